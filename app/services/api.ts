@@ -51,13 +51,24 @@ export const apiService = {
   createProduct: (data: any) => api.post('/api/my-products/', data),
   updateProduct: (id: number, data: any) => api.patch(`/api/my-products/${id}/`, data),
   deleteProduct: (id: number) => api.delete(`/api/my-products/${id}/`),
-  getAllProducts: () => api.get('/api/products/'),
+  getAllProducts: (cursor?: string) => api.get('/api/products/', { params: { cursor } }),
+  searchProducts: (q: string, params: { category?: string; status?: string; cursor?: string } = {}) =>
+    api.get('/api/products/search/', { params: { q, ...params } }),
+  getProductMatches: (productId: number) => api.get(`/api/products/${productId}/matches/`),
   toggleProductLike: (productId: number) => api.post(`/api/products/${productId}/like/`),
 
   // Chat
-  getMyChats: () => api.get('/api/my-chats/'),
+  getMyChats: (cursor?: string) => api.get('/api/my-chats/', { params: { cursor } }),
   getChatRoom: (chatId: number) => api.get(`/api/chats/${chatId}/`),
-  getChatMessages: (chatId: number) => api.get(`/api/chats/${chatId}/messages/`),
+  // Newest first; pass the `next` cursor to load older messages
+  getChatMessages: (chatId: number, cursor?: string) =>
+    api.get(`/api/chats/${chatId}/messages/`, { params: { cursor } }),
+  // Only messages newer than afterId; with wait > 0 the server holds the request until one arrives
+  getNewChatMessages: (chatId: number, afterId: number, wait: number = 0) =>
+    api.get(`/api/chats/${chatId}/messages/`, {
+      params: { after_id: afterId, wait: wait || undefined },
+      timeout: (wait + 10) * 1000,
+    }),
   sendMessage: (chatId: number, content: string) => 
     api.post(`/api/chats/${chatId}/messages/`, { content }),
   createChatRoom: (productId: number) => 
@@ -66,4 +77,8 @@ export const apiService = {
     api.post(`/api/chats/${chatId}/mark-read/`),
 };
 
+// Live chat updates: message, read and typing events for one room
+export const chatSocketUrl = (chatId: number, firebaseToken: string) =>
+  `${API_BASE_URL.replace(/^http/, 'ws')}/ws/chats/${chatId}/?token=${encodeURIComponent(firebaseToken)}`;
+
 export default api;
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Primary/replica database routing with read-your-writes stickiness.
+
+When DATABASE_REPLICA_ALIAS names a configured database, reads made inside
+use_replica() go to it; everything else, including management commands,
+WebSocket consumers and reads inside a transaction, uses the primary
+("default"). ReplicaPinningMiddleware lets safe requests read from the
+replica, except for a while after the same client's writes: each unsafe
+request flags its client in the cache for DATABASE_REPLICA_PIN_SECONDS,
+which should exceed the replica's usual lag, so clients read their own
+writes. A client is its Authorization header or session cookie, since token
+users are only resolved inside the view.
+"""
+
+import contextlib
+import contextvars
+import hashlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica_allowed = contextvars.ContextVar('replica_allowed', default=False)
+
+
+@contextlib.contextmanager
+def use_replica(allowed=True):
+    """Let reads in the block go to the replica, or with allowed=False keep them on the primary"""
+    token = _replica_allowed.set(allowed)
+    try:
+        yield
+    finally:
+        _replica_allowed.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replica = settings.DATABASE_REPLICA_ALIAS
+        if not replica or not _replica_allowed.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations from the database the instance came from
+            return instance._state.db
+        return replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica is a copy of the primary, so rows from either may be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def pin_key(request):
+    credentials = request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return 'db-pin:' + hashlib.sha256(credentials.encode()).hexdigest()
+
+
+class ReplicaPinningMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.DATABASE_REPLICA_ALIAS:
+            return self.get_response(request)
+        key = pin_key(request)
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            if key is not None:
+                cache.set(key, True, settings.DATABASE_REPLICA_PIN_SECONDS)
+            return response
+        with use_replica(key is None or not cache.get(key)):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if not settings.DATABASE_REPLICA_ALIAS:
+            return await self.get_response(request)
+        key = pin_key(request)
+        if request.method not in SAFE_METHODS:
+            response = await self.get_response(request)
+            if key is not None:
+                await cache.aset(key, True, settings.DATABASE_REPLICA_PIN_SECONDS)
+            return response
+        with use_replica(key is None or not await cache.aget(key)):
+            return await self.get_response(request)
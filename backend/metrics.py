@@ -0,0 +1,200 @@
+"""
+In-process request metrics exported in the Prometheus text format.
+
+MetricsMiddleware records, per resolved URL name, the total latency, SQL
+query count and time, time spent authenticating and serializing, and the
+response size. Values go into fixed-bucket histograms guarded by one lock
+each, so recording a request is a handful of additions. Requests slower than
+SLOW_REQUEST_THRESHOLD seconds are logged with their slowest queries.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import heapq
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+SLOW_QUERIES_KEPT = 5
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label: (list(counts), total, count) for label, (counts, total, count) in self._series.items()}
+        for label, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{route="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{route="{label}"}} {total}')
+            lines.append(f'{self.name}_count{{route="{label}"}} {count}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Total request latency.', DURATION_BUCKETS)
+SQL_QUERIES = Histogram('http_request_sql_queries', 'SQL queries per request.', COUNT_BUCKETS)
+SQL_DURATION = Histogram('http_request_sql_duration_seconds', 'Time spent in SQL per request.', DURATION_BUCKETS)
+SERIALIZER_DURATION = Histogram(
+    'http_request_serializer_duration_seconds', 'Time spent serializing per request.', DURATION_BUCKETS
+)
+AUTH_DURATION = Histogram(
+    'http_request_auth_duration_seconds', 'Time spent authenticating per request.', DURATION_BUCKETS
+)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'Response body size.', SIZE_BUCKETS)
+HISTOGRAMS = (REQUEST_DURATION, SQL_QUERIES, SQL_DURATION, SERIALIZER_DURATION, AUTH_DURATION, RESPONSE_SIZE)
+
+
+class RequestStats:
+    """Per-request accumulator, reachable from anywhere through the context var"""
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.phases = {}
+        self.active = set()
+        self.slow_queries = []
+
+    def record_query(self, sql, elapsed):
+        self.sql_count += 1
+        self.sql_time += elapsed
+        entry = (elapsed, self.sql_count, sql)
+        if len(self.slow_queries) < SLOW_QUERIES_KEPT:
+            heapq.heappush(self.slow_queries, entry)
+        elif elapsed > self.slow_queries[0][0]:
+            heapq.heapreplace(self.slow_queries, entry)
+
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """
+    Installed on every connection, so queries are counted whichever thread
+    runs them: async views reach the ORM through sync_to_async, which
+    carries the request's context var into its worker thread.
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - started)
+
+
+@receiver(connection_created)
+def install_execute_wrapper(sender, connection, **kwargs):
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, execute_wrapper)
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Add the time spent in the block to the current request's phase total"""
+    stats = _current.get()
+    if stats is None or phase in stats.active:
+        # Nested blocks of the same phase are already being timed
+        yield
+        return
+    stats.active.add(phase)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.active.discard(phase)
+        stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def observe(self, request, response, stats, elapsed):
+        match = request.resolver_match
+        route = (match.url_name or match.view_name) if match else 'unresolved'
+        REQUEST_DURATION.observe(route, elapsed)
+        SQL_QUERIES.observe(route, stats.sql_count)
+        SQL_DURATION.observe(route, stats.sql_time)
+        SERIALIZER_DURATION.observe(route, stats.phases.get('serializer', 0.0))
+        AUTH_DURATION.observe(route, stats.phases.get('auth', 0.0))
+        if not response.streaming:
+            RESPONSE_SIZE.observe(route, len(response.content))
+
+        if elapsed >= settings.SLOW_REQUEST_THRESHOLD:
+            slowest = sorted(stats.slow_queries, reverse=True)
+            logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries in %.3fs. Slowest queries:\n%s',
+                request.method, request.path, route, elapsed, stats.sql_count, stats.sql_time,
+                '\n'.join(f'  {duration * 1000:.1f}ms {sql}' for duration, _, sql in slowest),
+            )
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    return '\n'.join(lines) + '\n'
@@ -49,9 +49,12 @@ INSTALLED_APPS = [
     'allauth.socialaccount.providers.apple',
     'users',
     'rest_framework.authtoken',
+    'channels',
 ]
 
 MIDDLEWARE = [
+    'backend.metrics.MetricsMiddleware',
+    'backend.db_router.ReplicaPinningMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -81,16 +84,83 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
+
+# Shared cache for list version stamps and cached product representations.
+# Use Redis whenever more than one worker serves the API, otherwise workers
+# would disagree on ETags.
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+
+# Channel layer for chat WebSockets. The in-memory layer only reaches sockets
+# served by the same process; set REDIS_URL (and install channels_redis) to
+# fan out across workers.
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
+#
+# Connections are kept for DB_CONN_MAX_AGE seconds and checked before reuse.
+# On connect SQLite switches to WAL, so readers never wait for a writer;
+# writers wait up to DB_BUSY_TIMEOUT seconds for each other instead of failing,
+# and IMMEDIATE transactions take the write lock up front, where that wait
+# applies, rather than failing on a lock upgrade mid-transaction.
+# db.sqlite3 is local and untracked: create it with `python manage.py migrate`.
+# One from before users.User became AUTH_USER_MODEL cannot be migrated
+# forward; delete it and migrate again.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': config('DB_BUSY_TIMEOUT', default=5, cast=float),
+            'transaction_mode': 'IMMEDIATE',
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-32000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=268435456;'
+            ),
+        },
     }
 }
 
+# Optional read replica, e.g. a LiteFS or Litestream copy of the database
+# file. Reads are routed to it by backend.db_router, except for a client's
+# reads within DATABASE_REPLICA_PIN_SECONDS of its own writes.
+DATABASE_REPLICA_NAME = config('DATABASE_REPLICA_NAME', default='')
+DATABASE_REPLICA_ALIAS = ''
+if DATABASE_REPLICA_NAME:
+    DATABASE_REPLICA_ALIAS = 'replica'
+    DATABASES[DATABASE_REPLICA_ALIAS] = {
+        **DATABASES['default'],
+        'NAME': DATABASE_REPLICA_NAME,
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['backend.db_router.PrimaryReplicaRouter']
+DATABASE_REPLICA_PIN_SECONDS = config('DATABASE_REPLICA_PIN_SECONDS', default=5, cast=int)
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -123,12 +193,14 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+AUTH_USER_MODEL = 'users.User'
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'users.authentication.FirebaseAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'users.authentication.TokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -136,6 +208,26 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Long-polling on /api/chats/<id>/messages/?after_id=...&wait=<seconds>
+CHAT_LONG_POLL_MAX_WAIT = config('CHAT_LONG_POLL_MAX_WAIT', default=25, cast=float)
+CHAT_LONG_POLL_INTERVAL = config('CHAT_LONG_POLL_INTERVAL', default=1.0, cast=float)
+
+# `manage.py archive_messages` moves messages older than this into compressed
+# per-room segments of up to MESSAGE_ARCHIVE_SEGMENT_SIZE messages
+MESSAGE_ARCHIVE_AFTER_DAYS = config('MESSAGE_ARCHIVE_AFTER_DAYS', default=180, cast=int)
+MESSAGE_ARCHIVE_SEGMENT_SIZE = config('MESSAGE_ARCHIVE_SEGMENT_SIZE', default=500, cast=int)
+
+# 'direct' updates Product.likes_count atomically on every toggle; 'buffered'
+# appends deltas that `manage.py flush_like_counters` folds in periodically
+LIKE_COUNTER_MODE = config('LIKE_COUNTER_MODE', default='direct')
+
+# Largest number of items accepted by one request to the /batch/ endpoints
+BATCH_MAX_ITEMS = config('BATCH_MAX_ITEMS', default=500, cast=int)
+
+# Tombstones in the product change log (delta sync) are kept this long;
+# clients that have not synced for longer start over
+PRODUCT_CHANGES_RETENTION_DAYS = config('PRODUCT_CHANGES_RETENTION_DAYS', default=30, cast=int)
+
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
     'allauth.account.auth_backends.AuthenticationBackend',
@@ -147,9 +239,18 @@ ACCOUNT_EMAIL_VERIFICATION = 'none'
 ACCOUNT_AUTHENTICATION_METHOD = 'username_email'
 ACCOUNT_EMAIL_REQUIRED = True
 
+# Request metrics exported at /metrics; METRICS_TOKEN, when set, must be sent
+# as "Authorization: Bearer <token>" to scrape them
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+SLOW_REQUEST_THRESHOLD = config('SLOW_REQUEST_THRESHOLD', default=1.0, cast=float)
+
 # Firebase Configuration
 FIREBASE_CREDENTIALS_PATH = config('FIREBASE_CREDENTIALS_PATH', default='')
 
+# Verified ID tokens are cached until they expire; resolved users for this long
+FIREBASE_TOKEN_CACHE_SIZE = config('FIREBASE_TOKEN_CACHE_SIZE', default=10000, cast=int)
+FIREBASE_USER_CACHE_TTL = config('FIREBASE_USER_CACHE_TTL', default=300, cast=int)
+
 # Initialize Firebase Admin SDK
 if FIREBASE_CREDENTIALS_PATH and os.path.exists(FIREBASE_CREDENTIALS_PATH):
     cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
@@ -1,4 +1,16 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from .metrics import render_metrics
 
 def home(request):
-    return HttpResponse("Welcome to the Django site!") 
\ No newline at end of file
+    return HttpResponse("Welcome to the Django site!")
+
+def metrics(request):
+    """Prometheus scrape endpoint"""
+    if settings.METRICS_TOKEN:
+        keyword, _, token = request.headers.get('Authorization', '').partition(' ')
+        if keyword != 'Bearer' or not constant_time_compare(token, settings.METRICS_TOKEN):
+            return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
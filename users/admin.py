@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Product, ChatRoom, Message, ProductLike, Item
+from .models import (
+    User, Product, ChatRoom, ChatReadState, Message, MessageArchiveSegment, ProductLike, Item, ProductTerm
+)
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -23,16 +25,22 @@ class ProductAdmin(admin.ModelAdmin):
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ('id', 'product', 'created_at')
+    list_display = ('id', 'product', 'message_count', 'created_at')
     list_filter = ('created_at',)
     filter_horizontal = ('participants',)
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('sender', 'chat_room', 'content', 'is_read', 'created_at')
-    list_filter = ('is_read', 'created_at')
+    list_display = ('sender', 'chat_room', 'content', 'created_at')
+    list_filter = ('created_at',)
     search_fields = ('content', 'sender__username')
 
+@admin.register(MessageArchiveSegment)
+class MessageArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ('chat_room', 'message_count', 'first_created_at', 'last_created_at')
+    list_filter = ('last_created_at',)
+    exclude = ('data',)
+
 @admin.register(ProductLike)
 class ProductLikeAdmin(admin.ModelAdmin):
     list_display = ('user', 'product', 'created_at')
@@ -42,4 +50,14 @@ class ProductLikeAdmin(admin.ModelAdmin):
 class ItemAdmin(admin.ModelAdmin):
     list_display = ('title', 'location', 'created_at')
     list_filter = ('created_at',)
-    search_fields = ('title', 'location')
\ No newline at end of file
+    search_fields = ('title', 'location')
+
+@admin.register(ProductTerm)
+class ProductTermAdmin(admin.ModelAdmin):
+    list_display = ('term', 'kind', 'product')
+    list_filter = ('kind',)
+    search_fields = ('term',)
+
+@admin.register(ChatReadState)
+class ChatReadStateAdmin(admin.ModelAdmin):
+    list_display = ('chat_room', 'user', 'last_read_message_id', 'read_count')
@@ -0,0 +1,197 @@
+"""
+Cold storage for old chat history.
+
+archive_messages moves messages older than MESSAGE_ARCHIVE_AFTER_DAYS out of
+the Message table into MessageArchiveSegment rows: runs of up to
+MESSAGE_ARCHIVE_SEGMENT_SIZE consecutive messages of one room, stored as
+zlib-compressed JSON. Only a prefix of each room's history in
+MessagePagination order is archived, never the room's newest message (the
+inbox shows it through ChatRoom.last_message), so a room's archive sorts
+entirely before its hot rows.
+Paging back through a room therefore reads the hot rows until they run out
+and then continues into the archive, decompressing only the segments the
+page needs. Archived messages are read-only; admin search covers hot rows.
+"""
+
+import json
+import zlib
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from rest_framework.exceptions import NotFound
+
+from .models import ChatReadState, ChatRoom, Message, MessageArchiveSegment, User
+from .pagination import KeysetPagination, MessagePagination
+
+
+def pack(rows):
+    """Compress (id, sender_id, content, created_at) rows, oldest first"""
+    data = [
+        [message_id, sender_id, content, created_at.isoformat()]
+        for message_id, sender_id, content, created_at in rows
+    ]
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+
+def unpack(segment):
+    """The segment's messages, oldest first, as unsaved Message instances"""
+    return [
+        Message(
+            id=message_id, chat_room_id=segment.chat_room_id, sender_id=sender_id,
+            content=content, created_at=datetime.fromisoformat(created_at),
+        )
+        for message_id, sender_id, content, created_at in json.loads(zlib.decompress(segment.data))
+    ]
+
+
+def write_segment(segment, messages):
+    """Store messages (oldest first) in segment, deleting it when there are none"""
+    if not messages:
+        if segment.pk:
+            segment.delete()
+        return
+    first, last = messages[0], messages[-1]
+    segment.first_message_id, segment.first_created_at = first.id, first.created_at
+    segment.last_message_id, segment.last_created_at = last.id, last.created_at
+    segment.message_count = len(messages)
+    segment.data = pack(
+        (message.id, message.sender_id, message.content, message.created_at) for message in messages
+    )
+    segment.save()
+
+
+def archivable(chat_room_id, cutoff):
+    """The room's messages older than cutoff that sort before its newest message"""
+    newest = (
+        Message.objects.filter(chat_room_id=chat_room_id).order_by(*MessagePagination.ordering)
+        .values_list('created_at', 'id').first()
+    )
+    if newest is None:
+        return Message.objects.none()
+    last_message_id = ChatRoom.objects.filter(pk=chat_room_id).values_list('last_message_id', flat=True).first()
+    return (
+        Message.objects.filter(chat_room_id=chat_room_id, created_at__lt=cutoff)
+        .filter(KeysetPagination.keyset_filter(MessagePagination.ordering, newest))
+        .exclude(id=last_message_id)
+        .order_by('created_at', 'id')
+    )
+
+
+def archive_room(chat_room_id, cutoff, segment_size):
+    """Move the room's archivable messages into segments, one transaction each; return how many moved"""
+    moved = 0
+    while True:
+        with transaction.atomic():
+            tail = (
+                MessageArchiveSegment.objects.filter(chat_room_id=chat_room_id)
+                .order_by('-last_created_at', '-last_message_id').first()
+            )
+            # Top up a partly filled last segment before starting a new one
+            if tail is None or tail.message_count >= segment_size:
+                tail, messages = MessageArchiveSegment(chat_room_id=chat_room_id), []
+            else:
+                messages = unpack(tail)
+            rows = list(
+                archivable(chat_room_id, cutoff)
+                .values_list('id', 'sender_id', 'content', 'created_at')[:segment_size - len(messages)]
+            )
+            if not rows:
+                return moved
+            messages += [
+                Message(
+                    id=message_id, chat_room_id=chat_room_id, sender_id=sender_id,
+                    content=content, created_at=created_at,
+                )
+                for message_id, sender_id, content, created_at in rows
+            ]
+            write_segment(tail, messages)
+            Message.objects.filter(id__in=[row[0] for row in rows]).delete()
+        moved += len(rows)
+
+
+def archive(cutoff, segment_size):
+    """Archive every room's messages older than cutoff; return the number moved"""
+    rooms = ChatRoom.objects.filter(
+        Exists(Message.objects.filter(chat_room=OuterRef('pk'), created_at__lt=cutoff))
+    ).order_by('id').values_list('id', flat=True)
+    return sum(archive_room(chat_room_id, cutoff, segment_size) for chat_room_id in rooms.iterator())
+
+
+def read(chat_room_id, position, newer, limit):
+    """
+    Up to limit archived messages of the room strictly after position in the
+    direction of travel: newer ones oldest first, older ones newest first.
+    Segments are fetched and decompressed one by one until limit is reached.
+    """
+    segments = MessageArchiveSegment.objects.filter(chat_room_id=chat_room_id)
+    key = None
+    if position is not None:
+        try:
+            key = tuple(MessagePagination.parse_position(list(position), MessagePagination.position_types))
+        except (TypeError, ValueError):
+            raise NotFound(MessagePagination.invalid_cursor_message)
+    if newer:
+        if key is not None:
+            segments = segments.filter(last_created_at__gte=key[0])
+        segments = segments.order_by('last_created_at', 'last_message_id')
+    else:
+        if key is not None:
+            segments = segments.filter(first_created_at__lte=key[0])
+        segments = segments.order_by('-first_created_at', '-first_message_id')
+
+    def after(message):
+        if key is None:
+            return True
+        return (message.created_at, message.id) > key if newer else (message.created_at, message.id) < key
+
+    messages = []
+    for segment in segments.iterator(chunk_size=2):
+        batch = unpack(segment)
+        if not newer:
+            batch.reverse()
+        messages += filter(after, batch)
+        if len(messages) >= limit:
+            break
+    messages = messages[:limit]
+    if not messages:
+        return messages
+
+    senders = User.objects.in_bulk({message.sender_id for message in messages})
+    # forget_sender() misses senders who had already left the room
+    messages = [message for message in messages if message.sender_id in senders]
+    watermarks = list(
+        ChatReadState.objects.filter(chat_room_id=chat_room_id).values_list('user_id', 'last_read_message_id')
+    )
+    for message in messages:
+        message.sender = senders[message.sender_id]
+        # Same rule as Message.objects.with_read_state()
+        message.is_read = any(
+            user_id != message.sender_id and last_read >= message.id for user_id, last_read in watermarks
+        )
+    return messages
+
+
+def fill_page(paginator, rows, chat_room_id):
+    """
+    Complete the hot rows MessagePagination fetched for a page with archived
+    messages: going back, once the hot rows run out; going forward, ahead of
+    them, since the whole archive is older.
+    """
+    wanted = paginator.page_size_value + 1
+    if paginator.reverse:
+        return (read(chat_room_id, paginator.position, True, wanted) + rows)[:wanted]
+    if len(rows) >= wanted:
+        return rows
+    position = paginator.position_for(rows[-1]) if rows else paginator.position
+    return rows + read(chat_room_id, position, False, wanted - len(rows))
+
+
+def forget_sender(user_id):
+    """Drop a user's archived messages, as deleting the user does with their hot ones"""
+    segments = MessageArchiveSegment.objects.filter(chat_room__participants=user_id).distinct()
+    for segment in segments.iterator():
+        messages = unpack(segment)
+        kept = [message for message in messages if message.sender_id != user_id]
+        if len(kept) != len(messages):
+            write_segment(segment, kept)
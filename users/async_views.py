@@ -0,0 +1,188 @@
+"""
+Async versions of the hot read paths, for deployments served over ASGI.
+
+These are plain Django async views rather than DRF ones, whose request cycle
+is synchronous. Each authenticates through authenticate_async(), queries
+with the async ORM and hands only fully loaded rows to the serializers, so
+no serializer reaches the database from the event loop. A client waiting on
+a long-poll is a suspended coroutine rather than a blocked thread, so one
+worker holds many of them without growing its thread pool. Writes that must
+commit together still run in one sync_to_async() call, since transactions
+are not available to async code.
+"""
+
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.request import Request
+
+from . import archive, likes
+from .authentication import authenticate_async
+from .fieldsets import parse_fieldset
+from .longpoll import await_messages
+from .models import ChatRoom, Message, Product
+from .pagination import ChatRoomPagination, KeysetPagination, MessagePagination
+from .serializers import ChatRoomSerializer, MessageSerializer, ProductSerializer
+from .streaming import dumps
+
+
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), status=status, content_type='application/json')
+
+
+def async_api_view(*methods):
+    """
+    Restrict an async view to methods and require header authentication.
+
+    Only the Authorization header schemes are accepted, never the session
+    cookie, so the views can skip CSRF checks like DRF's token-authenticated
+    views do.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                return json_response({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            try:
+                user = await authenticate_async(request)
+            except exceptions.AuthenticationFailed as exc:
+                return json_response({'detail': str(exc.detail)}, status=401)
+            if user is None:
+                return json_response({'detail': 'Authentication credentials were not provided.'}, status=401)
+            request.user = user
+            try:
+                return await view(request, *args, **kwargs)
+            except exceptions.APIException as exc:
+                # e.g. NotFound for an invalid pagination cursor
+                return json_response({'detail': str(exc.detail)}, status=exc.status_code)
+        return wrapped
+    return decorator
+
+
+def serialize(request, serializer_class, instances, **kwargs):
+    """
+    Serialize with RepresentationMixin's ?fields= and ?normalize= handling;
+    return the data and the side-loaded users map (None when not normalizing).
+    """
+    context, users = {'request': request}, None
+    if request.method == 'GET':
+        if request.GET.get('fields'):
+            kwargs['fields'] = parse_fieldset(request.GET['fields'])
+        if request.GET.get('normalize') in ('1', 'true'):
+            users = context['users'] = {}
+    return serializer_class(instances, context=context, **kwargs).data, users
+
+
+def with_users(data, users):
+    if users is None:
+        return data
+    if isinstance(data, list):
+        return {'results': data, 'users': users}
+    return {**data, 'users': users}
+
+
+async def paginated_response(request, paginator, queryset, serializer_class):
+    page = await paginator.apaginate_queryset(queryset, Request(request))
+    data, users = serialize(request, serializer_class, page, many=True)
+    return json_response(with_users(paginator.get_paginated_data(data), users))
+
+
+@async_api_view('GET')
+async def all_products(request):
+    """Available products of other users, newest first (AllProductsView)"""
+    queryset = (
+        Product.objects.filter(status='available')
+        .exclude(owner=request.user)
+        .with_like_state(request.user)
+    )
+    return await paginated_response(request, KeysetPagination(), queryset, ProductSerializer)
+
+
+@async_api_view('GET')
+async def my_chats(request):
+    """The user's chat rooms, most recently active first (MyChatRoomsView)"""
+    queryset = ChatRoom.objects.for_inbox(request.user)
+    return await paginated_response(request, ChatRoomPagination(), queryset, ChatRoomSerializer)
+
+
+@async_api_view('GET', 'POST')
+async def chat_messages(request, chat_room_id):
+    """
+    List and send messages like ChatMessagesView, including ?after_id=,
+    ?since= and ?wait= long-polling.
+    """
+    if not await ChatRoom.objects.filter(id=chat_room_id, participants=request.user).aexists():
+        return json_response({'detail': 'Not found.'}, status=404)
+    if request.method == 'POST':
+        return await send_message(request, chat_room_id)
+
+    queryset = Message.objects.filter(chat_room_id=chat_room_id).with_read_state().select_related('sender')
+    params = request.GET
+    if 'after_id' not in params and 'since' not in params:
+        paginator = MessagePagination()
+        rows = [message async for message in paginator.get_page_queryset(queryset, Request(request))]
+        # Archived segments are read on the thread pool, like the ORM's own sync work
+        page = paginator.set_page(await sync_to_async(archive.fill_page)(paginator, rows, chat_room_id))
+        data, users = serialize(request, MessageSerializer, page, many=True)
+        return json_response(with_users(paginator.get_paginated_data(data), users))
+
+    try:
+        if 'after_id' in params:
+            queryset = queryset.filter(id__gt=int(params['after_id']))
+        if 'since' in params:
+            since = parse_datetime(params['since'])
+            if since is None:
+                raise ValueError
+            queryset = queryset.filter(created_at__gt=since)
+        wait = min(float(params.get('wait', 0)), settings.CHAT_LONG_POLL_MAX_WAIT)
+    except ValueError:
+        return json_response(
+            {'error': 'after_id must be an integer, since an ISO timestamp and wait a number'}, status=400
+        )
+
+    if wait > 0:
+        await await_messages(
+            chat_room_id, queryset.aexists, wait, poll_interval=settings.CHAT_LONG_POLL_INTERVAL,
+        )
+    batch = [message async for message in queryset.order_by('id')[:MessagePagination.max_page_size]]
+    data, users = serialize(request, MessageSerializer, batch, many=True)
+    return json_response(with_users(data, users))
+
+
+async def send_message(request, chat_room_id):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return json_response({'detail': 'JSON parse error.'}, status=400)
+    serializer = MessageSerializer(data=data, context={'request': request})
+    if not serializer.is_valid():
+        return json_response(serializer.errors, status=400)
+    return json_response(await sync_to_async(create_message)(serializer, request.user, chat_room_id), status=201)
+
+
+def create_message(serializer, user, chat_room_id):
+    # The message row and the room's counters (see ChatRoom.record_message) commit together
+    with transaction.atomic():
+        serializer.save(sender=user, chat_room_id=chat_room_id)
+    return serializer.data
+
+
+@async_api_view('POST')
+async def toggle_product_like(request, product_id):
+    """Toggle like/unlike for a product"""
+    if not await Product.objects.filter(id=product_id).aexists():
+        return json_response({'detail': 'Not found.'}, status=404)
+    return json_response(await sync_to_async(toggle_like)(request.user, product_id))
+
+
+def toggle_like(user, product_id):
+    liked = likes.toggle(user, product_id)
+    return {'liked': liked, 'likes_count': likes.current_count(product_id)}
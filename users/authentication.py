@@ -1,10 +1,32 @@
+import hashlib
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from rest_framework import authentication, exceptions
-from firebase_admin import auth
-import firebase_admin
+
+from backend.metrics import timed
+from .firebase_tokens import TTLCache, verify_id_token
 
 User = get_user_model()
 
+# Decoded claims keyed by sha256(token), kept until the token's own exp
+token_cache = TTLCache(maxsize=settings.FIREBASE_TOKEN_CACHE_SIZE)
+
+
+def user_cache_key(firebase_uid):
+    """
+    Resolved users live in the shared cache, so every worker sees the
+    eviction users.signals makes when a user is saved or deleted
+    """
+    return f'firebase-user:{firebase_uid}'
+
+
 class FirebaseAuthentication(authentication.BaseAuthentication):
     """
     Firebase token based authentication.
@@ -39,27 +61,144 @@ class FirebaseAuthentication(authentication.BaseAuthentication):
         return self.authenticate_credentials(token)
     
     def authenticate_credentials(self, token):
+        with timed('auth'):
+            decoded_token = token_cache.get(self.token_key(token)) or self.decode_token(token)
+            return (self.get_active_user(decoded_token), token)
+
+    async def aauthenticate_credentials(self, token):
+        """authenticate_credentials() for async views; only cache misses leave the event loop"""
+        with timed('auth'):
+            decoded_token = token_cache.get(self.token_key(token))
+            if decoded_token is None:
+                # Certificate fetches block, so verify outside the shared sync thread
+                decoded_token = await sync_to_async(self.decode_token, thread_sensitive=False)(token)
+            user = await cache.aget(user_cache_key(decoded_token['uid']))
+            if user is None:
+                user = await sync_to_async(self.get_or_cache_user)(decoded_token)
+            return (self.check_active(user), token)
+
+    def get_active_user(self, decoded_token):
+        user = cache.get(user_cache_key(decoded_token['uid']))
+        if user is None:
+            user = self.get_or_cache_user(decoded_token)
+        return self.check_active(user)
+
+    def get_or_cache_user(self, decoded_token):
+        user = self.get_or_create_user(decoded_token)
+        cache.set(user_cache_key(decoded_token['uid']), user, timeout=settings.FIREBASE_USER_CACHE_TTL)
+        return user
+
+    @staticmethod
+    def check_active(user):
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return user
+
+    @staticmethod
+    def token_key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def decode_token(self, token):
+        """Verify token with Firebase and cache its claims until it expires"""
         try:
             # Verify the Firebase ID token
-            decoded_token = auth.verify_id_token(token)
-            firebase_uid = decoded_token['uid']
-            email = decoded_token.get('email', '')
-            name = decoded_token.get('name', '')
-            
+            decoded_token = verify_id_token(token)
         except Exception as e:
             raise exceptions.AuthenticationFailed('Invalid Firebase token.')
+        token_cache.set(self.token_key(token), decoded_token, expires_at=decoded_token.get('exp', 0))
+        return decoded_token
+
+    def get_or_create_user(self, decoded_token):
+        firebase_uid = decoded_token['uid']
+        email = decoded_token.get('email', '')
+        name = decoded_token.get('name', '')
         
         try:
             # Try to get existing user by firebase_uid
-            user = User.objects.get(firebase_uid=firebase_uid)
+            return User.objects.get(firebase_uid=firebase_uid)
         except User.DoesNotExist:
             # Create new user if doesn't exist
-            user = User.objects.create_user(
+            return User.objects.create_user(
                 username=email or firebase_uid,
                 email=email,
                 firebase_uid=firebase_uid,
                 first_name=name.split(' ')[0] if name else '',
                 last_name=' '.join(name.split(' ')[1:]) if name and len(name.split(' ')) > 1 else ''
             )
-        
-        return (user, token)
\ No newline at end of file
+
+
+class TokenAuthentication(authentication.TokenAuthentication):
+    """DRF token authentication that reports its time to the request metrics"""
+
+    def authenticate_credentials(self, key):
+        with timed('auth'):
+            return super().authenticate_credentials(key)
+
+    async def aauthenticate_credentials(self, key):
+        """authenticate_credentials() through the async ORM"""
+        with timed('auth'):
+            try:
+                token = await self.get_model().objects.select_related('user').aget(key=key)
+            except self.get_model().DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return (token.user, token)
+
+
+async def authenticate_async(request):
+    """
+    Resolve the user of an async view from its Authorization header, with the
+    same "Bearer <firebase token>" and "Token <key>" schemes as the REST
+    backends. Returns None when no credentials were sent and raises
+    AuthenticationFailed when they are invalid.
+    """
+    keyword, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    backend = AUTHENTICATION_BACKENDS.get(keyword.lower())
+    if backend is None:
+        return None
+    if not credentials or ' ' in credentials.strip():
+        raise exceptions.AuthenticationFailed('Invalid token header.')
+    user, _ = await backend().aauthenticate_credentials(credentials.strip())
+    return user
+
+
+AUTHENTICATION_BACKENDS = {
+    FirebaseAuthentication.keyword.lower(): FirebaseAuthentication,
+    TokenAuthentication.keyword.lower(): TokenAuthentication,
+}
+
+
+class WebSocketAuthMiddleware(BaseMiddleware):
+    """
+    Resolve scope['user'] for WebSocket connections with the REST backends.
+
+    Accepts an "Authorization: Bearer <firebase token>" or "Token <key>" header,
+    or, for clients that cannot set headers, ?token=<firebase token> or
+    ?key=<DRF token> in the query string.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope, user=await get_websocket_user(scope))
+        return await super().__call__(scope, receive, send)
+
+
+@database_sync_to_async
+def get_websocket_user(scope):
+    headers = dict(scope.get('headers', []))
+    query = parse_qs(scope.get('query_string', b'').decode())
+    keyword, _, credentials = headers.get(b'authorization', b'').decode().partition(' ')
+
+    if not credentials and query.get('token'):
+        keyword, credentials = FirebaseAuthentication.keyword, query['token'][0]
+    elif not credentials and query.get('key'):
+        keyword, credentials = TokenAuthentication.keyword, query['key'][0]
+
+    backend = AUTHENTICATION_BACKENDS.get(keyword.lower())
+    if backend is None or not credentials:
+        return AnonymousUser()
+    try:
+        user, _ = backend().authenticate_credentials(credentials)
+    except exceptions.AuthenticationFailed:
+        return AnonymousUser()
+    return user
@@ -0,0 +1,162 @@
+"""
+Batched actions for clients replaying a queue of offline changes.
+
+Each batch runs in one transaction and answers with one result per item, in
+request order: {"status": <HTTP status>, "data": ...} when the item was
+applied, {"status": <HTTP status>, "errors": ...} when it was skipped.
+Product creates and updates go through bulk_create()/bulk_update(), which
+send no signals, so the search and matching indexes, the change log and the
+representation cache are updated here instead of in signals.product_saved.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import caching, changes, geo, likes, matching, search
+from .models import ChatRoom, Product
+from .realtime import broadcast_read_receipt
+from .serializers import ProductSerializer
+
+NOT_FOUND = {'detail': 'Not found.'}
+# SQLite integers are signed 64-bit; larger ones overflow in the driver
+MAX_ID = 2 ** 63 - 1
+
+
+def applied(data, status=200):
+    return {'status': status, 'data': data}
+
+
+def skipped(errors, status=400):
+    return {'status': status, 'errors': errors}
+
+
+def get_items(data, *keys):
+    """The lists under keys of a request body; ValueError if malformed or too long"""
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    lists = []
+    for key in keys:
+        items = data.get(key, [])
+        if not isinstance(items, list):
+            raise ValueError(f'{key} must be a list')
+        lists.append(items)
+    if sum(map(len, lists)) > settings.BATCH_MAX_ITEMS:
+        raise ValueError(f'At most {settings.BATCH_MAX_ITEMS} items per batch')
+    return lists
+
+
+def parse_id(value):
+    # bool is an int subclass, but true is not a product id
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= MAX_ID:
+        return None
+    return value
+
+
+def known(ids):
+    return [value for value in ids if value is not None]
+
+
+def save_products(request, creates, updates):
+    """Create and update the request user's products; return (created, updated) results"""
+    user, context = request.user, {'request': request}
+    created, new = [], []
+    for item in creates:
+        serializer = ProductSerializer(data=item, context=context)
+        if not serializer.is_valid():
+            created.append(skipped(serializer.errors))
+            continue
+        product = Product(owner=user, **serializer.validated_data)
+        product.geohash = geo.encode_point(product.latitude, product.longitude)
+        product.is_liked = False
+        created.append(product)
+        new.append(product)
+
+    ids = [parse_id(item.get('id')) if isinstance(item, dict) else None for item in updates]
+    existing = Product.objects.filter(owner=user).with_like_state(user).order_by().in_bulk(known(ids))
+    updated, changed, fields = [], {}, set()
+    for product_id, item in zip(ids, updates):
+        if product_id is None:
+            updated.append(skipped({'id': ['A product id is required.']}))
+            continue
+        product = existing.get(product_id)
+        if product is None:
+            updated.append(skipped(NOT_FOUND, status=404))
+            continue
+        serializer = ProductSerializer(product, data=item, partial=True, context=context)
+        if not serializer.is_valid():
+            updated.append(skipped(serializer.errors))
+            continue
+        for name, value in serializer.validated_data.items():
+            setattr(product, name, value)
+        fields.update(serializer.validated_data)
+        changed[product.id] = product
+        updated.append(product)
+
+    now = timezone.now()
+    for product in changed.values():
+        product.geohash = geo.encode_point(product.latitude, product.longitude)
+        product.updated_at = now
+    with transaction.atomic():
+        Product.objects.bulk_create(new)
+        if changed:
+            Product.objects.bulk_update(changed.values(), [*fields, 'geohash', 'updated_at'])
+        saved = new + list(changed.values())
+        search.index_products(saved)
+        matching.index_products(saved)
+        product_ids = [product.id for product in saved]
+        changes.record(product_ids)
+        transaction.on_commit(lambda: caching.invalidate_products(product_ids, [user.id]))
+
+    def result(entry, status):
+        if isinstance(entry, Product):
+            return applied(ProductSerializer(entry, context=context).data, status)
+        return entry
+    return [result(entry, 201) for entry in created], [result(entry, 200) for entry in updated]
+
+
+def toggle_likes(user, product_ids):
+    """Toggle the user's like of each product in turn; report the final counts"""
+    ids = [parse_id(product_id) for product_id in product_ids]
+    existing = set(Product.objects.filter(id__in=known(ids)).values_list('id', flat=True))
+    toggled = []
+    with transaction.atomic():
+        for product_id in ids:
+            toggled.append(likes.toggle(user, product_id) if product_id in existing else None)
+    counts = likes.current_counts(existing)
+
+    results = []
+    for product_id, liked in zip(ids, toggled):
+        if product_id is None:
+            results.append(skipped({'product_id': ['A product id is required.']}))
+        elif product_id not in existing:
+            results.append(skipped(NOT_FOUND, status=404))
+        else:
+            results.append(applied({
+                'product_id': product_id, 'liked': liked, 'likes_count': counts.get(product_id, 0),
+            }))
+    return results
+
+
+def mark_rooms_read(user, chat_room_ids):
+    """Mark each of the user's chat rooms read up to its newest message"""
+    ids = [parse_id(chat_room_id) for chat_room_id in chat_room_ids]
+    rooms = ChatRoom.objects.filter(participants=user).order_by().in_bulk(known(ids))
+    results, marked = [], set()
+    with transaction.atomic():
+        for chat_room_id in ids:
+            if chat_room_id is None:
+                results.append(skipped({'chat_room_id': ['A chat room id is required.']}))
+            elif chat_room_id not in rooms:
+                results.append(skipped(NOT_FOUND, status=404))
+            else:
+                if chat_room_id not in marked:
+                    marked.add(chat_room_id)
+                    rooms[chat_room_id].mark_read(user)
+                results.append(applied({'chat_room_id': chat_room_id}))
+
+        def broadcast():
+            for room_id in marked:
+                broadcast_read_receipt(room_id, user.id)
+        transaction.on_commit(broadcast)
+    return results
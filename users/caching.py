@@ -0,0 +1,133 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+# The catalogue: bumped by product writes only; like toggles bump likes_scope()
+PRODUCTS_SCOPE = 'products'
+REPRESENTATION_TIMEOUT = 60 * 60
+
+
+def owner_products_scope(user_id):
+    return f'products:{user_id}'
+
+
+def likes_scope(user_id):
+    return f'likes:{user_id}'
+
+
+def chats_scope(user_id):
+    return f'chats:{user_id}'
+
+
+def _version_key(scope):
+    return f'list-version:{scope}'
+
+
+def get_versions(scopes):
+    """
+    Return the version stamp of each scope, in order.
+
+    A stamp is the time.time_ns() of the last write to the scope, so it also
+    serves as Last-Modified. Stamps live in the shared cache; a scope nobody
+    has written yet (or that was evicted) starts at the current time.
+    """
+    keys = [_version_key(scope) for scope in scopes]
+    stored = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in stored}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        stored.update(missing)
+    return [stored[key] for key in keys]
+
+
+def bump_versions(*scopes):
+    now = time.time_ns()
+    cache.set_many({_version_key(scope): now for scope in scopes}, timeout=None)
+
+
+def _representation_key(product_id):
+    return f'product-repr:{product_id}'
+
+
+def get_product_representations(product_ids):
+    cached = cache.get_many([_representation_key(product_id) for product_id in product_ids])
+    return {
+        product_id: cached[_representation_key(product_id)]
+        for product_id in product_ids if _representation_key(product_id) in cached
+    }
+
+
+def set_product_representations(representations):
+    cache.set_many(
+        {_representation_key(product_id): data for product_id, data in representations.items()},
+        timeout=REPRESENTATION_TIMEOUT,
+    )
+
+
+def forget_product_representations(product_ids):
+    """
+    Forget cached representations of product_ids without bumping any list,
+    for likes_count changes: a 304 may then show a count as of the last
+    product write, as a delta-synced replica does.
+    """
+    cache.delete_many([_representation_key(product_id) for product_id in product_ids])
+
+
+def invalidate_products(product_ids, owner_ids):
+    """Forget cached representations of product_ids and bump the catalogue and their owners' lists"""
+    forget_product_representations(product_ids)
+    bump_versions(PRODUCTS_SCOPE, *[owner_products_scope(owner_id) for owner_id in set(owner_ids)])
+
+
+class ConditionalListMixin:
+    """
+    ETag / Last-Modified support for list views.
+
+    Views name the version scopes their payload depends on in
+    get_version_scopes(). The ETag combines those stamps with the user and the
+    full query string, so a matching If-None-Match (or an If-Modified-Since
+    later than the newest stamp) is answered with 304 before any query or
+    serialization happens.
+
+    HTTP dates have whole-second resolution, and a second may still receive
+    writes until it is over. So Last-Modified is the end of the newest stamp's
+    second once that second has passed. Until then it is the start of that
+    second, which no If-Modified-Since can match.
+    """
+
+    def get_version_scopes(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        versions = get_versions(self.get_version_scopes())
+        digest = hashlib.md5(
+            f'{versions}:{request.user.pk}:{request.get_full_path()}'.encode()
+        ).hexdigest()
+        etag = quote_etag(digest)
+        newest = max(versions) // 10 ** 9
+        last_modified = newest + 1 if newest < time.time_ns() // 10 ** 9 else newest
+
+        if self.is_not_modified(request, etag, newest):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = self.get_list_response(request, *args, **kwargs)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def get_list_response(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @staticmethod
+    def is_not_modified(request, etag, newest):
+        """newest is the second, rounded down, of the newest version stamp"""
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            return etag in parse_etags(if_none_match) or if_none_match.strip() == '*'
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        return if_modified_since is not None and newest < if_modified_since
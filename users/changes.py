@@ -0,0 +1,103 @@
+"""
+Change log behind delta sync of the product catalogue.
+
+Every product write appends a ProductChange, and its id is the sync
+position: a client at position X needs the current state of each product
+changed after X. Writers are serialized on SQLite, so ids are handed out in
+commit order and no change can appear behind a position already served.
+Like toggles leave updated_at alone and are not logged either, so
+likes_count in a replica is as of the product's last change.
+
+compact() keeps the log near one row per product. It drops every change
+superseded by a newer one of the same product, which no client needs, and
+tombstones (changes of deleted products) older than
+PRODUCT_CHANGES_RETENTION_DAYS. A token carries the time of the first
+tombstone after its position, or the time it was issued if there was none.
+Past the retention window that tombstone may have been compacted away; if
+it is no longer the first one after the position, the token has expired and
+the client must sync from scratch.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ProductChange
+from .pagination import decode_cursor, encode_cursor
+
+
+class TokenExpired(Exception):
+    """Tombstones after the token's position may have been compacted away"""
+
+
+def record(product_ids, deleted=False):
+    ProductChange.objects.bulk_create(
+        [ProductChange(product_id=product_id, deleted=deleted) for product_id in product_ids]
+    )
+
+
+def retention_cutoff():
+    return timezone.now() - timedelta(days=settings.PRODUCT_CHANGES_RETENTION_DAYS)
+
+
+def first_tombstone_after(position):
+    return (
+        ProductChange.objects.filter(deleted=True, id__gt=position).order_by('id')
+        .values_list('created_at', flat=True).first()
+    )
+
+
+def encode_token(position, stamp):
+    return encode_cursor({'p': position, 't': stamp.isoformat()})
+
+
+def decode_token(token):
+    """(position, stamp) of a sync token, raising ValueError on malformed input"""
+    data = decode_cursor(token)
+    try:
+        position, stamp = int(data['p']), parse_datetime(data['t'])
+    except (TypeError, KeyError, ValueError) as exc:
+        raise ValueError('Malformed token') from exc
+    if stamp is None or timezone.is_naive(stamp):
+        raise ValueError('Malformed token')
+    return position, stamp
+
+
+def read(token, limit):
+    """
+    Return (product_ids, next_token, has_more) for up to limit changes after
+    token, or from the start of the log when token is None. product_ids holds
+    each changed product once. Raises ValueError for a malformed token and
+    TokenExpired for an expired one.
+    """
+    now, position = timezone.now(), 0
+    if token is not None:
+        position, stamp = decode_token(token)
+        if stamp < retention_cutoff():
+            first = first_tombstone_after(position)
+            if first is None or first > stamp:
+                raise TokenExpired
+    rows = list(
+        ProductChange.objects.filter(id__gt=position).order_by('id')
+        .values_list('id', 'product_id')[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        position = rows[-1][0]
+    # Tombstones written from now on are stamped later than now
+    stamp = first_tombstone_after(position) or now
+    product_ids = list(dict.fromkeys(product_id for _, product_id in rows))
+    return product_ids, encode_token(position, stamp), has_more
+
+
+def compact():
+    """Drop superseded changes and expired tombstones; return the number of rows deleted"""
+    superseded, _ = ProductChange.objects.filter(Exists(
+        ProductChange.objects.filter(product_id=OuterRef('product_id'), id__gt=OuterRef('id'))
+    )).delete()
+    expired, _ = ProductChange.objects.filter(deleted=True, created_at__lt=retention_cutoff()).delete()
+    return superseded + expired
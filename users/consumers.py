@@ -0,0 +1,71 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .models import ChatRoom
+from .realtime import room_group_name
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Live updates for one chat room at ws/chats/<chat_room_id>/.
+
+    Pushes {"type": "message"}, {"type": "read"} and {"type": "typing"} events
+    to every connected participant. Clients may send {"type": "typing"} and
+    {"type": "read"}; new messages are still sent through the REST API.
+    """
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        self.chat_room_id = self.scope['url_route']['kwargs']['chat_room_id']
+        self.group_name = room_group_name(self.chat_room_id)
+
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4401)
+            return
+        if not await self.get_chat_room():
+            await self.close(code=4403)
+            return
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        event_type = content.get('type')
+        if event_type == 'typing':
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'chat.typing',
+                'user_id': self.user.id,
+                'is_typing': bool(content.get('is_typing', True)),
+            })
+        elif event_type == 'read':
+            chat_room = await self.get_chat_room()
+            if chat_room is None:
+                # Removed from the room since connecting
+                await self.close(code=4403)
+                return
+            await database_sync_to_async(chat_room.mark_read)(self.user)
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'chat.read',
+                'user_id': self.user.id,
+            })
+
+    async def chat_message(self, event):
+        await self.send_json({'type': 'message', 'message': event['message']})
+
+    async def chat_read(self, event):
+        await self.send_json({'type': 'read', 'user_id': event['user_id']})
+
+    async def chat_typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({
+                'type': 'typing',
+                'user_id': event['user_id'],
+                'is_typing': event['is_typing'],
+            })
+
+    @database_sync_to_async
+    def get_chat_room(self):
+        return ChatRoom.objects.filter(id=self.chat_room_id, participants=self.user).first()
@@ -0,0 +1,92 @@
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+
+def parse_fieldset(value):
+    """
+    Turn "id,title,owner.username" into {'id': {}, 'title': {}, 'owner': {'username': {}}}.
+    An empty dict means the whole field.
+    """
+    fieldset = {}
+    for path in value.split(','):
+        node = fieldset
+        for name in filter(None, path.strip().split('.')):
+            node = node.setdefault(name, {})
+    return fieldset
+
+
+def apply_fieldset(data, fieldset):
+    """Project an already serialized representation onto fieldset"""
+    result = {}
+    for name, value in data.items():
+        if name not in fieldset:
+            continue
+        nested = fieldset[name]
+        if nested and isinstance(value, dict):
+            value = apply_fieldset(value, nested)
+        elif nested and isinstance(value, list):
+            value = [apply_fieldset(item, nested) if isinstance(item, dict) else item for item in value]
+        result[name] = value
+    return result
+
+
+def sideload_user(users, user_data, fieldset=None):
+    """
+    Move a serialized user, projected onto fieldset if given, into the users
+    map and return the reference left in its place
+    """
+    key = str(user_data['id'])
+    users.setdefault(key, apply_fieldset(user_data, fieldset) if fieldset else user_data)
+    return user_data['id']
+
+
+class RepresentationMixin:
+    """
+    Response shaping for read endpoints.
+
+    ?fields=id,title,owner.username keeps only the listed fields (dotted
+    paths reach into nested objects). ?normalize=1 replaces every embedded
+    user with its id and returns each user once in a top-level "users" map
+    keyed by id: paginated envelopes gain a "users" key, bare lists become
+    {"results": [...], "users": {...}} and single objects gain a "users" key.
+    """
+    fields_query_param = 'fields'
+    normalize_query_param = 'normalize'
+
+    def get_fieldset(self):
+        value = self.request.query_params.get(self.fields_query_param)
+        if not value or self.request.method not in SAFE_METHODS:
+            return None
+        return parse_fieldset(value)
+
+    def get_sideloaded_users(self):
+        """The users map of this response, or None when not normalizing"""
+        if self.request.method not in SAFE_METHODS:
+            return None
+        if self.request.query_params.get(self.normalize_query_param) not in ('1', 'true'):
+            return None
+        if not hasattr(self, '_sideloaded_users'):
+            self._sideloaded_users = {}
+        return self._sideloaded_users
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        users = self.get_sideloaded_users()
+        if users is not None:
+            context['users'] = users
+        return context
+
+    def get_serializer(self, *args, **kwargs):
+        fieldset = self.get_fieldset()
+        if fieldset is not None:
+            kwargs.setdefault('fields', fieldset)
+        return super().get_serializer(*args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        users = getattr(self, '_sideloaded_users', None)
+        if users is not None and isinstance(response, Response) and response.status_code == 200:
+            if isinstance(response.data, list):
+                response.data = {'results': response.data, 'users': users}
+            elif isinstance(response.data, dict):
+                response.data['users'] = users
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,146 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import firebase_admin
+import requests
+from firebase_admin import auth
+from google.auth import jwt
+
+ID_TOKEN_CERT_URI = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+ID_TOKEN_ISSUER_PREFIX = 'https://securetoken.google.com/'
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire at a given time"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                return default
+            if expires_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CertificateCache:
+    """
+    Google's token signing certificates, kept in memory.
+
+    The first call fetches synchronously. After that, certificates are
+    refreshed in a background thread once they are within refresh_margin
+    seconds of their Cache-Control expiry, so verification never waits on
+    the network. refresh_now() handles key rotation when a token is signed
+    with a key id we have not seen yet.
+    """
+
+    def __init__(self, url=ID_TOKEN_CERT_URI, refresh_margin=300, min_refresh_interval=30, timeout=10):
+        self.url = url
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._certs = None
+        self._expires_at = 0
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        if self._certs is None:
+            return self.refresh_now()
+        if time.time() > self._expires_at - self.refresh_margin:
+            self._refresh_in_background()
+        return self._certs
+
+    def refresh_now(self):
+        with self._lock:
+            if self._certs is None or time.time() - self._fetched_at >= self.min_refresh_interval:
+                self._store(*self.fetch())
+            return self._certs
+
+    def fetch(self):
+        """Return (certificates, max_age_seconds) from the certificate endpoint"""
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        return response.json(), int(match.group(1)) if match else 3600
+
+    def _store(self, certs, max_age):
+        now = time.time()
+        self._certs, self._fetched_at, self._expires_at = certs, now, now + max_age
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            certs, max_age = self.fetch()
+            with self._lock:
+                self._store(certs, max_age)
+        except Exception:
+            # Keep serving the current certificates; the next request retries
+            pass
+        finally:
+            self._refreshing = False
+
+
+certificate_cache = CertificateCache()
+
+
+def verify_id_token(token):
+    """
+    Verify a Firebase ID token against the locally cached signing certificates.
+
+    Falls back to firebase_admin when the project id is unknown or the Auth
+    emulator is in use, since neither case uses Google's certificates.
+    """
+    project_id = firebase_admin.get_app().project_id
+    if not project_id or os.environ.get('FIREBASE_AUTH_EMULATOR_HOST'):
+        return auth.verify_id_token(token)
+
+    try:
+        claims = jwt.decode(token, certs=certificate_cache.get(), audience=project_id)
+    except ValueError as exc:
+        if 'Certificate for key id' not in str(exc):
+            raise
+        claims = jwt.decode(token, certs=certificate_cache.refresh_now(), audience=project_id)
+
+    if claims.get('iss') != ID_TOKEN_ISSUER_PREFIX + project_id:
+        raise ValueError('Firebase ID token has an incorrect "iss" claim.')
+    if not isinstance(claims.get('sub'), str) or not 0 < len(claims['sub']) <= 128:
+        raise ValueError('Firebase ID token has an invalid "sub" claim.')
+    claims['uid'] = claims['sub']
+    return claims
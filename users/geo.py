@@ -0,0 +1,145 @@
+"""
+Geohash cells, great-circle distances and an offline gazetteer.
+
+A geohash interleaves longitude and latitude bits into base32, so points in
+one cell share a prefix and a cell is a contiguous range of an indexed
+column. nearby_cells() picks the finest precision whose cells are at least
+radius wide at the given latitude; the cell around the centre plus its eight
+neighbours then cover every point within radius.
+"""
+
+import csv
+import math
+import re
+from functools import lru_cache
+from pathlib import Path
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Sorts after every BASE32 character, so [prefix, prefix + END) holds a cell
+END = '{'
+MAX_PRECISION = 12
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320
+GAZETTEER_PATH = Path(__file__).resolve().parent / 'data' / 'gazetteer.csv'
+
+
+def encode(latitude, longitude, precision=MAX_PRECISION):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def encode_point(latitude, longitude):
+    """Full precision geohash of a point, or '' when either coordinate is missing"""
+    if latitude is None or longitude is None:
+        return ''
+    return encode(latitude, longitude)
+
+
+def cell_size(precision):
+    """(latitude, longitude) extent of a cell in degrees"""
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def precision_for_radius(latitude, radius_km):
+    # Cells narrow towards the poles, so size them at the circle's poleward edge
+    edge = min(abs(latitude) + radius_km / KM_PER_DEGREE_LAT, 90.0)
+    lng_scale = max(math.cos(math.radians(edge)), 0.01)
+    for precision in range(MAX_PRECISION, 0, -1):
+        lat_size, lng_size = cell_size(precision)
+        if lat_size * KM_PER_DEGREE_LAT >= radius_km and lng_size * KM_PER_DEGREE_LNG * lng_scale >= radius_km:
+            return precision
+    return 1
+
+
+def neighbors(latitude, longitude, precision):
+    """Geohashes of the cell containing the point and of the cells around it"""
+    lat_size, lng_size = cell_size(precision)
+    cells = set()
+    for dlat in (-lat_size, 0, lat_size):
+        lat = latitude + dlat
+        if not -90 <= lat <= 90:
+            continue
+        for dlng in (-lng_size, 0, lng_size):
+            lng = (longitude + dlng + 180) % 360 - 180
+            cells.add(encode(lat, lng, precision))
+    return sorted(cells)
+
+
+def nearby_cells(latitude, longitude, radius_km):
+    return neighbors(latitude, longitude, precision_for_radius(latitude, radius_km))
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    (min_lat, max_lat, min_lng, max_lng) around the circle. The longitude
+    bounds are None when the box reaches a pole or crosses the antimeridian.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    min_lat, max_lat = latitude - dlat, latitude + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), min(max_lat, 90.0), None, None
+    dlng = radius_km / (KM_PER_DEGREE_LNG * math.cos(math.radians(latitude)))
+    min_lng, max_lng = longitude - dlng, longitude + dlng
+    if min_lng < -180 or max_lng > 180:
+        return min_lat, max_lat, None, None
+    return min_lat, max_lat, min_lng, max_lng
+
+
+def normalize_place(name):
+    name = re.sub(r'\s+', ' ', name.casefold()).strip()
+    return re.sub(r' (city|county|district)$', '', name)
+
+
+@lru_cache(maxsize=1)
+def load_gazetteer():
+    """Map normalized place names (and aliases) to (latitude, longitude)"""
+    places = {}
+    with open(GAZETTEER_PATH, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            point = (float(row['latitude']), float(row['longitude']))
+            for name in [row['name'], *filter(None, row['aliases'].split('|'))]:
+                places.setdefault(normalize_place(name), point)
+    return places
+
+
+def geocode(location):
+    """(latitude, longitude) of a free-text location, or None if the gazetteer does not know it"""
+    if not location:
+        return None
+    places = load_gazetteer()
+    name = normalize_place(location)
+    if name in places:
+        return places[name]
+    # "Da'an, Taipei" or "Taipei (Xinyi)": try each part in turn
+    for part in re.split(r'[,/()]', name):
+        part = normalize_place(part)
+        if part in places:
+            return places[part]
+    return None
@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from . import caching
+from .models import Product, ProductLike, ProductLikeDelta
+
+
+def is_buffered():
+    return settings.LIKE_COUNTER_MODE == 'buffered'
+
+
+def apply_delta(product_id, delta):
+    """
+    Change a product's likes_count by delta without a read-modify-write.
+
+    In "direct" mode this is a single UPDATE ... SET likes_count = likes_count + delta,
+    which leaves updated_at alone. In "buffered" mode the delta is appended to
+    ProductLikeDelta and folded in later by flush_deltas(), so concurrent taps
+    on a viral listing never contend for the Product row.
+    """
+    if not delta:
+        return
+    if is_buffered():
+        ProductLikeDelta.objects.create(product_id=product_id, delta=delta)
+    else:
+        Product.objects.filter(pk=product_id).update(
+            likes_count=Greatest(F('likes_count') + delta, Value(0))
+        )
+
+
+def toggle(user, product_id):
+    """Like or unlike product_id for user and adjust its count; return whether it is now liked"""
+    with transaction.atomic():
+        deleted, _ = ProductLike.objects.filter(user=user, product_id=product_id).delete()
+        if deleted:
+            liked, delta = False, -1
+        else:
+            try:
+                with transaction.atomic():
+                    ProductLike.objects.create(user=user, product_id=product_id)
+                liked, delta = True, 1
+            except IntegrityError:
+                # A concurrent request from the same user already liked it
+                liked, delta = True, 0
+        apply_delta(product_id, delta)
+    return liked
+
+
+def current_count(product_id):
+    return current_counts([product_id]).get(product_id, 0)
+
+
+def current_counts(product_ids):
+    """Map each existing product id to its likes_count, including pending deltas"""
+    counts = dict(Product.objects.filter(pk__in=product_ids).values_list('id', 'likes_count'))
+    if is_buffered():
+        pending = (
+            ProductLikeDelta.objects.filter(product_id__in=product_ids)
+            .values('product').annotate(total=Sum('delta')).order_by()
+        )
+        for row in pending:
+            if row['product'] in counts:
+                counts[row['product']] = max(0, counts[row['product']] + row['total'])
+    return counts
+
+
+def flush_deltas(batch_size=10000):
+    """Fold up to batch_size pending deltas into likes_count; return the rows flushed"""
+    with transaction.atomic():
+        last_id = (
+            ProductLikeDelta.objects.order_by('id')
+            .values_list('id', flat=True)[batch_size - 1:batch_size].first()
+        )
+        if last_id is None:
+            last_id = ProductLikeDelta.objects.order_by('-id').values_list('id', flat=True).first()
+        if last_id is None:
+            return 0
+        pending = ProductLikeDelta.objects.filter(id__lte=last_id)
+        totals = list(pending.values('product').annotate(total=Sum('delta')).order_by())
+        for row in totals:
+            if row['total']:
+                Product.objects.filter(pk=row['product']).update(
+                    likes_count=Greatest(F('likes_count') + row['total'], Value(0))
+                )
+        deleted, _ = pending.delete()
+        product_ids = [row['product'] for row in totals]
+        transaction.on_commit(lambda: caching.forget_product_representations(product_ids))
+    return deleted
+
+
+def reconcile_counts():
+    """Recompute every likes_count from ProductLike; return the rows corrected"""
+    actual = Coalesce(Subquery(
+        ProductLike.objects.filter(product=OuterRef('pk'))
+        .order_by().values('product').annotate(count=Count('id')).values('count')
+    ), 0)
+    with transaction.atomic():
+        ProductLikeDelta.objects.all().delete()
+        product_ids = list(
+            Product.objects.annotate(actual=actual).exclude(likes_count=F('actual'))
+            .values_list('id', flat=True)
+        )
+        for start in range(0, len(product_ids), 500):
+            Product.objects.filter(id__in=product_ids[start:start + 500]).update(likes_count=actual)
+        transaction.on_commit(lambda: caching.forget_product_representations(product_ids))
+    return len(product_ids)
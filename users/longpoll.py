@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+
+_condition = threading.Condition()
+_versions = {}
+_waiters = {}
+# Async waiters per room: (event loop, asyncio.Event) pairs woken thread-safely
+_async_waiters = {}
+
+
+def notify_new_message(chat_room_id):
+    """Wake requests in this process that are long-polling chat_room_id"""
+    with _condition:
+        if chat_room_id in _waiters:
+            _versions[chat_room_id] += 1
+            _condition.notify_all()
+        waiters = list(_async_waiters.get(chat_room_id, ()))
+    for loop, event in waiters:
+        loop.call_soon_threadsafe(event.set)
+
+
+def wait_for_messages(chat_room_id, has_new_messages, timeout, poll_interval=1.0):
+    """
+    Block until has_new_messages() returns True or timeout seconds pass.
+
+    Messages saved by this process wake the waiter immediately. Messages saved
+    by other workers are picked up by re-checking has_new_messages() every
+    poll_interval seconds.
+    """
+    deadline = time.monotonic() + timeout
+    with _condition:
+        _waiters[chat_room_id] = _waiters.get(chat_room_id, 0) + 1
+        _versions.setdefault(chat_room_id, 0)
+    try:
+        while True:
+            with _condition:
+                version = _versions[chat_room_id]
+            if has_new_messages():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with _condition:
+                _condition.wait_for(
+                    lambda: _versions[chat_room_id] != version,
+                    timeout=min(poll_interval, remaining),
+                )
+    finally:
+        with _condition:
+            _waiters[chat_room_id] -= 1
+            if not _waiters[chat_room_id]:
+                del _waiters[chat_room_id]
+                del _versions[chat_room_id]
+
+
+async def await_messages(chat_room_id, has_new_messages, timeout, poll_interval=1.0):
+    """
+    wait_for_messages() for async views: has_new_messages is a coroutine
+    function, and waiting suspends the request instead of holding a thread.
+    """
+    deadline = time.monotonic() + timeout
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _condition:
+        _async_waiters.setdefault(chat_room_id, set()).add(waiter)
+    try:
+        while True:
+            # Clear before checking so a notification racing the check is not lost
+            waiter[1].clear()
+            if await has_new_messages():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(waiter[1].wait(), timeout=min(poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with _condition:
+            _async_waiters[chat_room_id].discard(waiter)
+            if not _async_waiters[chat_room_id]:
+                del _async_waiters[chat_room_id]
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move chat messages older than MESSAGE_ARCHIVE_AFTER_DAYS into compressed per-room '
+        'archive segments, keeping each room\'s newest message'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--segment-size', type=int, default=settings.MESSAGE_ARCHIVE_SEGMENT_SIZE)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        moved = archive.archive(cutoff, options['segment_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} messages.'))
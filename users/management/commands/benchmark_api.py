@@ -0,0 +1,199 @@
+import json
+import platform
+import statistics
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from users import urls
+from users.models import ChatRoom, Product, User
+
+# Ids sent per request to the /batch/ routes
+BATCH_SIZE = 20
+
+
+def percentile(samples, pct):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive every route in users/urls.py through the test client and report '
+        'latency percentiles, queries per request and bytes per response. '
+        'Writes run in a transaction that is rolled back, so they leave the '
+        'database as it was and on_commit work is not measured'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Username to benchmark as (default: the user with most chats)')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--output', help='Write results as JSON to this path')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['user'])
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        cases = self.get_cases(user)
+        results = {}
+        for pattern in urls.urlpatterns:
+            if not isinstance(pattern, URLPattern) or not pattern.name:
+                continue
+            case = cases.get(pattern.name)
+            if case is None:
+                self.stdout.write(f'{pattern.name:<24} skipped (no sample data)')
+                continue
+            method, kwargs, data = case
+            run = self.run_case if method == 'get' else self.run_write_case
+            results[pattern.name] = run(
+                client, method, reverse(pattern.name, kwargs=kwargs), data,
+                options['iterations'], options['warmup'],
+            )
+            self.report(pattern.name, results[pattern.name])
+
+        output = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'user': user.username,
+                'iterations': options['iterations'],
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'products': Product.objects.count(),
+            },
+            'routes': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(output, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        if options['baseline']:
+            self.compare(results, options['baseline'])
+
+    def get_user(self, username):
+        if username:
+            try:
+                return User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise CommandError(f'User "{username}" does not exist.')
+        user = (
+            User.objects.filter(chat_rooms__isnull=False)
+            .annotate(rooms=Count('chat_rooms'))
+            .order_by('-rooms').first()
+        ) or User.objects.first()
+        if user is None:
+            raise CommandError('No users found. Run generate_fake_data first.')
+        return user
+
+    def get_cases(self, user):
+        """Map URL names to (method, url kwargs, data); GET data becomes the query string"""
+        cases = {
+            'item-list': ('get', {}, None),
+            'user-profile': ('get', {}, None),
+            'my-products': ('get', {}, None),
+            'all-products': ('get', {}, None),
+            'feed': ('get', {}, None),
+            'product-changes': ('get', {}, {'page_size': 100}),
+            'my-chats': ('get', {}, None),
+            'nearby-products': ('get', {}, {'lat': 25.033, 'lng': 121.5654, 'radius': 10}),
+            'async-all-products': ('get', {}, None),
+            'async-my-chats': ('get', {}, None),
+        }
+        own_products = list(Product.objects.filter(owner=user).values('id', 'title')[:BATCH_SIZE])
+        if own_products:
+            own_product = own_products[0]
+            cases['product-detail'] = ('get', {'pk': own_product['id']}, None)
+            cases['product-matches'] = ('get', {'product_id': own_product['id']}, None)
+            cases['batch-my-products'] = ('post', {}, {'update': own_products})
+        product_ids = list(Product.objects.values_list('id', flat=True)[:BATCH_SIZE])
+        if product_ids:
+            cases['product-batch'] = ('get', {}, {'ids': ','.join(map(str, product_ids))})
+        other_products = list(Product.objects.exclude(owner=user).filter(status='available')[:BATCH_SIZE])
+        if other_products:
+            other_product = other_products[0]
+            cases['batch-toggle-likes'] = ('post', {}, {'product_ids': [product.id for product in other_products]})
+            cases['toggle-product-like'] = ('post', {'product_id': other_product.id}, None)
+            cases['async-toggle-product-like'] = ('post', {'product_id': other_product.id}, None)
+            cases['create-chat-room'] = ('post', {}, {'product_id': other_product.id})
+            cases['product-search'] = ('get', {}, {'q': other_product.title.split()[0]})
+        room_ids = list(ChatRoom.objects.filter(participants=user).values_list('id', flat=True)[:BATCH_SIZE])
+        if room_ids:
+            cases['batch-mark-read'] = ('post', {}, {'chat_room_ids': room_ids})
+            room_id = room_ids[0]
+            cases['chat-room-detail'] = ('get', {'pk': room_id}, None)
+            cases['chat-messages'] = ('get', {'chat_room_id': room_id}, None)
+            cases['async-chat-messages'] = ('get', {'chat_room_id': room_id}, None)
+            cases['mark-messages-read'] = ('post', {'chat_room_id': room_id}, None)
+        return cases
+
+    def run_case(self, client, method, url, data, iterations, warmup):
+        send = getattr(client, method)
+        for _ in range(warmup):
+            send(url, data, **self.request_options(method))
+
+        latencies, queries, sizes, statuses = [], [], [], set()
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = send(url, data, **self.request_options(method))
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+                latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(len(captured))
+            sizes.append(len(content))
+            statuses.add(response.status_code)
+
+        return {
+            'method': method.upper(),
+            'url': url,
+            'status': sorted(statuses),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.fmean(latencies), 3),
+            'queries': max(queries),
+            'bytes': max(sizes),
+        }
+
+    def run_write_case(self, *args):
+        """run_case() inside a transaction that is rolled back afterwards"""
+        with transaction.atomic():
+            result = self.run_case(*args)
+            transaction.set_rollback(True)
+        return result
+
+    @staticmethod
+    def request_options(method):
+        return {} if method == 'get' else {'format': 'json'}
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<24} p50 {result['p50_ms']:>8.2f}ms  p95 {result['p95_ms']:>8.2f}ms  "
+            f"p99 {result['p99_ms']:>8.2f}ms  {result['queries']:>4} queries  {result['bytes']:>9} bytes"
+        )
+
+    def compare(self, results, path):
+        with open(path) as f:
+            baseline = json.load(f)['routes']
+        self.stdout.write('\nChange against baseline:')
+        for name, result in results.items():
+            before = baseline.get(name)
+            if not before:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'queries', 'bytes'):
+                if before[key]:
+                    changes.append(f'{key} {(result[key] - before[key]) / before[key]:+.0%}')
+            self.stdout.write(f"{name:<24} {'  '.join(changes)}")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        'Rank personalized feeds from like co-occurrence and category affinity '
+        'into FeedRecommendation (requires NumPy and SciPy)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only re-rank users whose likes changed since their feed was built',
+        )
+        parser.add_argument('--top-k', type=int, default=recommendations.TOP_K)
+        parser.add_argument('--category-weight', type=float, default=recommendations.CATEGORY_WEIGHT)
+        parser.add_argument(
+            '--active-days', type=int, default=recommendations.ACTIVE_DAYS,
+            help='A full build ranks users who liked something within this many days',
+        )
+
+    def handle(self, *args, **options):
+        if not recommendations.is_available():
+            raise CommandError('Building recommendations requires NumPy and SciPy.')
+        count = recommendations.build(
+            incremental=options['incremental'], top_k=options['top_k'],
+            category_weight=options['category_weight'], active_days=options['active_days'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Ranked feeds for {count} users.'))
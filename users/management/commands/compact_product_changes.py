@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users import changes
+
+
+class Command(BaseCommand):
+    help = (
+        'Drop superseded entries from the product change log, and tombstones older '
+        'than PRODUCT_CHANGES_RETENTION_DAYS'
+    )
+
+    def handle(self, *args, **options):
+        deleted = changes.compact()
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {deleted} change log entries '
+            f'(retention {settings.PRODUCT_CHANGES_RETENTION_DAYS} days).'
+        ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from users import likes
+
+
+class Command(BaseCommand):
+    help = 'Apply buffered like count deltas to Product.likes_count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            flushed = likes.flush_deltas(batch_size=options['batch_size'])
+            if not flushed:
+                break
+            total += flushed
+        self.stdout.write(self.style.SUCCESS(f'Flushed {total} like deltas.'))
@@ -0,0 +1,241 @@
+import random
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from users import changes, geo, likes, matching, search
+from users.models import ChatReadState, ChatRoom, Message, Product, ProductLike, User
+
+CATEGORY_WEIGHTS = {
+    'electronics': 30, 'fashion': 25, 'home': 15, 'books': 12,
+    'sports': 8, 'toys': 6, 'others': 4,
+}
+LOCATIONS = ['Taipei', 'New Taipei', 'Taoyuan', 'Taichung', 'Tainan', 'Kaohsiung', 'Hsinchu', 'Keelung']
+NOUNS = {
+    'electronics': ['phone', 'camera', 'headphones', 'laptop', 'speaker', 'console', 'tablet'],
+    'fashion': ['jacket', 'sneakers', 'dress', 'handbag', 'watch', 'scarf', 'jeans'],
+    'home': ['lamp', 'chair', 'rug', 'kettle', 'mirror', 'plant', 'blender'],
+    'books': ['novel', 'cookbook', 'comic', 'textbook', 'atlas', 'poetry', 'biography'],
+    'sports': ['bike', 'racket', 'tent', 'skateboard', 'yoga mat', 'dumbbells', 'helmet'],
+    'toys': ['lego', 'puzzle', 'doll', 'drone', 'board game', 'robot', 'kite'],
+    'others': ['guitar', 'stamps', 'vinyl', 'sewing kit', 'telescope', 'easel', 'ukulele'],
+}
+ADJECTIVES = ['vintage', 'used', 'like new', 'retro', 'compact', 'handmade', 'classic', 'portable']
+ALL_NOUNS = [noun for nouns in NOUNS.values() for noun in nouns]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Generate realistic fake users, products, likes, chat rooms and messages for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--likes', type=int, default=50000)
+        parser.add_argument('--rooms', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--prefix', default='fake', help='Username prefix for generated users')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        users = self.create_users(options['users'], options['prefix'])
+        products = self.create_products(users, options['products'])
+        self.create_likes(users, [product_id for product_id, _ in products], options['likes'])
+        rooms = self.create_rooms(products, users, options['rooms'])
+        self.create_messages(rooms, options['messages'])
+
+        self.stdout.write('Rebuilding derived data...')
+        search.rebuild_index()
+        matching.rebuild_index()
+        likes.reconcile_counts()
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def zipf_weights(self, count, exponent=1.1):
+        """Heavy-tailed weights: a few items get most of the activity"""
+        weights = [1 / (rank ** exponent) for rank in range(1, count + 1)]
+        self.random.shuffle(weights)
+        return weights
+
+    def random_point(self, location):
+        """A point within a few kilometres of the gazetteer entry for location"""
+        latitude, longitude = geo.geocode(location)
+        return latitude + self.random.uniform(-0.05, 0.05), longitude + self.random.uniform(-0.05, 0.05)
+
+    def create_users(self, count, prefix):
+        start = User.objects.filter(username__startswith=f'{prefix}_').count()
+        password = make_password(None)
+
+        def rows():
+            for i in range(start, start + count):
+                location = self.random.choice(LOCATIONS)
+                latitude, longitude = self.random_point(location)
+                yield User(
+                    username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com', password=password,
+                    location=location, latitude=latitude, longitude=longitude,
+                )
+
+        for batch in batched(rows(), self.batch_size):
+            User.objects.bulk_create(batch)
+        users = list(
+            User.objects.filter(username__startswith=f'{prefix}_').values_list('id', flat=True)
+        )
+        self.stdout.write(f'Users: {count} created')
+        return users
+
+    def create_products(self, users, count):
+        if not users:
+            return []
+        categories, category_weights = zip(*CATEGORY_WEIGHTS.items())
+        owner_weights = self.zipf_weights(len(users), exponent=0.8)
+
+        def rows():
+            owners = self.random.choices(users, weights=owner_weights, k=count)
+            for owner_id, category in zip(owners, self.random.choices(categories, category_weights, k=count)):
+                noun = self.random.choice(NOUNS[category])
+                location = self.random.choice(LOCATIONS)
+                latitude, longitude = self.random_point(location)
+                yield Product(
+                    owner_id=owner_id,
+                    title=f'{self.random.choice(ADJECTIVES)} {noun}'.capitalize(),
+                    description=f'Swapping my {noun}. ' * self.random.randint(1, 5),
+                    category=category,
+                    image=f'https://picsum.photos/seed/{self.random.getrandbits(32)}/400',
+                    wanted_items=', '.join(self.random.sample(ALL_NOUNS, self.random.randint(1, 4))),
+                    location=location,
+                    latitude=latitude,
+                    longitude=longitude,
+                    # bulk_create skips Product.save(), which derives the geohash
+                    geohash=geo.encode_point(latitude, longitude),
+                    status=self.random.choices(['available', 'pending', 'exchanged'], [85, 5, 10])[0],
+                    can_sell=self.random.random() < 0.3,
+                )
+
+        created = []
+        for batch in batched(rows(), self.batch_size):
+            with transaction.atomic():
+                products = Product.objects.bulk_create(batch)
+                # bulk_create sends no post_save, so log the products for delta sync here
+                changes.record([product.id for product in products])
+                created += [(product.id, product.owner_id) for product in products]
+        self.stdout.write(f'Products: {count} created')
+        return created
+
+    def create_likes(self, users, products, count):
+        if not users or not products:
+            return
+        product_weights = self.zipf_weights(len(products))
+        # Oversample because duplicate (user, product) pairs are dropped
+        draws = zip(
+            self.random.choices(users, k=count * 2),
+            self.random.choices(products, weights=product_weights, k=count * 2),
+        )
+        pairs = list(islice(dict.fromkeys(draws), count))
+        rows = (ProductLike(user_id=user_id, product_id=product_id) for user_id, product_id in pairs)
+        for batch in batched(rows, self.batch_size):
+            ProductLike.objects.bulk_create(batch, ignore_conflicts=True)
+        self.stdout.write(f'Likes: {len(pairs)} created')
+
+    def create_rooms(self, products, users, count):
+        if not products or len(users) < 2:
+            return []
+        owners = dict(products)
+        products = list(owners)
+        Participant = ChatRoom.participants.through
+        rooms, seen = [], set(
+            ChatRoom.objects.filter(user_low__isnull=False).values_list('product', 'user_low', 'user_high')
+        )
+        for batch in batched(range(count), self.batch_size):
+            conversations = []
+            for product_id in self.random.choices(products, k=len(batch)):
+                buyer = self.random.choice(users)
+                while buyer == owners[product_id]:
+                    buyer = self.random.choice(users)
+                # One room per conversation, as ChatRoom's unique key requires
+                key = (product_id, *sorted((owners[product_id], buyer)))
+                if key not in seen:
+                    seen.add(key)
+                    conversations.append(key)
+            with transaction.atomic():
+                created = ChatRoom.objects.bulk_create(
+                    ChatRoom(product_id=product_id, user_low_id=user_low, user_high_id=user_high)
+                    for product_id, user_low, user_high in conversations
+                )
+                participants = []
+                for room, (product_id, user_low, user_high) in zip(created, conversations):
+                    participants += [
+                        Participant(chatroom_id=room.id, user_id=user_low),
+                        Participant(chatroom_id=room.id, user_id=user_high),
+                    ]
+                    buyer = user_high if user_low == owners[product_id] else user_low
+                    rooms.append((room.id, owners[product_id], buyer))
+                Participant.objects.bulk_create(participants, ignore_conflicts=True)
+                ChatReadState.objects.bulk_create(
+                    [ChatReadState(chat_room_id=row.chatroom_id, user_id=row.user_id) for row in participants],
+                    ignore_conflicts=True,
+                )
+        self.stdout.write(f'Chat rooms: {len(rooms)} created')
+        return rooms
+
+    def create_messages(self, rooms, count):
+        if not rooms:
+            return
+        room_weights = self.zipf_weights(len(rooms), exponent=0.9)
+
+        def rows():
+            for room_id, seller, buyer in self.random.choices(rooms, weights=room_weights, k=count):
+                yield Message(
+                    chat_room_id=room_id,
+                    sender_id=self.random.choice((seller, buyer)),
+                    content=self.random.choice([
+                        'Is this still available?', 'Would you swap for my bike?',
+                        'Sure, when can we meet?', 'Can you send more photos?', 'Deal!',
+                    ]),
+                )
+
+        for batch in batched(rows(), self.batch_size):
+            Message.objects.bulk_create(batch)
+        for batch in batched((room_id for room_id, _, _ in rooms), self.batch_size):
+            self.update_read_states(batch)
+        self.stdout.write(f'Messages: {count} created')
+
+    def update_read_states(self, room_ids):
+        """
+        Fill the activity fields of the given rooms, all created by this run,
+        and leave each participant read up to their own last message
+        """
+        def count_messages(**filters):
+            return Coalesce(Subquery(
+                Message.objects.filter(**filters).order_by().values('chat_room')
+                .annotate(count=Count('id')).values('count')
+            ), 0)
+
+        latest = Message.objects.filter(chat_room=OuterRef('pk')).order_by('-id')
+        ChatRoom.objects.filter(pk__in=room_ids).update(
+            message_count=count_messages(chat_room=OuterRef('pk')),
+            last_message_id=Subquery(latest.values('id')[:1]),
+            last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+        )
+        read_states = ChatReadState.objects.filter(chat_room_id__in=room_ids)
+        read_states.update(last_activity_at=Subquery(
+            ChatRoom.objects.filter(pk=OuterRef('chat_room')).values('last_activity_at')
+        ))
+        read_states.update(last_read_message_id=Coalesce(Subquery(
+            Message.objects.filter(chat_room=OuterRef('chat_room'), sender=OuterRef('user'))
+            .order_by('-id').values('id')[:1]
+        ), 0))
+        read_states.update(read_count=count_messages(
+            chat_room=OuterRef('chat_room'), id__lte=OuterRef('last_read_message_id'),
+        ))
@@ -0,0 +1,69 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from users import caching, changes, geo
+from users.models import Product, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill in product and user coordinates by looking their location text up '
+        'in the bundled offline gazetteer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--overwrite', action='store_true', help='Also geocode rows that already have coordinates'
+        )
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        for model in (User, Product):
+            queryset = model.objects.exclude(location__isnull=True).exclude(location='')
+            if not options['overwrite']:
+                queryset = queryset.filter(latitude__isnull=True)
+            matched, unmatched = self.geocode(model, queryset, options['batch_size'])
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural.capitalize()}: {matched} geocoded, '
+                f'{sum(unmatched.values())} unmatched'
+            )
+            for location, count in unmatched.most_common(10):
+                self.stdout.write(f'  {count:>6}  {location}')
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def geocode(self, model, queryset, batch_size):
+        """Walk queryset in id order, so rows updated along the way are never revisited"""
+        fields = ['latitude', 'longitude'] + (['geohash'] if model is Product else [])
+        loaded = ['id', 'location'] + (['owner'] if model is Product else [])
+        matched, unmatched, last_id = 0, Counter(), 0
+        while batch := list(queryset.filter(id__gt=last_id).order_by('id').only(*loaded)[:batch_size]):
+            last_id = batch[-1].id
+            located = []
+            for obj in batch:
+                point = geo.geocode(obj.location)
+                if point is None:
+                    unmatched[obj.location] += 1
+                    continue
+                obj.latitude, obj.longitude = point
+                if model is Product:
+                    obj.geohash = geo.encode_point(*point)
+                located.append(obj)
+            if not located:
+                continue
+            with transaction.atomic():
+                # bulk_update skips the signals, so log the changes and invalidate cached representations here
+                model.objects.bulk_update(located, fields)
+                if model is Product:
+                    product_ids, owner_ids = [obj.id for obj in located], [obj.owner_id for obj in located]
+                else:
+                    product_ids = list(Product.objects.filter(owner__in=located).values_list('id', flat=True))
+                    owner_ids = [obj.id for obj in located]
+                changes.record(product_ids)
+                transaction.on_commit(
+                    lambda product_ids=product_ids, owner_ids=owner_ids:
+                    caching.invalidate_products(product_ids, owner_ids)
+                )
+            matched += len(located)
+        return matched, unmatched
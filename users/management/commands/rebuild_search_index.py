@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from users import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index from the products table'
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            raise CommandError('The product search index requires SQLite FTS5.')
+        with transaction.atomic():
+            count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from users import likes
+
+
+class Command(BaseCommand):
+    help = 'Recompute Product.likes_count from ProductLike rows to repair drift'
+
+    def handle(self, *args, **options):
+        fixed = likes.reconcile_counts()
+        self.stdout.write(self.style.SUCCESS(f'Corrected likes_count on {fixed} products.'))
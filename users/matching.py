@@ -0,0 +1,166 @@
+import re
+from collections import defaultdict
+
+from django.db.models import Count, Q
+
+from .models import Product, ProductTerm
+
+STOPWORDS = {'a', 'an', 'and', 'any', 'for', 'in', 'of', 'or', 'the', 'with', 'used', 'new'}
+MAX_TERM_LENGTH = 64
+# Broad terms ("electronic") post most of the catalogue; matching reads only
+# the newest products of each, so its cost does not grow with the catalogue
+POSTINGS_PER_TERM = 1000
+
+
+def normalize_term(word):
+    """Lowercase and crudely singularize a word so "Books" matches "book" """
+    word = word.lower()
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    return word[:MAX_TERM_LENGTH]
+
+
+def tokenize(text):
+    return {
+        normalize_term(word) for word in re.findall(r'\w+', text or '')
+        if word.lower() not in STOPWORDS
+    }
+
+
+def offered_terms(title, category):
+    return tokenize(title) | {normalize_term(category)}
+
+
+def wanted_terms(wanted_items):
+    return tokenize(wanted_items.replace(',', ' '))
+
+
+def term_rows(product):
+    if product.status != 'available':
+        return []
+    rows = [
+        ProductTerm(product=product, kind=ProductTerm.OFFERED, term=term)
+        for term in offered_terms(product.title, product.category)
+    ]
+    rows += [
+        ProductTerm(product=product, kind=ProductTerm.WANTED, term=term)
+        for term in wanted_terms(product.wanted_items)
+    ]
+    return rows
+
+
+def index_products(products):
+    """Replace the index rows of products; unavailable products are dropped"""
+    ProductTerm.objects.filter(product__in=[product.id for product in products]).delete()
+    ProductTerm.objects.bulk_create(
+        [row for product in products for row in term_rows(product)], ignore_conflicts=True
+    )
+
+
+def rebuild_index(batch_size=2000):
+    ProductTerm.objects.all().delete()
+    count = 0
+    products = Product.objects.filter(status='available').only(
+        'id', 'title', 'category', 'wanted_items', 'status'
+    )
+    batch = []
+    for product in products.iterator(chunk_size=batch_size):
+        batch += term_rows(product)
+        count += 1
+        if len(batch) >= batch_size:
+            ProductTerm.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ProductTerm.objects.bulk_create(batch, ignore_conflicts=True)
+    return count
+
+
+def postings(kind, terms):
+    """Index rows of kind for terms, at most the newest POSTINGS_PER_TERM products per term"""
+    condition = Q()
+    for term in terms:
+        newest = (
+            ProductTerm.objects.filter(kind=kind, term=term)
+            .order_by('-product_id').values('id')[:POSTINGS_PER_TERM]
+        )
+        condition |= Q(id__in=newest)
+    return ProductTerm.objects.filter(condition)
+
+
+def find_direct_matches(product, limit=20):
+    """
+    Products whose owners want something product offers and offer something
+    product's owner wants, best overlap first.
+
+    Returns a list of (product_id, score) pairs.
+    """
+    wanted = wanted_terms(product.wanted_items)
+    offered = offered_terms(product.title, product.category)
+    if not wanted or not offered:
+        return []
+    rows = (
+        postings(ProductTerm.OFFERED, wanted)
+        .exclude(product__owner_id=product.owner_id)
+        .filter(product__terms__kind=ProductTerm.WANTED, product__terms__term__in=offered)
+        .values('product')
+        .annotate(
+            gets=Count('term', distinct=True),
+            gives=Count('product__terms__term', distinct=True),
+        )
+        .order_by('-gets', '-gives', 'product')[:limit]
+    )
+    return [(row['product'], row['gets'] + row['gives']) for row in rows]
+
+
+def _candidates(kind, terms, exclude_owner_id, limit):
+    """Available products with index rows of kind matching terms, best overlap first"""
+    if not terms:
+        return {}
+    rows = (
+        postings(kind, terms)
+        .exclude(product__owner_id=exclude_owner_id)
+        .values('product', 'product__owner')
+        .annotate(score=Count('term'))
+        .order_by('-score', 'product')[:limit]
+    )
+    return {row['product']: (row['product__owner'], row['score']) for row in rows}
+
+
+def _terms_by_product(kind, product_ids):
+    terms = defaultdict(set)
+    rows = ProductTerm.objects.filter(kind=kind, product__in=product_ids).values_list('product', 'term')
+    for product_id, term in rows:
+        terms[product_id].add(term)
+    return terms
+
+
+def find_trade_cycles(product, limit=10, fanout=200):
+    """
+    Three-way swaps A -> B -> C -> A, where "X -> Y" means X's owner wants Y.
+
+    The search is bounded: at most fanout candidates are expanded on each
+    side of product, so the cost does not grow with the catalogue. Returns a
+    list of ((b_id, c_id), score) pairs.
+    """
+    # B: products A's owner wants. C: products whose owners want A.
+    wants = _candidates(
+        ProductTerm.OFFERED, wanted_terms(product.wanted_items), product.owner_id, fanout
+    )
+    wanted_by = _candidates(
+        ProductTerm.WANTED, offered_terms(product.title, product.category), product.owner_id, fanout
+    )
+    if not wants or not wanted_by:
+        return []
+
+    b_wants = _terms_by_product(ProductTerm.WANTED, list(wants))
+    c_offers = _terms_by_product(ProductTerm.OFFERED, list(wanted_by))
+
+    cycles = []
+    for b_id, (b_owner, b_score) in wants.items():
+        for c_id, (c_owner, c_score) in wanted_by.items():
+            if b_id == c_id or b_owner == c_owner:
+                continue
+            overlap = len(b_wants[b_id] & c_offers[c_id])
+            if overlap:
+                cycles.append(((b_id, c_id), b_score + overlap + c_score))
+    cycles.sort(key=lambda cycle: (-cycle[1], cycle[0]))
+    return cycles[:limit]
@@ -0,0 +1,28 @@
+from django.db import migrations
+
+from users import search
+
+
+def create_index(apps, schema_editor):
+    if search.is_available(schema_editor.connection):
+        schema_editor.execute(search.CREATE_SQL)
+        schema_editor.execute(
+            f'INSERT INTO {search.FTS_TABLE} (rowid, title, description, wanted_items) '
+            'SELECT id, title, description, wanted_items FROM users_product'
+        )
+
+
+def drop_index(apps, schema_editor):
+    if search.is_available(schema_editor.connection):
+        schema_editor.execute(search.DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
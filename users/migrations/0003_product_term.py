@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from users.matching import offered_terms, wanted_terms
+
+
+def index_available_products(apps, schema_editor):
+    Product = apps.get_model('users', 'Product')
+    ProductTerm = apps.get_model('users', 'ProductTerm')
+    rows = []
+    for product in Product.objects.filter(status='available').iterator():
+        rows += [
+            ProductTerm(product_id=product.id, kind='offered', term=term)
+            for term in offered_terms(product.title, product.category)
+        ]
+        rows += [
+            ProductTerm(product_id=product.id, kind='wanted', term=term)
+            for term in wanted_terms(product.wanted_items)
+        ]
+        if len(rows) >= 2000:
+            ProductTerm.objects.bulk_create(rows, ignore_conflicts=True)
+            rows = []
+    ProductTerm.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('offered', 'Offered'), ('wanted', 'Wanted')], max_length=10)),
+                ('term', models.CharField(max_length=64)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='users.product')),
+            ],
+            options={
+                'unique_together': {('kind', 'term', 'product')},
+            },
+        ),
+        migrations.RunPython(index_available_products, migrations.RunPython.noop),
+    ]
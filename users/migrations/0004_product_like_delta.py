@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_product_term'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductLikeDelta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.SmallIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_deltas', to='users.product')),
+            ],
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:29
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(queryset):
+    return Coalesce(Subquery(
+        queryset.order_by().values('chat_room').annotate(count=Count('id')).values('count')
+    ), 0)
+
+
+def backfill_read_states(apps, schema_editor):
+    ChatRoom = apps.get_model('users', 'ChatRoom')
+    ChatReadState = apps.get_model('users', 'ChatReadState')
+    Message = apps.get_model('users', 'Message')
+    Participant = ChatRoom.participants.through
+
+    ChatRoom.objects.update(message_count=count_messages(Message.objects.filter(chat_room=OuterRef('pk'))))
+
+    # A participant has read up to their own newest message, or the newest one flagged read
+    last_read = (
+        Message.objects.filter(chat_room=OuterRef('chatroom_id'))
+        .filter(Q(sender=OuterRef('user_id')) | Q(is_read=True))
+        .order_by('-id').values('id')[:1]
+    )
+    rows = Participant.objects.annotate(last_read=Coalesce(Subquery(last_read), 0)).values_list(
+        'chatroom_id', 'user_id', 'last_read'
+    )
+    states = []
+    for chat_room_id, user_id, last_read_message_id in rows.iterator():
+        states.append(ChatReadState(
+            chat_room_id=chat_room_id, user_id=user_id, last_read_message_id=last_read_message_id,
+        ))
+        if len(states) >= 2000:
+            ChatReadState.objects.bulk_create(states, ignore_conflicts=True)
+            states = []
+    ChatReadState.objects.bulk_create(states, ignore_conflicts=True)
+
+    ChatReadState.objects.update(read_count=count_messages(Message.objects.filter(
+        chat_room=OuterRef('chat_room'), id__lte=OuterRef('last_read_message_id'),
+    )))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_product_like_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('read_count', models.PositiveIntegerField(default=0)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='users.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('chat_room', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
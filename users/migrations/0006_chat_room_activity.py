@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_activity(apps, schema_editor):
+    ChatRoom = apps.get_model('users', 'ChatRoom')
+    ChatReadState = apps.get_model('users', 'ChatReadState')
+    Message = apps.get_model('users', 'Message')
+
+    latest = Message.objects.filter(chat_room=OuterRef('pk')).order_by('-id')
+    ChatRoom.objects.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+    )
+    ChatReadState.objects.update(last_activity_at=Subquery(
+        ChatRoom.objects.filter(pk=OuterRef('chat_room')).values('last_activity_at')
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_chat_read_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='users.message'),
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatreadstate',
+            index=models.Index(fields=['user', 'last_activity_at', 'chat_room'], name='users_chatreadstate_inbox'),
+        ),
+    ]
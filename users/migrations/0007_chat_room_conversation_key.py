@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:33
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def merge_duplicate_rooms(apps, schema_editor):
+    """
+    Key every two-person product room, folding duplicates of a conversation
+    into its oldest room: messages move over, watermarks merge and the
+    counters are recomputed.
+    """
+    ChatRoom = apps.get_model('users', 'ChatRoom')
+    ChatReadState = apps.get_model('users', 'ChatReadState')
+    Message = apps.get_model('users', 'Message')
+    Participant = ChatRoom.participants.through
+
+    participants = defaultdict(list)
+    for chat_room_id, user_id in Participant.objects.values_list('chatroom_id', 'user_id').iterator():
+        participants[chat_room_id].append(user_id)
+
+    conversations = defaultdict(list)
+    rooms = ChatRoom.objects.filter(product__isnull=False).order_by('id').values_list('id', 'product_id')
+    for chat_room_id, product_id in rooms.iterator():
+        users = participants.get(chat_room_id, [])
+        if len(users) == 2 and users[0] != users[1]:
+            conversations[(product_id, *sorted(users))].append(chat_room_id)
+
+    for (product_id, user_low, user_high), (keeper, *duplicates) in conversations.items():
+        if duplicates:
+            watermarks = dict(
+                ChatReadState.objects.filter(chat_room__in=[keeper, *duplicates])
+                .values('user').annotate(last_read=Max('last_read_message_id'))
+                .values_list('user', 'last_read')
+            )
+            Message.objects.filter(chat_room__in=duplicates).update(chat_room=keeper)
+            ChatRoom.objects.filter(id__in=duplicates).delete()
+
+            latest = Message.objects.filter(chat_room=keeper).order_by('-id')
+            ChatRoom.objects.filter(id=keeper).update(
+                message_count=latest.count(),
+                last_message_id=Subquery(latest.values('id')[:1]),
+                last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+            )
+            for user_id, last_read in watermarks.items():
+                ChatReadState.objects.filter(chat_room=keeper, user=user_id).update(
+                    last_read_message_id=last_read,
+                    read_count=Message.objects.filter(chat_room=keeper, id__lte=last_read).count(),
+                    last_activity_at=Subquery(
+                        ChatRoom.objects.filter(pk=OuterRef('chat_room')).values('last_activity_at')
+                    ),
+                )
+        ChatRoom.objects.filter(id=keeper).update(user_low=user_low, user_high=user_high)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_chat_room_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='user_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='user_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(merge_duplicate_rooms, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.UniqueConstraint(fields=('product', 'user_low', 'user_high'), name='users_chatroom_conversation'),
+        ),
+    ]
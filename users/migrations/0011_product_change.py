@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:58
+
+from django.db import migrations, models
+
+
+def log_existing_products(apps, schema_editor):
+    # Without a change each, products that predate the log would never reach a fresh replica
+    schema_editor.execute(
+        'INSERT INTO users_productchange (product_id, deleted, created_at) '
+        'SELECT id, %s, updated_at FROM users_product ORDER BY id',
+        [False],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_feed_recommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['product_id', 'id'], name='users_productchange_product'),
+                    models.Index(fields=['deleted', 'id'], name='users_productchange_deleted'),
+                ],
+            },
+        ),
+        migrations.RunPython(log_existing_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_product_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_message_id', models.BigIntegerField()),
+                ('first_created_at', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('last_created_at', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='users.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat_room', 'first_created_at', 'first_message_id'], name='users_archive_room_first'), models.Index(fields=['chat_room', 'last_created_at', 'last_message_id'], name='users_archive_room_last')],
+            },
+        ),
+    ]
@@ -1,18 +1,57 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils import timezone
+
+from . import caching, geo
 
 class User(AbstractUser):
     firebase_uid = models.CharField(max_length=128, unique=True, null=True, blank=True)
     profile_image = models.URLField(blank=True, null=True)
     phone_number = models.CharField(max_length=20, blank=True, null=True)
     location = models.CharField(max_length=100, blank=True, null=True)
+    latitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    longitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)]
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.username
 
+class ProductQuerySet(models.QuerySet):
+    def with_like_state(self, user):
+        """Join the owner and annotate is_liked for user in the same query"""
+        queryset = self.select_related('owner')
+        if user is None or not user.is_authenticated:
+            return queryset.annotate(is_liked=models.Value(False))
+        return queryset.annotate(is_liked=models.Exists(
+            ProductLike.objects.filter(user=user, product=models.OuterRef('pk'))
+        ))
+
+    def near(self, latitude, longitude, radius_km):
+        """
+        Prefilter to products that may lie within radius_km: the geohash cells
+        covering the circle, then its bounding box. Rank the survivors with
+        geo.haversine_km(). Each cell is its own index range scan, combined
+        with UNION ALL, so apply other filters first; only values_list(),
+        slicing and ordering work on the result.
+        """
+        min_lat, max_lat, min_lng, max_lng = geo.bounding_box(latitude, longitude, radius_km)
+        queryset = self.order_by().filter(latitude__range=(min_lat, max_lat))
+        if min_lng is not None:
+            queryset = queryset.filter(longitude__range=(min_lng, max_lng))
+        first, *rest = [
+            queryset.filter(geohash__gte=cell, geohash__lt=cell + geo.END)
+            for cell in geo.nearby_cells(latitude, longitude, radius_km)
+        ]
+        return first.union(*rest, all=True)
+
 class Product(models.Model):
     CATEGORY_CHOICES = [
         ('electronics', 'Electronics'),
@@ -37,22 +76,65 @@ class Product(models.Model):
     image = models.URLField()
     wanted_items = models.TextField(help_text='Comma separated list of wanted items')
     location = models.CharField(max_length=100)
+    latitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    longitude = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)]
+    )
+    # Derived from latitude/longitude in save(); bulk writes must set it themselves
+    geohash = models.CharField(max_length=geo.MAX_PRECISION, blank=True, default='', editable=False)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='available')
     can_sell = models.BooleanField(default=False)
     likes_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # The feed: available products, newest first, paged by (created_at, id)
+            models.Index(fields=['status', 'created_at', 'id'], name='users_product_feed'),
+            models.Index(fields=['owner', 'created_at'], name='users_product_owner_created'),
+            # Nearby listings: available products in a few geohash ranges
+            models.Index(fields=['status', 'geohash'], name='users_product_nearby'),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.geohash = geo.encode_point(self.latitude, self.longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'geohash'}
+        super().save(*args, **kwargs)
+
     @property
     def wanted_items_list(self):
         return [item.strip() for item in self.wanted_items.split(',') if item.strip()]
 
+class ProductTerm(models.Model):
+    """Inverted index of normalized terms that available products offer or want"""
+    OFFERED = 'offered'
+    WANTED = 'wanted'
+    KIND_CHOICES = [
+        (OFFERED, 'Offered'),
+        (WANTED, 'Wanted'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='terms')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    term = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('kind', 'term', 'product')
+
+    def __str__(self):
+        return f"{self.product_id} {self.kind} {self.term}"
+
 class ProductLike(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='likes')
@@ -61,33 +143,227 @@ class ProductLike(models.Model):
     class Meta:
         unique_together = ('user', 'product')
 
+class ProductLikeDelta(models.Model):
+    """Pending likes_count change written instead of updating a hot Product row"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='like_deltas')
+    delta = models.SmallIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class ProductChange(models.Model):
+    """A write to a product, logged for delta sync; the id is the sync position (see users.changes)"""
+    # Not a foreign key: tombstones outlive their product
+    product_id = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Compaction: is there a newer change of the same product?
+            models.Index(fields=['product_id', 'id'], name='users_productchange_product'),
+            # Token stamps: the first tombstone after a position
+            models.Index(fields=['deleted', 'id'], name='users_productchange_deleted'),
+        ]
+
+class FeedRecommendation(models.Model):
+    """One ranked entry of a user's precomputed feed; see users.recommendations"""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='feed_recommendations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='feed_recommendations')
+    rank = models.PositiveIntegerField()
+    score = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # The feed read: one user's entries in rank order
+        unique_together = ('user', 'rank')
+
+class StaleFeed(models.Model):
+    """A user whose likes changed since their feed was last ranked"""
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='+'
+    )
+    marked_at = models.DateTimeField(auto_now=True)
+
+class ChatRoomQuerySet(models.QuerySet):
+    def for_inbox(self, user):
+        """
+        Rooms user takes part in, with everything ChatRoomSerializer reads
+        preloaded so the list costs O(1) queries.
+
+        Rooms are reached through user's ChatReadState rows, which carry a copy
+        of last_activity_at, so "my rooms by activity" is one range scan of
+        the (user, last_activity_at, chat_room) index.
+        """
+        return self.annotate(
+            my_read_state=models.FilteredRelation('read_states', condition=models.Q(read_states__user=user)),
+        ).filter(my_read_state__isnull=False).annotate(
+            activity_at=models.F('my_read_state__last_activity_at'),
+            # Same value as id, but read from the index so ORDER BY needs no sort
+            activity_id=models.F('my_read_state__chat_room'),
+            unread_count=Greatest(
+                models.F('message_count') - Coalesce(models.F('my_read_state__read_count'), 0), 0
+            ),
+        ).prefetch_related(
+            'participants',
+            models.Prefetch('product', queryset=Product.objects.with_like_state(user)),
+            models.Prefetch('last_message', queryset=Message.objects.with_read_state().select_related('sender')),
+        )
+
+    def get_or_create_conversation(self, product, user_a, user_b):
+        """
+        The room for (product, user_a, user_b), created with its participants
+        if missing. The unique conversation key makes concurrent calls agree on
+        one room: the loser of the insert race reads the winner's row.
+        """
+        user_low, user_high = sorted((user_a.pk, user_b.pk))
+        key = {'product': product, 'user_low_id': user_low, 'user_high_id': user_high}
+        try:
+            return self.get(**key), False
+        except self.model.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic(using=self.db):
+                room = self.create(**key)
+                room.participants.add(user_low, user_high)
+            return room, True
+        except IntegrityError:
+            return self.get(**key), False
+
 class ChatRoom(models.Model):
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='chat_rooms')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='chat_rooms', null=True, blank=True)
+    # Canonical conversation key: the two participants ordered by id
+    user_low = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', null=True, blank=True
+    )
+    user_high = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', null=True, blank=True
+    )
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, related_name='+', null=True, blank=True
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    message_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ChatRoomQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['product', 'user_low', 'user_high'], name='users_chatroom_conversation'
+            ),
+        ]
+
     def __str__(self):
         participants_names = ', '.join([user.username for user in self.participants.all()])
         return f"Chat: {participants_names}"
 
-    @property
-    def last_message(self):
-        return self.messages.order_by('-created_at').first()
+    def mark_read(self, user):
+        """Move user's read watermark to the newest message; one UPDATE, no-op if already read"""
+        room = ChatRoom.objects.filter(pk=self.pk)
+        message_count = room.values('message_count')
+        updated = ChatReadState.objects.filter(
+            chat_room=self, user=user, read_count__lt=models.Subquery(message_count),
+        ).update(
+            last_read_message_id=Coalesce(models.Subquery(room.values('last_message_id')), 0),
+            read_count=models.Subquery(message_count),
+        )
+        if updated:
+            caching.bump_versions(*[
+                caching.chats_scope(user_id) for user_id in self.participants.values_list('id', flat=True)
+            ])
+        return updated
+
+    def record_message(self, message):
+        """
+        Count message as the room's latest activity and mark the room read up
+        to it for its sender: one UPDATE of the room, one of its state rows.
+        """
+        ChatRoom.objects.filter(pk=self.pk).update(
+            message_count=models.F('message_count') + 1,
+            last_message_id=Greatest(Coalesce(models.F('last_message_id'), 0), message.id),
+            last_activity_at=Greatest(models.F('last_activity_at'), message.created_at),
+        )
+        is_sender = models.Q(user_id=message.sender_id)
+        ChatReadState.objects.filter(chat_room=self).update(
+            last_activity_at=Greatest(models.F('last_activity_at'), message.created_at),
+            last_read_message_id=models.Case(
+                models.When(is_sender, then=Greatest(models.F('last_read_message_id'), message.id)),
+                default=models.F('last_read_message_id'),
+            ),
+            read_count=models.Case(
+                models.When(is_sender, then=models.Subquery(
+                    ChatRoom.objects.filter(pk=self.pk).values('message_count')
+                )),
+                default=models.F('read_count'),
+            ),
+        )
+
+class ChatReadState(models.Model):
+    """Per-participant read watermark: everything up to last_read_message_id is read"""
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_read_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    read_count = models.PositiveIntegerField(default=0)
+    # Copy of ChatRoom.last_activity_at for the inbox index
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('chat_room', 'user')
+        indexes = [
+            models.Index(fields=['user', 'last_activity_at', 'chat_room'], name='users_chatreadstate_inbox'),
+        ]
+
+class MessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """Annotate is_read: whether another participant's watermark has passed the message"""
+        return self.annotate(is_read=models.Exists(
+            ChatReadState.objects.filter(
+                chat_room=models.OuterRef('chat_room'),
+                last_read_message_id__gte=models.OuterRef('pk'),
+            ).exclude(user=models.OuterRef('sender'))
+        ))
 
 class Message(models.Model):
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     content = models.TextField()
-    is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['chat_room', 'created_at', 'id'], name='users_message_room_created'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
+class MessageArchiveSegment(models.Model):
+    """A run of a room's oldest messages, moved out of Message and compressed; see users.archive"""
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archive_segments')
+    first_message_id = models.BigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_message_id = models.BigIntegerField()
+    last_created_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    # zlib-compressed JSON: [[id, sender_id, content, created_at], ...], oldest first
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Paging back from a position, and forward again
+            models.Index(fields=['chat_room', 'first_created_at', 'first_message_id'], name='users_archive_room_first'),
+            models.Index(fields=['chat_room', 'last_created_at', 'last_message_id'], name='users_archive_room_last'),
+        ]
+
+    def __str__(self):
+        return f"Chat {self.chat_room_id}: {self.message_count} archived messages"
+
 # Keep the original Item model for backward compatibility
 class Item(models.Model):
     title = models.CharField(max_length=100)
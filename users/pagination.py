@@ -0,0 +1,217 @@
+import base64
+import json
+import math
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_cursor(data):
+    """Pack a JSON-serializable value into an opaque URL-safe token"""
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Reverse encode_cursor(), raising ValueError on malformed input"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return json.loads(raw)
+    except (TypeError, ValueError, UnicodeDecodeError) as exc:
+        raise ValueError('Malformed cursor') from exc
+
+
+def cursor_int(value):
+    # Past 64 bits the SQLite driver overflows; bool is an int subclass
+    if isinstance(value, bool) or not isinstance(value, int) or not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError('Expected an integer')
+    return value
+
+
+def cursor_float(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError('Expected a number')
+    return float(value)
+
+
+def cursor_datetime(value):
+    """An aware datetime, from the isoformat() string position_for() stored"""
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if not isinstance(value, datetime) or timezone.is_naive(value):
+        raise ValueError('Expected an ISO 8601 timestamp')
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique compound ordering such as (-created_at, -id).
+
+    Each page is fetched with a WHERE clause on the last row of the previous
+    page instead of an OFFSET, so page N costs the same as page one as long as
+    an index covers the ordering. Cursors are opaque tokens carrying the
+    position and the direction of travel. position_types parses each value of
+    a position, so a tampered cursor is a 404 rather than a failing query.
+    """
+    ordering = ('-created_at', '-id')
+    position_types = (cursor_datetime, cursor_int)
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.get_page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset() for async views, fetching the page with the async ORM"""
+        return self.set_page([obj async for obj in self.get_page_queryset(queryset, request)])
+
+    def get_page_queryset(self, queryset, request):
+        """Slice one page, plus a row to tell whether more follow, out of queryset"""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size_value = self.get_page_size(request)
+        self.position, self.reverse = self.get_position(request)
+
+        ordering = self.ordering
+        if self.reverse:
+            ordering = tuple(self.invert(field) for field in ordering)
+        if self.position is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, self.position))
+        return queryset.order_by(*ordering)[:self.page_size_value + 1]
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size_value
+        self.page = results[:self.page_size_value]
+        if self.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.position is not None
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_position(self, request, position_types=None):
+        """
+        The (position, reverse) of the request's cursor, or (None, False)
+        without one. Views ranking by something other than the ordering pass
+        their own position_types.
+        """
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            data = decode_cursor(token)
+            position, reverse = data['p'], bool(data.get('r'))
+            position = self.parse_position(position, position_types or self.position_types)
+        except (KeyError, TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    @staticmethod
+    def parse_position(position, position_types):
+        if not isinstance(position, list) or len(position) != len(position_types):
+            raise ValueError('Cursor does not match the ordering')
+        return [parse(value) for parse, value in zip(position_types, position)]
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.get_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.get_link(self.page[0], reverse=True)
+
+    def get_link(self, obj, reverse):
+        data = {'p': self.position_for(obj)}
+        if reverse:
+            data['r'] = 1
+        url = remove_query_param(self.base_url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(data))
+
+    def position_for(self, obj):
+        position = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            position.append(value)
+        return position
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def keyset_filter(ordering, position):
+        """
+        Build "row after position" for the given ordering, e.g. for
+        (-created_at, -id): created_at <= c AND (created_at < c OR (created_at = c AND id < i)).
+        The redundant leading bound lets the database use a range scan.
+        """
+        names = [field.lstrip('-') for field in ordering]
+        lookups = ['lt' if field.startswith('-') else 'gt' for field in ordering]
+
+        after = Q()
+        for i, (name, lookup) in enumerate(zip(names, lookups)):
+            clause = Q(**{f'{name}__{lookup}': position[i]})
+            for previous, value in zip(names[:i], position):
+                clause &= Q(**{previous: value})
+            after |= clause
+        return Q(**{f'{names[0]}__{lookups[0]}e': position[0]}) & after
+
+
+class ChatRoomPagination(KeysetPagination):
+    """Most recently active first, over ChatRoom.objects.for_inbox()"""
+    ordering = ('-activity_at', '-activity_id')
+
+
+class MessagePagination(KeysetPagination):
+    """Newest messages first; follow `next` to page back through history"""
+    page_size = 50
+    max_page_size = 200
+
+
+class FeedPagination(KeysetPagination):
+    """A user's FeedRecommendation entries, best first"""
+    ordering = ('rank',)
+    position_types = (cursor_int,)
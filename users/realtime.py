@@ -0,0 +1,39 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(chat_room_id):
+    return f'chat_{chat_room_id}'
+
+
+def broadcast(chat_room_id, event):
+    """
+    Send event to every WebSocket connected to the chat room. Callers send
+    after their write has committed, so a channel layer outage (Redis down) is
+    logged rather than raised: failing the request would make clients retry a
+    write that already happened.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(room_group_name(chat_room_id), event)
+    except Exception:
+        logger.exception('Could not broadcast %s to chat room %s', event['type'], chat_room_id)
+
+
+def broadcast_message(message):
+    from .serializers import MessageSerializer
+
+    broadcast(message.chat_room_id, {
+        'type': 'chat.message',
+        'message': MessageSerializer(message).data,
+    })
+
+
+def broadcast_read_receipt(chat_room_id, user_id):
+    broadcast(chat_room_id, {'type': 'chat.read', 'user_id': user_id})
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from .consumers import ChatConsumer
+
+websocket_urlpatterns = [
+    path('ws/chats/<int:chat_room_id>/', ChatConsumer.as_asgi(), name='chat-socket'),
+]
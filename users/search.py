@@ -0,0 +1,99 @@
+import re
+
+from django.db import connection, connections, router
+
+from .models import Product
+
+FTS_TABLE = 'users_product_fts'
+# bm25() column weights for (title, description, wanted_items)
+RANK_WEIGHTS = (10.0, 2.0, 5.0)
+
+CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "title, description, wanted_items, tokenize='unicode61 remove_diacritics 2')"
+)
+DROP_SQL = f'DROP TABLE IF EXISTS {FTS_TABLE}'
+INSERT_SQL = f'INSERT INTO {FTS_TABLE} (rowid, title, description, wanted_items) VALUES (%s, %s, %s, %s)'
+DELETE_SQL = f'DELETE FROM {FTS_TABLE} WHERE rowid = %s'
+
+
+def is_available(using=connection):
+    """FTS5 is only used on SQLite; other backends fall back to LIKE filters"""
+    return using.vendor == 'sqlite'
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query where every word must match as a prefix"""
+    words = re.findall(r'\w+', text)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def index_products(products):
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(DELETE_SQL, [(product.id,) for product in products])
+        cursor.executemany(INSERT_SQL, [
+            (product.id, product.title, product.description, product.wanted_items)
+            for product in products
+        ])
+
+
+def unindex_products(product_ids):
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(DELETE_SQL, [(product_id,) for product_id in product_ids])
+
+
+def rebuild_index():
+    """Repopulate the whole index from users_product in one statement"""
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_SQL)
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, description, wanted_items) '
+            'SELECT id, title, description, wanted_items FROM users_product'
+        )
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT count(*) FROM {FTS_TABLE}')
+        return cursor.fetchone()[0]
+
+
+def search_product_ids(text, limit, after=None, exclude_owner=None, category=None, status=None):
+    """
+    Return up to limit (product_id, rank) pairs best match first.
+
+    Lower bm25 ranks are better. after is the (rank, id) of the last row of
+    the previous page, so deep pages are fetched with a keyset condition.
+    """
+    match = build_match_query(text)
+    if not match:
+        return []
+
+    where, params = [f'{FTS_TABLE} MATCH %s'], [match]
+    if exclude_owner is not None:
+        where.append('p.owner_id != %s')
+        params.append(exclude_owner)
+    if category:
+        where.append('p.category = %s')
+        params.append(category)
+    if status:
+        where.append('p.status = %s')
+        params.append(status)
+
+    sql = (
+        f'SELECT p.id, bm25({FTS_TABLE}, %s, %s, %s) AS rank '
+        f'FROM {FTS_TABLE} JOIN users_product p ON p.id = {FTS_TABLE}.rowid '
+        f'WHERE {" AND ".join(where)}'
+    )
+    params = [*RANK_WEIGHTS, *params]
+    if after is not None:
+        sql = f'SELECT id, rank FROM ({sql}) WHERE rank > %s OR (rank = %s AND id > %s)'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY rank, id LIMIT %s'
+    params.append(limit)
+
+    with connections[router.db_for_read(Product)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
@@ -1,29 +1,97 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Product, ChatRoom, Message, ProductLike
+from backend.metrics import timed
+from . import geo
+from .models import Product, ChatRoom, ChatReadState, Message, ProductLike
 
 User = get_user_model()
 
-class UserSerializer(serializers.ModelSerializer):
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+class BaseModelSerializer(serializers.ModelSerializer):
+    """
+    Base for the app's serializers: reports top-level serialization time to
+    the request metrics and accepts fields= (a parse_fieldset() tree) to
+    drop everything not asked for, including inside nested serializers.
+    Method fields that serialize nested objects pass on their own subtree
+    of _fieldset.
+    """
+    _fieldset = None
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            self.restrict_fields(fields)
+
+    def restrict_fields(self, fieldset):
+        self._fieldset = fieldset
+        for name in list(self.fields):
+            if name not in fieldset:
+                self.fields.pop(name)
+            elif fieldset[name]:
+                field = self.fields[name]
+                field = getattr(field, 'child', field)
+                if isinstance(field, BaseModelSerializer):
+                    field.restrict_fields(fieldset[name])
+
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+class LocationSerializerMixin:
+    """Look a changed location up in the bundled gazetteer unless coordinates come with it"""
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if ('latitude' in attrs) != ('longitude' in attrs):
+            raise serializers.ValidationError('latitude and longitude must be given together')
+        location = attrs.get('location')
+        # A PATCH resending the stored location keeps the stored coordinates
+        changed = self.instance is None or location != self.instance.location
+        if location is not None and changed and 'latitude' not in attrs:
+            attrs['latitude'], attrs['longitude'] = geo.geocode(location) or (None, None)
+        return attrs
+
+class UserSerializer(LocationSerializerMixin, BaseModelSerializer):
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 
-                 'profile_image', 'phone_number', 'location', 'created_at']
+                 'profile_image', 'phone_number', 'location', 'latitude', 'longitude', 'created_at']
         read_only_fields = ['id', 'created_at']
 
-class ProductSerializer(serializers.ModelSerializer):
+    def to_representation(self, instance):
+        # When the view side-loads users (RepresentationMixin), embed just the id
+        users = self.context.get('users')
+        if users is None:
+            return super().to_representation(instance)
+        key = str(instance.pk)
+        if key not in users:
+            users[key] = super().to_representation(instance)
+        return instance.pk
+
+class ProductSerializer(LocationSerializerMixin, BaseModelSerializer):
     owner = UserSerializer(read_only=True)
     wanted_items_list = serializers.ReadOnlyField()
     is_liked = serializers.SerializerMethodField()
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = Product
         fields = ['id', 'owner', 'title', 'description', 'category', 'image', 
-                 'wanted_items', 'wanted_items_list', 'location', 'status', 
+                 'wanted_items', 'wanted_items_list', 'location', 'latitude', 'longitude', 'status',
                  'can_sell', 'likes_count', 'is_liked', 'created_at', 'updated_at']
         read_only_fields = ['id', 'owner', 'likes_count', 'created_at', 'updated_at']
 
     def get_is_liked(self, obj):
+        # Querysets built with Product.objects.with_like_state() carry the flag
+        if hasattr(obj, 'is_liked'):
+            return obj.is_liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return ProductLike.objects.filter(user=request.user, product=obj).exists()
@@ -33,15 +101,25 @@ class ProductSerializer(serializers.ModelSerializer):
         validated_data['owner'] = self.context['request'].user
         return super().create(validated_data)
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(BaseModelSerializer):
     sender = UserSerializer(read_only=True)
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = Message
         fields = ['id', 'sender', 'content', 'is_read', 'created_at']
         read_only_fields = ['id', 'sender', 'created_at']
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+    def get_is_read(self, obj):
+        # Querysets built with Message.objects.with_read_state() carry the flag
+        if hasattr(obj, 'is_read'):
+            return obj.is_read
+        return ChatReadState.objects.filter(
+            chat_room_id=obj.chat_room_id, last_read_message_id__gte=obj.id
+        ).exclude(user_id=obj.sender_id).exists()
+
+class ChatRoomSerializer(BaseModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
     product = ProductSerializer(read_only=True)
     last_message = MessageSerializer(read_only=True)
@@ -49,21 +127,29 @@ class ChatRoomSerializer(serializers.ModelSerializer):
     other_participant = serializers.SerializerMethodField()
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = ChatRoom
         fields = ['id', 'participants', 'product', 'last_message', 
                  'unread_count', 'other_participant', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
     def get_unread_count(self, obj):
+        # Querysets built with ChatRoom.objects.for_inbox() carry the count
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.messages.filter(is_read=False).exclude(sender=request.user).count()
+            state = obj.read_states.filter(user=request.user).first()
+            return max(obj.message_count - (state.read_count if state else 0), 0)
         return 0
 
     def get_other_participant(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            other_participants = obj.participants.exclude(id=request.user.id)
-            if other_participants.exists():
-                return UserSerializer(other_participants.first()).data
-        return None
\ No newline at end of file
+            # Iterate participants.all() so a prefetched list is reused
+            for participant in obj.participants.all():
+                if participant.id != request.user.id:
+                    fields = (self._fieldset or {}).get('other_participant') or None
+                    serializer = UserSerializer(participant, context=self.context, fields=fields)
+                    return serializer.to_representation(participant)
+        return None
@@ -0,0 +1,137 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import archive, caching, changes
+from .authentication import user_cache_key
+from .longpoll import notify_new_message
+from .matching import index_products as index_product_terms
+from .models import ChatReadState, ChatRoom, Message, Product, ProductLike, StaleFeed, User
+from .search import index_products, unindex_products
+from .realtime import broadcast_message
+
+
+def bump_chat_lists(chat_room_id, user_ids=None):
+    if user_ids is None:
+        user_ids = ChatRoom.participants.through.objects.filter(
+            chatroom_id=chat_room_id
+        ).values_list('user_id', flat=True)
+    scopes = [caching.chats_scope(user_id) for user_id in user_ids]
+    if scopes:
+        transaction.on_commit(lambda: caching.bump_versions(*scopes))
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if created:
+        instance.chat_room.record_message(instance)
+        transaction.on_commit(lambda: notify_new_message(instance.chat_room_id))
+        transaction.on_commit(lambda: broadcast_message(instance))
+    bump_chat_lists(instance.chat_room_id)
+
+
+@receiver(post_save, sender=ChatRoom)
+def chat_room_saved(sender, instance, created, **kwargs):
+    if not created:
+        bump_chat_lists(instance.id)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def chat_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Forward: instance is the room and pk_set users; reverse (user.chat_rooms) the other way round
+    if action == 'post_add':
+        if reverse:
+            activity = dict(ChatRoom.objects.filter(pk__in=pk_set).values_list('id', 'last_activity_at'))
+            rows = [(room_id, instance.pk, activity[room_id]) for room_id in pk_set]
+        else:
+            rows = [(instance.pk, user_id, instance.last_activity_at) for user_id in pk_set]
+        ChatReadState.objects.bulk_create(
+            [
+                ChatReadState(chat_room_id=room_id, user_id=user_id, last_activity_at=last_activity_at)
+                for room_id, user_id, last_activity_at in rows
+            ],
+            ignore_conflicts=True,
+        )
+    elif action == 'post_remove':
+        lookup = {'user': instance, 'chat_room_id__in': pk_set} if reverse else {
+            'chat_room': instance, 'user_id__in': pk_set}
+        ChatReadState.objects.filter(**lookup).delete()
+    elif action == 'post_clear':
+        ChatReadState.objects.filter(**{'user' if reverse else 'chat_room': instance}).delete()
+    if action in ('post_add', 'post_remove') and isinstance(instance, ChatRoom):
+        bump_chat_lists(instance.id, list(pk_set or ()) + [
+            user.id for user in instance.participants.all()
+        ])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    if instance.firebase_uid:
+        key = user_cache_key(instance.firebase_uid)
+        transaction.on_commit(lambda: cache.delete(key))
+    # Logins only touch last_login, which is not serialized
+    update_fields = kwargs.get('update_fields')
+    serialized = update_fields is None or set(update_fields) - {'last_login'}
+    if serialized and kwargs['signal'] is post_save:
+        bump_partner_chat_lists(instance.id)
+    # Cached product representations embed the owner
+    product_ids = list(Product.objects.filter(owner=instance).values_list('id', flat=True))
+    if product_ids:
+        transaction.on_commit(lambda: caching.invalidate_products(product_ids, [instance.id]))
+        # So do synced ones
+        if serialized:
+            changes.record(product_ids)
+
+
+def bump_partner_chat_lists(user_id):
+    """Inboxes embed participants, so revalidate those of everyone sharing a room with the user"""
+    Participant = ChatRoom.participants.through
+    user_ids = Participant.objects.filter(
+        chatroom__in=Participant.objects.filter(user_id=user_id).values('chatroom')
+    ).values_list('user_id', flat=True).distinct()
+    scopes = [caching.chats_scope(partner_id) for partner_id in user_ids]
+    if scopes:
+        transaction.on_commit(lambda: caching.bump_versions(*scopes))
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # Deleting a user cascades to their messages; do the same in the archive
+    archive.forget_sender(instance.id)
+    # and to their room memberships, which post_delete can no longer see
+    bump_partner_chat_lists(instance.id)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    index_products([instance])
+    index_product_terms([instance])
+    changes.record([instance.id])
+    transaction.on_commit(lambda: caching.invalidate_products([instance.id], [instance.owner_id]))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    unindex_products([instance.id])
+    changes.record([instance.id], deleted=True)
+    transaction.on_commit(lambda: caching.invalidate_products([instance.id], [instance.owner_id]))
+
+
+@receiver(post_save, sender=ProductLike)
+@receiver(post_delete, sender=ProductLike)
+def product_like_changed(sender, instance, **kwargs):
+    # Queue the user's feed for the next incremental users.recommendations run,
+    # unless the like goes because its user or product is being deleted
+    origin = kwargs.get('origin')
+    if origin is None or isinstance(origin, ProductLike) or getattr(origin, 'model', None) is ProductLike:
+        StaleFeed.objects.bulk_create(
+            [StaleFeed(user_id=instance.user_id)],
+            update_conflicts=True, unique_fields=['user'], update_fields=['marked_at'],
+        )
+
+    def invalidate():
+        caching.forget_product_representations([instance.product_id])
+        caching.bump_versions(caching.likes_scope(instance.user_id))
+    transaction.on_commit(invalidate)
@@ -0,0 +1,95 @@
+import json
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Bytes gathered before handing a piece of the body to the server
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def dumps(value):
+    """Encode value as JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value, default=DjangoJSONEncoder().default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def iter_json_array(items):
+    """Yield the JSON encoding of an iterable of items as a few large chunks"""
+    buffer, size = [b'['], 1
+    for index, item in enumerate(items):
+        encoded = dumps(item)
+        buffer.append(b',' + encoded if index else encoded)
+        size += len(encoded) + 1
+        if size >= WRITE_BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(b']')
+    yield b''.join(buffer)
+
+
+def iter_json_object(members):
+    """Yield a JSON object from (key, chunks) pairs, chunks being an iterable of encoded bytes"""
+    yield b'{'
+    for index, (key, chunks) in enumerate(members):
+        yield (b',' if index else b'') + dumps(key) + b':'
+        yield from chunks
+    yield b'}'
+
+
+def iter_json_value(get_value):
+    """Encode get_value() only once the stream reaches it"""
+    yield dumps(get_value())
+
+
+def streaming_json_response(chunks, status=200):
+    response = StreamingHttpResponse(chunks, content_type='application/json', status=status)
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+class StreamingListMixin:
+    """
+    ?stream=1 on a list view returns every row as one JSON array, written
+    while the queryset is read with .iterator(chunk_size=stream_chunk_size):
+    only one chunk of model instances and representations is alive at a
+    time, so memory stays flat however many rows there are. Pagination is
+    skipped; rows come in the pagination class's ordering. With ?normalize=1
+    the body is {"results": [...], "users": {...}}, the users map last.
+    """
+    stream_query_param = 'stream'
+    stream_chunk_size = 500
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_query_param) not in ('1', 'true'):
+            return super().list(request, *args, **kwargs)
+        results = iter_json_array(self.iter_representations())
+        users = self.get_sideloaded_users() if hasattr(self, 'get_sideloaded_users') else None
+        if users is None:
+            return streaming_json_response(results)
+        return streaming_json_response(iter_json_object([
+            ('results', results),
+            ('users', iter_json_value(lambda: users)),
+        ]))
+
+    def get_stream_queryset(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        ordering = getattr(self.pagination_class, 'ordering', None)
+        return queryset.order_by(*ordering) if ordering else queryset
+
+    def iter_representations(self):
+        rows = self.get_stream_queryset().iterator(chunk_size=self.stream_chunk_size)
+        for chunk in batched(rows, self.stream_chunk_size):
+            yield from self.get_serializer(chunk, many=True).data
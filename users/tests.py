@@ -1,3 +1,1578 @@
-from django.test import TestCase
+import asyncio
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, transaction
+import heapq
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.urls import reverse
+from rest_framework import exceptions
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from backend import metrics
+from backend.db_router import PrimaryReplicaRouter, ReplicaPinningMiddleware, use_replica
+from backend.asgi import application
+
+from .authentication import FirebaseAuthentication, token_cache, user_cache_key
+from .firebase_tokens import CertificateCache
+from . import archive, caching, changes, geo, likes, matching, recommendations, search, streaming
+from .longpoll import notify_new_message, wait_for_messages
+from .pagination import ChatRoomPagination, encode_cursor
+from .streaming import StreamingListMixin
+from .models import (
+    Item, User, Product, ProductChange, ProductLike, ChatRoom, ChatRoomQuerySet, ChatReadState, FeedRecommendation,
+    Message, MessageArchiveSegment, StaleFeed,
+)
+
+
+def make_products(owner, count, **kwargs):
+    fields = {
+        'description': 'A thing to swap',
+        'category': 'books',
+        'image': 'https://example.com/image.png',
+        'wanted_items': 'lamp, bike',
+        'location': 'Taipei',
+    }
+    fields.update(kwargs)
+    return Product.objects.bulk_create(
+        Product(owner=owner, title=f'Product {i}', **fields) for i in range(count)
+    )
+
+
+class ProductFeedQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='viewer')
+        self.owners = [
+            User.objects.create(username=f'owner{i}') for i in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_feed(self, count):
+        products = []
+        for i, owner in enumerate(self.owners):
+            products += make_products(owner, count // len(self.owners) + (i < count % len(self.owners)))
+        ProductLike.objects.bulk_create(
+            ProductLike(user=self.user, product=product) for product in products[::2]
+        )
+        return products
+
+    def assert_feed_queries(self, count):
+        self.create_feed(count)
+        # Cold: page of ids, products with owners, liked flags
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('all-products'), {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        # Warm: representations come from the shared cache
+        with self.assertNumQueries(2):
+            warm = self.client.get(reverse('all-products'), {'page_size': 100})
+        self.assertEqual(warm.data, response.data)
+        return response
+
+    def test_all_products_10(self):
+        self.assert_feed_queries(10)
+
+    def test_all_products_100(self):
+        self.assert_feed_queries(100)
+
+    def test_all_products_1000(self):
+        self.assert_feed_queries(1000)
+
+    def test_my_products_query_count_is_fixed(self):
+        for count in (10, 100, 1000):
+            Product.objects.all().delete()
+            make_products(self.user, count)
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('my-products'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_is_liked_and_owner_are_serialized(self):
+        products = self.create_feed(4)
+        liked_ids = {product.id for product in products[::2]}
+        response = self.client.get(reverse('all-products'))
+        for item in response.data['results']:
+            self.assertEqual(item['is_liked'], item['id'] in liked_ids)
+            self.assertIn(item['owner']['username'], {owner.username for owner in self.owners})
+
+
+class ChatListQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_rooms(self, count):
+        start = ChatRoom.objects.count()
+        for i in range(start, start + count):
+            other = User.objects.create(username=f'other{i}')
+            product = make_products(other, 1)[0]
+            room = ChatRoom.objects.create(product=product)
+            room.participants.add(self.user, other)
+            Message.objects.create(chat_room=room, sender=self.user, content='mine')
+            Message.objects.create(chat_room=room, sender=other, content='hi')
+            Message.objects.create(chat_room=room, sender=other, content=f'last {i}')
+
+    def test_query_count_is_fixed(self):
+        for count in (5, 50):
+            self.create_rooms(count - ChatRoom.objects.count())
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse('my-chats'))
+            self.assertEqual(len(response.data['results']), min(count, 20))
+
+    def test_serialized_values(self):
+        self.create_rooms(1)
+        room = self.client.get(reverse('my-chats')).data['results'][0]
+        self.assertEqual(room['unread_count'], 2)
+        self.assertEqual(room['last_message']['content'], 'last 0')
+        self.assertFalse(room['last_message']['is_read'])
+        self.assertEqual(room['other_participant']['username'], 'other0')
+        self.assertEqual(len(room['participants']), 2)
+        self.assertFalse(room['product']['is_liked'])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='viewer')
+        owner = User.objects.create(username='owner')
+        self.products = make_products(owner, 25)
+        # Ties on created_at must still page deterministically via id
+        Product.objects.filter(id__in=[p.id for p in self.products[:10]]).update(
+            created_at=timezone.now()
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_walks_every_product_once_in_both_directions(self):
+        seen, pages = [], []
+        url = reverse('all-products') + '?page_size=7'
+        while url:
+            response = self.client.get(url)
+            pages.append(response.data)
+            seen += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+        expected = list(
+            Product.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+        self.assertIsNone(pages[0]['previous'])
+
+        back = self.client.get(pages[-1]['previous'])
+        self.assertEqual(back.data['results'], pages[-2]['results'])
+
+    def test_page_query_has_no_offset(self):
+        response = self.client.get(reverse('all-products'), {'page_size': 5})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(response.data['next'])
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('all-products'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_wrongly_typed_cursor(self):
+        room = ChatRoom.objects.create()
+        room.participants.add(self.user)
+        self.user.latitude, self.user.longitude = 25.0330, 121.5654
+        self.user.save()
+        FeedRecommendation.objects.create(user=self.user, product=self.products[0], rank=0, score=1)
+        token = Token.objects.create(user=self.user)
+        bad = [['x', 1], ['2024-01-01T00:00:00+00:00', 'x'], ['2024-13-01T00:00:00+00:00', 1], [None, 10 ** 23]]
+        endpoints = [
+            (reverse('all-products'), {}),
+            (reverse('my-chats'), {}),
+            (reverse('chat-messages', args=[room.id]), {}),
+            (reverse('nearby-products'), {}),
+            (reverse('product-search'), {'q': 'product'}),
+        ]
+        for position in bad:
+            cursor = encode_cursor({'p': position})
+            for url, params in endpoints:
+                with self.subTest(url=url, position=position):
+                    self.assertEqual(self.client.get(url, {**params, 'cursor': cursor}).status_code, 404)
+            with self.subTest(url='async-all-products', position=position):
+                response = self.client.get(
+                    reverse('async-all-products'), {'cursor': cursor},
+                    headers={'Authorization': f'Token {token.key}'},
+                )
+                self.assertEqual(response.status_code, 404)
+        for position in [['x'], [1.5], [True]]:
+            with self.subTest(url='feed', position=position):
+                response = self.client.get(reverse('feed'), {'cursor': encode_cursor({'p': position})})
+                self.assertEqual(response.status_code, 404)
+
+
+class IncrementalMessageSyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        other = User.objects.create(username='other')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.user, other)
+        self.messages = [
+            Message.objects.create(chat_room=self.room, sender=other, content=str(i))
+            for i in range(5)
+        ]
+        self.url = reverse('chat-messages', args=[self.room.id])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_after_id_returns_only_newer_messages_oldest_first(self):
+        response = self.client.get(self.url, {'after_id': self.messages[2].id})
+        self.assertEqual([m['content'] for m in response.data], ['3', '4'])
+
+    def test_bad_after_id(self):
+        response = self.client.get(self.url, {'after_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CHAT_LONG_POLL_INTERVAL=0.05)
+    def test_long_poll_times_out_empty(self):
+        started = time.monotonic()
+        response = self.client.get(self.url, {'after_id': self.messages[-1].id, 'wait': 0.2})
+        self.assertEqual(response.data, [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_waiter_wakes_on_notify(self):
+        arrived = threading.Event()
+        threading.Timer(0.05, lambda: (arrived.set(), notify_new_message(self.room.id))).start()
+        started = time.monotonic()
+        self.assertTrue(wait_for_messages(self.room.id, arrived.is_set, timeout=5, poll_interval=5))
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class ReadWatermarkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.user, self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def unread_count(self):
+        return self.client.get(reverse('chat-room-detail', args=[self.room.id])).data['unread_count']
+
+    def test_unread_count_follows_watermark(self):
+        for i in range(3):
+            Message.objects.create(chat_room=self.room, sender=self.other, content=f'm{i}')
+        self.assertEqual(self.unread_count(), 3)
+
+        # One UPDATE, plus the participant lookup for the cache bump
+        with self.assertNumQueries(2):
+            self.room.mark_read(self.user)
+        self.assertEqual(self.unread_count(), 0)
+
+        Message.objects.create(chat_room=self.room, sender=self.other, content='new')
+        self.assertEqual(self.unread_count(), 1)
+        # Sending a message reads everything before it
+        Message.objects.create(chat_room=self.room, sender=self.user, content='reply')
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_is_read_reflects_other_participants_watermark(self):
+        first = Message.objects.create(chat_room=self.room, sender=self.user, content='hi')
+        self.room.mark_read(self.other)
+        second = Message.objects.create(chat_room=self.room, sender=self.user, content='there')
+
+        response = self.client.get(reverse('chat-messages', args=[self.room.id]))
+        is_read = {message['id']: message['is_read'] for message in response.data['results']}
+        self.assertTrue(is_read[first.id])
+        self.assertFalse(is_read[second.id])
+
+    def test_mark_read_is_a_noop_when_nothing_is_unread(self):
+        Message.objects.create(chat_room=self.room, sender=self.other, content='hi')
+        self.assertEqual(self.room.mark_read(self.user), 1)
+        self.assertEqual(self.room.mark_read(self.user), 0)
+
+    def test_removed_participant_loses_state(self):
+        self.other.chat_rooms.remove(self.room)
+        self.assertFalse(ChatReadState.objects.filter(user=self.other).exists())
+
+
+class ChatActivityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.rooms = []
+        for i in range(3):
+            room = ChatRoom.objects.create()
+            room.participants.add(self.user, User.objects.create(username=f'other{i}'))
+            self.rooms.append(room)
+
+    def test_inbox_orders_by_last_message(self):
+        message = Message.objects.create(chat_room=self.rooms[0], sender=self.user, content='bump')
+        self.rooms[0].refresh_from_db()
+        self.assertEqual(
+            (self.rooms[0].last_message_id, self.rooms[0].last_activity_at, self.rooms[0].message_count),
+            (message.id, message.created_at, 1),
+        )
+        results = self.client.get(reverse('my-chats')).data['results']
+        self.assertEqual(
+            [room['id'] for room in results], [self.rooms[0].id, self.rooms[2].id, self.rooms[1].id]
+        )
+        self.assertEqual(results[0]['last_message']['content'], 'bump')
+
+        page = self.client.get(reverse('my-chats'), {'page_size': 1})
+        page = self.client.get(page.data['next'])
+        self.assertEqual(page.data['results'][0]['id'], self.rooms[2].id)
+
+    def test_inbox_is_an_index_range_scan(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN output is SQLite specific')
+        queryset = ChatRoom.objects.for_inbox(self.user).order_by(*ChatRoomPagination.ordering)[:21]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' / '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('users_chatreadstate_inbox', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ConversationKeyTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='buyer')
+        self.owner = User.objects.create(username='owner')
+        self.product = make_products(self.owner, 1)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_double_tap_returns_one_room(self):
+        first = self.client.post(reverse('create-chat-room'), {'product_id': self.product.id}, format='json')
+        second = self.client.post(reverse('create-chat-room'), {'product_id': self.product.id}, format='json')
+        self.assertEqual((first.status_code, second.status_code), (201, 200))
+        self.assertEqual(first.data['id'], second.data['id'])
+        room = ChatRoom.objects.get()
+        self.assertEqual((room.user_low_id, room.user_high_id), (self.user.id, self.owner.id))
+        self.assertEqual(set(room.participants.values_list('id', flat=True)), {self.user.id, self.owner.id})
+
+    def test_key_is_unique(self):
+        ChatRoom.objects.create(product=self.product, user_low=self.user, user_high=self.owner)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ChatRoom.objects.create(product=self.product, user_low=self.user, user_high=self.owner)
+
+    def test_losing_the_insert_race_returns_the_winner(self):
+        winner, _ = ChatRoom.objects.get_or_create_conversation(self.product, self.owner, self.user)
+        real_get = ChatRoomQuerySet.get
+        calls = []
+
+        def get(queryset, *args, **kwargs):
+            # The first lookup misses, as if the other request had not committed yet
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise ChatRoom.DoesNotExist
+            return real_get(queryset, *args, **kwargs)
+
+        with mock.patch.object(ChatRoomQuerySet, 'get', get):
+            room, created = ChatRoom.objects.get_or_create_conversation(self.product, self.user, self.owner)
+        self.assertEqual((room, created), (winner, False))
+        self.assertEqual(ChatRoom.objects.count(), 1)
+
+
+class QueryPlanTests(TestCase):
+    """
+    EXPLAIN every SELECT the hot views run, with its real bound parameters,
+    and fail on a full table scan or on a sort an index should provide.
+    """
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN output is SQLite specific')
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.product = make_products(self.other, 3)[0]
+        self.own_product = make_products(self.user, 2, wanted_items='product')[0]
+        self.room, _ = ChatRoom.objects.get_or_create_conversation(self.product, self.user, self.other)
+        Message.objects.create(chat_room=self.room, sender=self.other, content='hi')
+        ProductLike.objects.create(user=self.user, product=self.product)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_queries(self, url, data=None):
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            if sql.startswith('SELECT'):
+                queries.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+    def assert_indexed(self, url, data=None, allow_sort=False):
+        with connection.cursor() as cursor:
+            for sql, params in self.get_queries(url, data):
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = [row[-1] for row in cursor.fetchall()]
+                for step in plan:
+                    full_scan = step.startswith('SCAN ') and ' INDEX ' not in step
+                    if full_scan or (step.startswith('USE TEMP B-TREE') and not allow_sort):
+                        self.fail(f'{step} in plan of {url}:\n{sql}\n' + '\n'.join(plan))
+
+    def test_product_feed(self):
+        self.assert_indexed(reverse('all-products'))
+        cursor = self.client.get(reverse('all-products'), {'page_size': 1}).data['next']
+        self.assert_indexed(cursor)
+
+    def test_my_products(self):
+        self.assert_indexed(reverse('my-products'))
+
+    def test_chat_list(self):
+        self.assert_indexed(reverse('my-chats'))
+
+    def test_chat_messages(self):
+        self.assert_indexed(reverse('chat-messages', args=[self.room.id]))
+        self.assert_indexed(reverse('chat-messages', args=[self.room.id]), {'after_id': 0})
+
+    def test_feed(self):
+        FeedRecommendation.objects.create(user=self.user, product=self.product, rank=0, score=1)
+        self.assert_indexed(reverse('feed'))
+
+    def test_nearby_products(self):
+        Product.objects.filter(owner=self.other).update(latitude=25.04, longitude=121.56, geohash=geo.encode(25.04, 121.56))
+        self.assert_indexed(reverse('nearby-products'), {'lat': 25.0330, 'lng': 121.5654})
+
+    def test_product_changes(self):
+        self.product.save()
+        self.own_product.delete()
+        token = changes.encode_token(0, timezone.now())
+        self.assert_indexed(reverse('product-changes'), {'since': token})
+
+    def test_product_matches(self):
+        # Ranked aggregates are sorted by score, but must still reach rows through indexes
+        self.assert_indexed(reverse('product-matches', args=[self.own_product.id]), allow_sort=True)
+
+
+class RepresentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        self.owner = User.objects.create(username='owner', email='owner@example.com')
+        self.products = make_products(self.owner, 3)
+        for product in self.products:
+            room, _ = ChatRoom.objects.get_or_create_conversation(product, self.user, self.owner)
+            Message.objects.create(chat_room=room, sender=self.owner, content='hi')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_sparse_fields(self):
+        # Twice: the second page comes out of the representation cache
+        for _ in range(2):
+            results = self.client.get(
+                reverse('all-products'), {'fields': 'id,title,owner.username'}
+            ).data['results']
+            self.assertEqual(results[0], {
+                'id': self.products[2].id, 'title': 'Product 2', 'owner': {'username': 'owner'},
+            })
+
+        room = self.client.get(reverse('my-chats'), {'fields': 'id,unread_count,last_message.content'})
+        self.assertEqual(set(room.data['results'][0]), {'id', 'unread_count', 'last_message'})
+        self.assertEqual(room.data['results'][0]['last_message'], {'content': 'hi'})
+
+        room = self.client.get(reverse('my-chats'), {'fields': 'id,other_participant.username'})
+        self.assertEqual(room.data['results'][0]['other_participant'], {'username': 'owner'})
+        room = self.client.get(reverse('my-chats'), {'fields': 'other_participant.username', 'normalize': '1'})
+        self.assertEqual(room.data['users'], {str(self.owner.id): {'username': 'owner'}})
+
+    def test_normalized_users(self):
+        response = self.client.get(reverse('my-chats'), {'normalize': '1'})
+        users = response.data['users']
+        self.assertEqual(set(users), {str(self.user.id), str(self.owner.id)})
+        self.assertEqual(users[str(self.owner.id)]['email'], 'owner@example.com')
+        for room in response.data['results']:
+            self.assertEqual(sorted(room['participants']), sorted([self.user.id, self.owner.id]))
+            self.assertEqual(room['other_participant'], self.owner.id)
+            self.assertEqual(room['product']['owner'], self.owner.id)
+            self.assertEqual(room['last_message']['sender'], self.owner.id)
+
+        full = self.client.get(reverse('my-chats'))
+        self.assertLess(len(response.content), len(full.content))
+
+        for _ in range(2):
+            feed = self.client.get(reverse('all-products'), {'normalize': '1'}).data
+            self.assertEqual([item['owner'] for item in feed['results']], [self.owner.id] * 3)
+            self.assertEqual(list(feed['users']), [str(self.owner.id)])
+
+    def test_sparse_fields_with_normalized_users(self):
+        for _ in range(2):
+            response = self.client.get(
+                reverse('all-products'), {'fields': 'id,owner.username', 'normalize': '1'}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['results'][0], {'id': self.products[2].id, 'owner': self.owner.id})
+            self.assertEqual(response.data['users'], {str(self.owner.id): {'username': 'owner'}})
+
+    def test_normalized_bare_list(self):
+        room = ChatRoom.objects.first()
+        response = self.client.get(
+            reverse('chat-messages', args=[room.id]), {'after_id': 0, 'normalize': 'true'}
+        )
+        self.assertEqual(response.data['results'][0]['sender'], self.owner.id)
+        self.assertIn(str(self.owner.id), response.data['users'])
+
+
+class StreamingListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        self.owner = User.objects.create(username='owner')
+        self.products = make_products(self.owner, 7)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def stream(self, url, data):
+        response = self.client.get(url, data)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_streams_every_row_in_page_order(self):
+        paged = self.client.get(reverse('all-products'), {'page_size': 100}).data['results']
+        for encoder in (streaming.orjson, None):
+            with mock.patch.object(streaming, 'orjson', encoder), \
+                    mock.patch.object(StreamingListMixin, 'stream_chunk_size', 3):
+                streamed = self.stream(reverse('all-products'), {'stream': '1'})
+            self.assertEqual(streamed, json.loads(json.dumps(paged)))
+
+    def test_streams_with_fields_and_normalized_users(self):
+        for product in self.products[:4]:
+            ChatRoom.objects.get_or_create_conversation(product, self.user, self.owner)
+        with mock.patch.object(StreamingListMixin, 'stream_chunk_size', 3):
+            body = self.stream(reverse('my-chats'), {
+                'stream': '1', 'normalize': '1', 'fields': 'id,participants,product.owner',
+            })
+        self.assertEqual(len(body['results']), 4)
+        self.assertEqual(body['results'][0]['product'], {'owner': self.owner.id})
+        self.assertEqual(set(body['users']), {str(self.user.id), str(self.owner.id)})
+
+    def test_item_list(self):
+        Item.objects.bulk_create(Item(title=f'Item {i}', location='Taipei', wanted_items='a,b') for i in range(3))
+        client = APIClient()
+        self.assertEqual(
+            self.stream(reverse('item-list'), {'stream': '1'}),
+            json.loads(client.get(reverse('item-list')).content),
+        )
+
+
+class ChatSocketTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.user, self.other)
+        self.token = Token.objects.create(user=self.user)
+        self.other_token = Token.objects.create(user=self.other)
+
+    def connect(self, query):
+        return WebsocketCommunicator(
+            application, f'/ws/chats/{self.room.id}/?{query}', headers=[(b'origin', b'http://testserver')]
+        )
+
+    async def test_rejects_anonymous(self):
+        communicator = self.connect('')
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4401)
+
+    async def test_pushes_messages_read_receipts_and_typing(self):
+        mine = self.connect(f'key={self.token.key}')
+        theirs = self.connect(f'key={self.other_token.key}')
+        self.assertTrue((await mine.connect())[0])
+        self.assertTrue((await theirs.connect())[0])
+
+        def send_message():
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(chat_room=self.room, sender=self.other, content='hello')
+        await sync_to_async(send_message)()
+        for communicator in (mine, theirs):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event['type'], 'message')
+            self.assertEqual(event['message']['content'], 'hello')
+
+        await mine.send_json_to({'type': 'typing'})
+        self.assertEqual(await theirs.receive_json_from(), {
+            'type': 'typing', 'user_id': self.user.id, 'is_typing': True,
+        })
+
+        await mine.send_json_to({'type': 'read'})
+        self.assertEqual(
+            await theirs.receive_json_from(), {'type': 'read', 'user_id': self.user.id}
+        )
+        state = await ChatReadState.objects.aget(chat_room=self.room, user=self.user)
+        self.assertEqual(state.read_count, 1)
+
+        await mine.disconnect()
+        await theirs.disconnect()
+
+    async def test_read_after_leaving_the_room_closes_the_socket(self):
+        communicator = self.connect(f'key={self.token.key}')
+        self.assertTrue((await communicator.connect())[0])
+        await self.room.participants.aremove(self.user)
+        await communicator.send_json_to({'type': 'read'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4403})
+        await communicator.wait()
+
+    def test_channel_layer_outage_does_not_fail_the_write(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        layer = mock.Mock(group_send=mock.AsyncMock(side_effect=ConnectionError('redis down')))
+        with mock.patch('users.realtime.get_channel_layer', return_value=layer), \
+                self.assertLogs('users.realtime', 'ERROR'), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                reverse('chat-messages', args=[self.room.id]), {'content': 'hello'}, format='json'
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Message.objects.filter(chat_room=self.room, content='hello').exists())
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.products = make_products(self.other, 3)
+        ProductLike.objects.create(user=self.user, product=self.products[0])
+        self.room = ChatRoom.objects.create(product=self.products[0])
+        self.room.participants.add(self.user, self.other)
+        self.message = Message.objects.create(chat_room=self.room, sender=self.other, content='hi')
+        self.headers = {'Authorization': f'Token {Token.objects.create(user=self.user).key}'}
+
+    async def test_requires_credentials(self):
+        response = await self.async_client.get(reverse('async-all-products'))
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get(
+            reverse('async-all-products'), headers={'Authorization': 'Token nope'}
+        )
+        self.assertEqual(response.status_code, 401)
+
+    async def test_feed_matches_sync_view(self):
+        response = await self.async_client.get(reverse('async-all-products'), headers=self.headers)
+        expected = await sync_to_async(self.sync_get)(reverse('all-products'))
+        self.assertEqual(response.json(), expected)
+        self.assertEqual([p['is_liked'] for p in response.json()['results']], [False, False, True])
+
+    async def test_chat_list_and_normalized_messages(self):
+        response = await self.async_client.get(reverse('async-my-chats'), headers=self.headers)
+        [room] = response.json()['results']
+        self.assertEqual(room['unread_count'], 1)
+        self.assertEqual(room['other_participant']['username'], 'other')
+
+        response = await self.async_client.get(
+            reverse('async-chat-messages', args=[self.room.id]), {'normalize': '1'}, headers=self.headers
+        )
+        body = response.json()
+        self.assertEqual(body['results'][0]['sender'], self.other.id)
+        self.assertEqual(body['users'][str(self.other.id)]['username'], 'other')
+
+    async def test_send_message_and_toggle_like(self):
+        url = reverse('async-chat-messages', args=[self.room.id])
+        response = await self.async_client.post(
+            url, {'content': 'hello'}, content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['sender']['id'], self.user.id)
+        room = await ChatRoom.objects.aget(pk=self.room.pk)
+        self.assertEqual(room.message_count, 2)
+
+        url = reverse('async-toggle-product-like', args=[self.products[1].id])
+        response = await self.async_client.post(url, headers=self.headers)
+        self.assertEqual(response.json(), {'liked': True, 'likes_count': 1})
+        response = await self.async_client.post(url, headers=self.headers)
+        self.assertEqual(response.json(), {'liked': False, 'likes_count': 0})
+
+    async def test_other_users_room_is_not_found(self):
+        stranger_room = await ChatRoom.objects.acreate()
+        response = await self.async_client.get(
+            reverse('async-chat-messages', args=[stranger_room.id]), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(CHAT_LONG_POLL_INTERVAL=5)
+    async def test_long_poll_wakes_on_new_message(self):
+        def send_reply():
+            Message.objects.create(chat_room=self.room, sender=self.other, content='reply')
+            notify_new_message(self.room.id)
+
+        async def reply_later():
+            await asyncio.sleep(0.05)
+            await sync_to_async(send_reply)()
+
+        task = asyncio.ensure_future(reply_later())
+        started = time.monotonic()
+        response = await self.async_client.get(
+            reverse('async-chat-messages', args=[self.room.id]),
+            {'after_id': self.message.id, 'wait': 5}, headers=self.headers,
+        )
+        await task
+        self.assertEqual([m['content'] for m in response.json()], ['reply'])
+        self.assertLess(time.monotonic() - started, 1)
+
+    def sync_get(self, url):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return json.loads(client.get(url).content)
+
+
+@override_settings(DATABASE_REPLICA_ALIAS='replica')
+class DatabaseRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = PrimaryReplicaRouter()
+        self.middleware = ReplicaPinningMiddleware(
+            lambda request: HttpResponse(self.router.db_for_read(Product))
+        )
+
+    def read_db(self, method, token):
+        request = getattr(RequestFactory(), method)('/', HTTP_AUTHORIZATION=f'Token {token}')
+        return self.middleware(request).content.decode()
+
+    def test_only_allowed_reads_go_to_replica(self):
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+            product = Product()
+            product._state.db = 'default'
+            self.assertEqual(self.router.db_for_read(User, instance=product), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'users'))
+
+    def test_client_reads_its_own_writes(self):
+        self.assertEqual(self.read_db('get', 'a'), 'replica')
+        self.assertEqual(self.read_db('post', 'a'), 'default')
+        self.assertEqual(self.read_db('get', 'a'), 'default')
+        self.assertEqual(self.read_db('get', 'b'), 'replica')
+        cache.clear()
+        self.assertEqual(self.read_db('get', 'a'), 'replica')
+
+
+class FirebaseAuthenticationCacheTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        cache.clear()
+        self.user = User.objects.create(username='fb', firebase_uid='uid-1')
+        self.claims = {'uid': 'uid-1', 'sub': 'uid-1', 'exp': time.time() + 3600}
+
+    def authenticate(self, token='token-1'):
+        return FirebaseAuthentication().authenticate_credentials(token)
+
+    def test_second_request_skips_verification_and_database(self):
+        with mock.patch('users.authentication.verify_id_token', return_value=self.claims) as verify:
+            self.authenticate()
+            with self.assertNumQueries(0):
+                user, _ = self.authenticate()
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_expired_claims_are_verified_again(self):
+        self.claims['exp'] = time.time() - 1
+        with mock.patch('users.authentication.verify_id_token', return_value=self.claims) as verify:
+            self.authenticate()
+            self.authenticate()
+        self.assertEqual(verify.call_count, 2)
+
+    def test_profile_update_invalidates_cached_user(self):
+        key = user_cache_key('uid-1')
+        with mock.patch('users.authentication.verify_id_token', return_value=self.claims):
+            self.authenticate()
+            self.assertIsNotNone(cache.get(key))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.location = 'Tainan'
+                self.user.save()
+            self.assertIsNone(cache.get(key))
+            with self.assertNumQueries(1):
+                user, _ = self.authenticate()
+            with self.assertNumQueries(0):
+                self.assertEqual(self.authenticate()[0].location, 'Tainan')
+        self.assertEqual(user.location, 'Tainan')
+
+    def test_deactivated_user_is_rejected(self):
+        with mock.patch('users.authentication.verify_id_token', return_value=self.claims):
+            self.authenticate()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.is_active = False
+                self.user.save()
+            with self.assertRaises(exceptions.AuthenticationFailed):
+                self.authenticate()
+
+    def test_certificates_refresh_in_background_before_expiry(self):
+        cache = CertificateCache(refresh_margin=60)
+        fetched = threading.Event()
+
+        def fetch():
+            fetched.set()
+            return {'kid': 'pem'}, 30
+        with mock.patch.object(cache, 'fetch', side_effect=fetch) as fetch_mock:
+            self.assertEqual(cache.get(), {'kid': 'pem'})
+            fetched.clear()
+            # Inside the refresh margin: served from memory, refreshed off-thread
+            self.assertEqual(cache.get(), {'kid': 'pem'})
+            self.assertTrue(fetched.wait(1))
+        self.assertEqual(fetch_mock.call_count, 2)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        owner = User.objects.create(username='owner')
+        self.bike = Product.objects.create(
+            owner=owner, title='Road bike', description='Light frame', category='sports',
+            image='https://example.com/1.png', wanted_items='camera', location='Taipei',
+        )
+        self.lamp = Product.objects.create(
+            owner=owner, title='Desk lamp', description='Works with any bike light bulb',
+            category='home', image='https://example.com/2.png', wanted_items='books',
+            location='Taipei',
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get(reverse('product-search'), params)
+        return [item['id'] for item in response.data['results']]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.search(q='bike'), [self.bike.id, self.lamp.id])
+
+    def test_prefix_and_filters(self):
+        self.assertEqual(self.search(q='cam'), [self.bike.id])
+        self.assertEqual(self.search(q='bike', category='home'), [self.lamp.id])
+        self.bike.status = 'exchanged'
+        self.bike.save()
+        self.assertEqual(self.search(q='bike'), [self.lamp.id])
+
+    def test_delete_removes_from_index(self):
+        self.lamp.delete()
+        self.assertEqual(self.search(q='bike'), [self.bike.id])
+
+    def test_cursor_pages(self):
+        first = self.client.get(reverse('product-search'), {'q': 'bike', 'page_size': 1}).data
+        self.assertEqual([item['id'] for item in first['results']], [self.bike.id])
+        second = self.client.get(first['next']).data
+        self.assertEqual([item['id'] for item in second['results']], [self.lamp.id])
+        self.assertIsNone(second['next'])
+
+    def test_rebuild(self):
+        Product.objects.filter(id=self.bike.id).update(title='Tent')
+        self.assertEqual(search.rebuild_index(), 2)
+        self.assertEqual(self.search(q='tent'), [self.bike.id])
+
+
+class GeoTests(TestCase):
+    def test_encode_and_distance(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertAlmostEqual(geo.haversine_km(25.0330, 121.5654, 22.6273, 120.3014), 297, delta=3)
+
+    def test_nearby_cells_cover_the_circle(self):
+        for latitude, longitude, radius in [(25.03, 121.56, 10), (59.9, 10.7, 40), (-33.9, 151.2, 1), (0, 179.99, 5)]:
+            cells = geo.nearby_cells(latitude, longitude, radius)
+            for bearing in range(0, 360, 15):
+                # A point radius km away along bearing, by the equirectangular approximation
+                lat = latitude + radius * 0.999 * math.cos(math.radians(bearing)) / geo.KM_PER_DEGREE_LAT
+                lng = longitude + radius * 0.999 * math.sin(math.radians(bearing)) / (
+                    geo.KM_PER_DEGREE_LNG * math.cos(math.radians(lat))
+                )
+                lng = (lng + 180) % 360 - 180
+                self.assertTrue(any(geo.encode(lat, lng).startswith(cell) for cell in cells), (latitude, bearing))
+
+    def test_geocode(self):
+        self.assertEqual(geo.geocode('Taipei City'), geo.geocode('台北市'))
+        self.assertEqual(geo.geocode("Da'an, Taipei"), geo.geocode('Daan'))
+        self.assertIsNone(geo.geocode('Atlantis'))
+
+
+class NearbyProductsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me', latitude=25.0330, longitude=121.5654)
+        self.other = User.objects.create(username='other')
+        self.near, self.middle, self.edge = [
+            self.make_product(self.other, km, category) for km, category in [(0.5, 'books'), (3, 'toys'), (8, 'books')]
+        ]
+        self.make_product(self.other, 30, 'books')
+        self.make_product(self.other, 1, 'books', status='exchanged')
+        self.make_product(self.user, 1, 'books')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_product(self, owner, km_north, category, **kwargs):
+        return Product.objects.create(
+            owner=owner, title=f'{km_north} km', description='', category=category,
+            image='https://example.com/image.png', wanted_items='lamp', location='Taipei',
+            latitude=25.0330 + km_north / geo.KM_PER_DEGREE_LAT, longitude=121.5654, **kwargs,
+        )
+
+    def test_nearest_first_within_radius(self):
+        response = self.client.get(reverse('nearby-products'))
+        results = response.data['results']
+        self.assertEqual([p['id'] for p in results], [self.near.id, self.middle.id, self.edge.id])
+        self.assertAlmostEqual(results[0]['distance_km'], 0.5, places=2)
+
+        response = self.client.get(reverse('nearby-products'), {'lat': 25.0330, 'lng': 121.5654, 'radius': 5, 'category': 'books'})
+        self.assertEqual([p['id'] for p in response.data['results']], [self.near.id])
+
+    def test_product_deleted_mid_request(self):
+        nsmallest = heapq.nsmallest
+
+        def delete_nearest(*args, **kwargs):
+            rows = nsmallest(*args, **kwargs)
+            self.near.delete()
+            return rows
+        with mock.patch('heapq.nsmallest', delete_nearest):
+            results = self.client.get(reverse('nearby-products')).data['results']
+        self.assertEqual([p['id'] for p in results], [self.middle.id, self.edge.id])
+        self.assertAlmostEqual(results[0]['distance_km'], 3, delta=0.1)
+        self.assertAlmostEqual(results[1]['distance_km'], 8, delta=0.1)
+
+    def test_cursor_pagination(self):
+        response = self.client.get(reverse('nearby-products'), {'page_size': 2})
+        self.assertEqual([p['id'] for p in response.data['results']], [self.near.id, self.middle.id])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([p['id'] for p in response.data['results']], [self.edge.id])
+        self.assertIsNone(response.data['next'])
+
+    def test_requires_a_location(self):
+        self.user.latitude = self.user.longitude = None
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('nearby-products')).status_code, 400)
+        self.assertEqual(self.client.get(reverse('nearby-products'), {'lat': 'x', 'lng': 1}).status_code, 400)
+
+    def test_new_products_are_geocoded(self):
+        response = self.client.post(reverse('my-products'), {
+            'title': 'Lamp', 'description': 'Bright', 'category': 'home',
+            'image': 'https://example.com/lamp.png', 'wanted_items': 'books', 'location': 'Taichung',
+        }, format='json')
+        product = Product.objects.get(id=response.data['id'])
+        self.assertEqual((product.latitude, product.longitude), geo.geocode('Taichung'))
+        self.assertEqual(product.geohash, geo.encode(product.latitude, product.longitude))
+
+    def test_unchanged_location_keeps_coordinates(self):
+        product = self.make_product(self.user, 0, 'books')
+        Product.objects.filter(id=product.id).update(latitude=25.1, longitude=121.7)
+        response = self.client.patch(
+            reverse('product-detail', args=[product.id]), {'title': 'Lamp', 'location': 'Taipei'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        product.refresh_from_db()
+        self.assertEqual((product.latitude, product.longitude), (25.1, 121.7))
+
+        self.user.location = 'Atlantis'
+        self.user.save()
+        self.client.patch(reverse('user-profile'), {'location': 'Atlantis'}, format='json')
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.latitude, self.user.longitude), (25.0330, 121.5654))
+        self.client.patch(reverse('user-profile'), {'location': 'Tainan'}, format='json')
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.latitude, self.user.longitude), geo.geocode('Tainan'))
+
+    def test_geocode_command(self):
+        [product] = make_products(self.other, 1, location='Kaohsiung')
+        make_products(self.other, 1, location='Atlantis')
+        out = io.StringIO()
+        call_command('geocode_locations', stdout=out)
+        product.refresh_from_db()
+        self.assertEqual(product.geohash, geo.encode(*geo.geocode('Kaohsiung')))
+        self.assertIn('Atlantis', out.getvalue())
+
+
+class FeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.products = make_products(self.other, 4)
+        make_products(self.user, 1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def recommend(self, *products):
+        FeedRecommendation.objects.bulk_create(
+            FeedRecommendation(user=self.user, product=product, rank=rank, score=1 / (rank + 1))
+            for rank, product in enumerate(products)
+        )
+
+    def test_recency_fallback(self):
+        response = self.client.get(reverse('feed'))
+        self.assertEqual(response.data['source'], 'recent')
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_personalized_pages_continue_with_recent(self):
+        a, b, c, d = self.products
+        self.recommend(c, a, d)
+        Product.objects.filter(id=d.id).update(status='exchanged')
+        ProductLike.objects.create(user=self.user, product=a)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('feed'), {'page_size': 1})
+        self.assertEqual(response.data['source'], 'personalized')
+        self.assertEqual([p['id'] for p in response.data['results']], [c.id])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([(p['id'], p['is_liked']) for p in response.data['results']], [(a.id, True)])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['source'], 'recent')
+        self.assertEqual([p['id'] for p in response.data['results']], [c.id])
+
+    def test_likes_mark_the_feed_stale(self):
+        self.client.post(reverse('toggle-product-like', args=[self.products[0].id]))
+        self.assertTrue(StaleFeed.objects.filter(user=self.user).exists())
+        StaleFeed.objects.all().delete()
+        self.user.delete()
+        self.assertFalse(StaleFeed.objects.exists())
+
+    def test_command_requires_numpy(self):
+        with mock.patch('users.recommendations.is_available', return_value=False):
+            with self.assertRaises(CommandError):
+                call_command('build_recommendations')
+
+    @skipUnless(recommendations.is_available(), 'NumPy and SciPy are not installed')
+    def test_build_ranks_co_liked_products(self):
+        a, b, c, d = self.products
+        buyer = User.objects.create(username='buyer')
+        for product in (a, b, c):
+            ProductLike.objects.create(user=buyer, product=product)
+        ProductLike.objects.create(user=self.user, product=a)
+        ProductLike.objects.create(user=self.user, product=b)
+        ProductLike.objects.create(user=self.other, product=d)
+
+        call_command('build_recommendations', stdout=io.StringIO())
+        ranked = list(FeedRecommendation.objects.filter(user=self.user).order_by('rank').values_list('product', flat=True))
+        self.assertEqual(ranked, [c.id])
+        # other owns everything they could be recommended
+        self.assertFalse(FeedRecommendation.objects.filter(user=self.other).exists())
+        self.assertFalse(StaleFeed.objects.exists())
+
+        ProductLike.objects.filter(user=self.user, product=b).delete()
+        ProductLike.objects.create(user=buyer, product=d)
+        self.assertEqual(recommendations.build(incremental=True), 2)
+        ranked = list(FeedRecommendation.objects.filter(user=self.user).order_by('rank').values_list('product', flat=True))
+        self.assertEqual(ranked[0], b.id)
+        self.assertEqual(set(ranked), {b.id, c.id, d.id})
+
+
+class BarterMatchTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (
+            User.objects.create(username=name) for name in ('alice', 'bob', 'carol')
+        )
+        self.camera = self.listing(self.alice, 'Film camera', 'electronics', 'bikes, tent')
+        self.bike = self.listing(self.bob, 'Mountain bike', 'sports', 'camera lens, books')
+        self.tent = self.listing(self.bob, 'Camping tent', 'sports', 'guitar')
+        self.guitar = self.listing(self.carol, 'Acoustic guitar', 'others', 'camera')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def listing(self, owner, title, category, wanted):
+        return Product.objects.create(
+            owner=owner, title=title, category=category, wanted_items=wanted,
+            description='', image='https://example.com/x.png', location='Taipei',
+        )
+
+    def test_direct_and_cycle_matches(self):
+        response = self.client.get(reverse('product-matches', args=[self.camera.id]))
+        self.assertEqual([m['product']['id'] for m in response.data['direct']], [self.bike.id])
+        self.assertEqual(
+            [[p['id'] for p in c['products']] for c in response.data['cycles']],
+            [[self.tent.id, self.guitar.id]],
+        )
+
+    def test_index_follows_product_changes(self):
+        self.bike.status = 'exchanged'
+        self.bike.save()
+        self.assertEqual(matching.find_direct_matches(self.camera), [])
+        self.bike.status = 'available'
+        self.bike.wanted_items = 'skateboard'
+        self.bike.save()
+        self.assertEqual(matching.find_direct_matches(self.camera), [])
+        self.assertEqual(matching.rebuild_index(), 4)
+
+    def test_broad_terms_read_newest_postings(self):
+        bikes = [self.listing(self.carol, 'Road bike', 'sports', 'camera') for _ in range(3)]
+        with mock.patch.object(matching, 'POSTINGS_PER_TERM', 2):
+            direct = matching.find_direct_matches(self.camera)
+            with CaptureQueriesContext(connection) as queries:
+                matching.find_trade_cycles(self.camera)
+        self.assertEqual(sorted(product_id for product_id, _ in direct), [bike.id for bike in bikes[1:]])
+        self.assertIn('LIMIT 2', queries[0]['sql'])
+
+    def test_deleted_match_is_skipped(self):
+        with mock.patch.object(matching, 'find_direct_matches', return_value=[(self.bike.id, 2), (999999, 2)]):
+            response = self.client.get(reverse('product-matches', args=[self.camera.id]))
+        self.assertEqual([m['product']['id'] for m in response.data['direct']], [self.bike.id])
+
+    def test_only_own_products(self):
+        response = self.client.get(reverse('product-matches', args=[self.bike.id]))
+        self.assertEqual(response.status_code, 404)
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.mine = make_products(self.user, 2)
+        self.theirs = make_products(self.other, 2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_create_and_update_products(self):
+        new = {
+            'title': 'Tandem bicycle', 'description': 'Seats two', 'category': 'sports',
+            'image': 'https://example.com/bike.png', 'wanted_items': 'kayak', 'location': 'Tainan',
+        }
+        response = self.client.post(reverse('batch-my-products'), {
+            'create': [new, {'title': 'No image'}],
+            'update': [
+                {'id': self.mine[0].id, 'title': 'Renamed', 'status': 'pending'},
+                {'id': self.theirs[0].id, 'title': 'Not mine'},
+                {'title': 'No id'},
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        created, updated = response.data['created'], response.data['updated']
+        self.assertEqual([item['status'] for item in created], [201, 400])
+        self.assertEqual([item['status'] for item in updated], [200, 404, 400])
+        self.assertIn('image', created[1]['errors'])
+
+        product = Product.objects.get(id=created[0]['data']['id'])
+        self.assertEqual((product.owner, product.geohash[:4]), (self.user, geo.encode(*geo.geocode('Tainan'), 4)))
+        self.assertEqual([row[0] for row in search.search_product_ids('tandem', 10)], [product.id])
+        renamed = Product.objects.get(id=self.mine[0].id)
+        self.assertEqual((renamed.title, renamed.status), ('Renamed', 'pending'))
+        self.assertGreater(renamed.updated_at, self.mine[0].updated_at)
+        self.assertEqual(updated[0]['data']['title'], 'Renamed')
+        self.assertEqual(Product.objects.get(id=self.theirs[0].id).title, 'Product 0')
+
+    def test_batch_size_limit(self):
+        with override_settings(BATCH_MAX_ITEMS=2):
+            response = self.client.post(
+                reverse('batch-toggle-likes'), {'product_ids': [1, 2, 3]}, format='json'
+            )
+        self.assertEqual(response.status_code, 400)
+
+    def test_fetch_by_ids(self):
+        ids = [self.theirs[1].id, self.mine[0].id, 999999]
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('product-batch'), {'ids': ','.join(map(str, ids))})
+        self.assertEqual([item['id'] for item in response.data['results']], ids[:2])
+        self.assertEqual(response.data['missing'], [999999])
+        self.assertEqual(self.client.get(reverse('product-batch'), {'ids': 'a'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('product-batch'), {'ids': str(10 ** 23)}).status_code, 400)
+
+    def test_out_of_range_ids(self):
+        for name, key in [('batch-toggle-likes', 'product_ids'), ('batch-mark-read', 'chat_room_ids')]:
+            response = self.client.post(reverse(name), {key: [10 ** 23, -1]}, format='json')
+            self.assertEqual([item['status'] for item in response.data['results']], [400, 400])
+        response = self.client.post(reverse('batch-my-products'), {'update': [{'id': 10 ** 23}]}, format='json')
+        self.assertEqual(response.data['updated'][0]['status'], 400)
+
+    def test_like_toggles(self):
+        first, second = self.theirs
+        response = self.client.post(reverse('batch-toggle-likes'), {
+            'product_ids': [first.id, second.id, first.id, 999999],
+        }, format='json')
+        results = response.data['results']
+        self.assertEqual([item['status'] for item in results], [200, 200, 200, 404])
+        self.assertEqual([item['data']['liked'] for item in results[:3]], [True, True, False])
+        self.assertEqual(results[0]['data']['likes_count'], 0)
+        self.assertEqual(results[1]['data']['likes_count'], 1)
+        self.assertEqual(list(ProductLike.objects.values_list('product_id', flat=True)), [second.id])
+
+    def test_mark_rooms_read(self):
+        rooms = [ChatRoom.objects.create() for _ in range(3)]
+        for room in rooms[:2]:
+            room.participants.add(self.user, self.other)
+            Message.objects.create(chat_room=room, sender=self.other, content='hi')
+        rooms[2].participants.add(self.other)
+        response = self.client.post(reverse('batch-mark-read'), {
+            'chat_room_ids': [room.id for room in rooms],
+        }, format='json')
+        self.assertEqual([item['status'] for item in response.data['results']], [200, 200, 404])
+        states = ChatReadState.objects.filter(user=self.user).values_list('read_count', flat=True)
+        self.assertEqual(list(states), [1, 1])
+
+
+class ProductChangesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.products = make_products(self.other, 4)
+        make_products(self.user, 1)
+        # bulk_create sends no signals; log them like the migration does for existing rows
+        changes.record(Product.objects.order_by('id').values_list('id', flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, token=None, **params):
+        if token:
+            params['since'] = token
+        return self.client.get(reverse('product-changes'), params)
+
+    def test_initial_sync_pages_through_listed_products(self):
+        self.assertEqual(self.sync(page_size=2).data['tombstones'], [])
+        seen, token, has_more = [], None, True
+        while has_more:
+            response = self.sync(token, page_size=2)
+            seen += [item['id'] for item in response.data['upserts']]
+            token, has_more = response.data['next'], response.data['has_more']
+        self.assertEqual(seen, [product.id for product in self.products])
+        self.assertEqual(self.sync(token).data['upserts'], [])
+
+    def test_changes_and_tombstones(self):
+        token = self.sync().data['next']
+        changed, deleted, exchanged, untouched = self.products
+        changed.title = 'Renamed'
+        changed.save()
+        deleted_id = deleted.id
+        deleted.delete()
+        exchanged.status = 'exchanged'
+        exchanged.save()
+        new = Product.objects.create(
+            owner=self.other, title='New', description='', image='https://example.com/x.png',
+            wanted_items='', location='Taipei',
+        )
+        # Changes, the new token's stamp, products
+        with self.assertNumQueries(3):
+            response = self.sync(token)
+        self.assertEqual([item['id'] for item in response.data['upserts']], [changed.id, new.id])
+        self.assertEqual(response.data['upserts'][0]['title'], 'Renamed')
+        self.assertEqual(response.data['tombstones'], [deleted_id, exchanged.id])
+        self.assertEqual(self.sync('garbage').status_code, 400)
+
+    def test_owner_changes_are_logged_but_logins_are_not(self):
+        token = self.sync().data['next']
+        self.other.last_login = timezone.now()
+        self.other.save(update_fields=['last_login'])
+        self.assertEqual(self.sync(token).data['upserts'], [])
+        self.other.first_name = 'Olive'
+        self.other.save()
+        self.assertEqual(len(self.sync(token).data['upserts']), 4)
+
+    def test_compaction_and_expired_tokens(self):
+        token = self.sync().data['next']
+        for product in self.products[:2]:
+            product.save()
+        deleted_id = self.products[3].id
+        self.products[3].delete()
+        self.assertEqual(call_command('compact_product_changes', stdout=io.StringIO()), None)
+        # One row per product, and the tombstone is still within retention
+        self.assertEqual(ProductChange.objects.count(), 5)
+        self.assertEqual(self.sync(token).data['tombstones'], [deleted_id])
+
+        old = timezone.now() - timedelta(days=31)
+        ProductChange.objects.filter(deleted=True).update(created_at=old)
+        # Past retention but not compacted yet, so nothing has been missed
+        stale = changes.encode_token(changes.decode_token(token)[0], old)
+        self.assertEqual(self.sync(stale).status_code, 200)
+        tombstone_id = ProductChange.objects.get(deleted=True).id
+        self.assertEqual(changes.compact(), 1)
+        response = self.sync(stale)
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.data['reset'])
+        # Ids are AUTOINCREMENT, so compacting the newest row does not free its id
+        self.products[0].save()
+        self.assertGreater(ProductChange.objects.latest('id').id, tombstone_id)
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        self.other = User.objects.create(username='other')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.user, self.other)
+        self.messages = [
+            Message.objects.create(chat_room=self.room, sender=(self.user, self.other)[i % 2], content=f'm{i}')
+            for i in range(11)
+        ]
+        self.room.mark_read(self.user)
+        start = timezone.now() - timedelta(days=400)
+        for i, message in enumerate(self.messages):
+            Message.objects.filter(id=message.id).update(created_at=start + timedelta(minutes=i))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('chat-messages', args=[self.room.id])
+
+    def walk(self, url, **params):
+        pages, url = [], f'{url}?page_size={params.get("page_size", 3)}'
+        while url:
+            response = self.client.get(url)
+            pages.append(response.data)
+            url = response.data['next']
+        return pages
+
+    def test_archives_all_but_the_newest_message_in_segments(self):
+        before = [item for page in self.walk(self.url) for item in page['results']]
+        call_command('archive_messages', segment_size=4, stdout=io.StringIO())
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [self.messages[-1].id])
+        self.assertEqual(
+            list(MessageArchiveSegment.objects.order_by('first_message_id').values_list('message_count', flat=True)),
+            [4, 4, 2],
+        )
+        pages = self.walk(self.url)
+        self.assertEqual([item for page in pages for item in page['results']], before)
+        self.assertEqual(before[0]['sender']['username'], 'me')
+        self.assertTrue(all(item['is_read'] for item in before if item['sender']['id'] == self.other.id))
+
+        # Back again from inside the archive
+        back = self.client.get(pages[2]['previous'])
+        self.assertEqual(back.data['results'], pages[1]['results'])
+
+    def test_tops_up_the_last_segment(self):
+        archive.archive(timezone.now() - timedelta(days=400, seconds=-150), segment_size=4)
+        self.assertEqual(list(MessageArchiveSegment.objects.values_list('message_count', flat=True)), [3])
+        archive.archive(timezone.now(), segment_size=4)
+        self.assertEqual(
+            list(MessageArchiveSegment.objects.order_by('first_message_id').values_list('message_count', flat=True)),
+            [4, 4, 2],
+        )
+
+    def test_deleting_a_user_drops_their_archived_messages(self):
+        archive.archive(timezone.now(), segment_size=4)
+        self.other.delete()
+        contents = [item['content'] for page in self.walk(self.url, page_size=20) for item in page['results']]
+        self.assertEqual(contents, [f'm{i}' for i in range(10, -1, -2)])
+
+    def test_async_view_pages_into_the_archive(self):
+        archive.archive(timezone.now(), segment_size=4)
+        token = Token.objects.create(user=self.user)
+        response = self.client.get(
+            reverse('async-chat-messages', args=[self.room.id]), {'page_size': 20},
+            HTTP_AUTHORIZATION=f'Token {token.key}',
+        )
+        self.assertEqual([item['content'] for item in response.json()['results']], [f'm{i}' for i in range(10, -1, -1)])
+
+
+class LikeCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='me')
+        owner = User.objects.create(username='owner')
+        self.product = make_products(owner, 1)[0]
+        self.url = reverse('toggle-product-like', args=[self.product.id])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_toggle_updates_count_without_touching_updated_at(self):
+        updated_at = Product.objects.get(id=self.product.id).updated_at
+        self.assertEqual(self.client.post(self.url).data, {'liked': True, 'likes_count': 1})
+        self.assertEqual(self.client.post(self.url).data, {'liked': False, 'likes_count': 0})
+        self.assertEqual(Product.objects.get(id=self.product.id).updated_at, updated_at)
+
+    @override_settings(LIKE_COUNTER_MODE='buffered')
+    def test_buffered_mode_defers_the_row_update(self):
+        self.assertEqual(self.client.post(self.url).data['likes_count'], 1)
+        self.assertEqual(Product.objects.get(id=self.product.id).likes_count, 0)
+        self.assertEqual(likes.flush_deltas(), 1)
+        self.assertEqual(Product.objects.get(id=self.product.id).likes_count, 1)
+        self.assertEqual(likes.flush_deltas(), 0)
+
+    def test_reconcile_repairs_drift(self):
+        ProductLike.objects.create(user=self.user, product=self.product)
+        Product.objects.filter(id=self.product.id).update(likes_count=7)
+        self.assertEqual(likes.reconcile_counts(), 1)
+        self.assertEqual(Product.objects.get(id=self.product.id).likes_count, 1)
+
+
+class ConditionalListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='me')
+        owner = User.objects.create(username='owner')
+        self.product = make_products(owner, 3)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, name='all-products', **headers):
+        return self.client.get(reverse(name), headers=headers)
+
+    def assert_revalidates(self, name, change):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.get(name)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(name, if_none_match=first['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        second = self.get(name, if_none_match=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        return second
+
+    def test_product_edit_invalidates_feed(self):
+        def change():
+            self.product.title = 'Renamed'
+            self.product.save()
+        response = self.assert_revalidates('all-products', change)
+        self.assertIn('Renamed', [item['title'] for item in response.data['results']])
+
+    def test_like_invalidates_feed_and_cached_count(self):
+        def change():
+            self.client.post(reverse('toggle-product-like', args=[self.product.id]))
+        response = self.assert_revalidates('all-products', change)
+        item = next(i for i in response.data['results'] if i['id'] == self.product.id)
+        self.assertEqual((item['is_liked'], item['likes_count']), (True, 1))
+
+    def test_scopes_follow_the_listed_products(self):
+        mine = make_products(self.user, 1)[0]
+        feed, own = self.get(), self.get('my-products')
+        liker = User.objects.create(username='liker')
+        with self.captureOnCommitCallbacks(execute=True):
+            likes.toggle(liker, self.product.id)
+            ProductLike.objects.create(user=liker, product=mine)
+        self.assertEqual(self.get(if_none_match=feed['ETag']).status_code, 304)
+        self.assertEqual(self.get('my-products', if_none_match=own['ETag']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'Renamed'
+            self.product.save()
+        self.assertEqual(self.get(if_none_match=feed['ETag']).status_code, 200)
+        self.assertEqual(self.get('my-products', if_none_match=own['ETag']).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            mine.title = 'Mine renamed'
+            mine.save()
+        self.assertEqual(self.get('my-products', if_none_match=own['ETag']).status_code, 200)
+
+    def test_new_message_invalidates_chat_list(self):
+        other = User.objects.create(username='other')
+        room = ChatRoom.objects.create()
+        room.participants.add(self.user, other)
+        self.assert_revalidates(
+            'my-chats', lambda: Message.objects.create(chat_room=room, sender=other, content='hi')
+        )
+
+    def test_partner_profile_edit_invalidates_chat_list(self):
+        other = User.objects.create(username='other')
+        room = ChatRoom.objects.create()
+        room.participants.add(self.user, other)
+
+        def change():
+            other.first_name = 'Renamed'
+            other.save()
+        response = self.assert_revalidates('my-chats', change)
+        self.assertEqual(response.data['results'][0]['other_participant']['first_name'], 'Renamed')
+
+    def test_if_modified_since(self):
+        start = 1_700_000_000 * 10 ** 9
+        scope = caching.owner_products_scope(self.user.id)
+
+        def at(offset_ms):
+            return mock.patch('users.caching.time.time_ns', return_value=start + offset_ms * 10 ** 6)
+        with at(100):
+            first = self.get('my-products')
+        # A write later in the same second must not be hidden by a 304
+        with at(200):
+            caching.bump_versions(scope)
+            self.assertEqual(self.get('my-products', if_modified_since=first['Last-Modified']).status_code, 200)
+        with at(2500):
+            second = self.get('my-products')
+            self.assertEqual(self.get('my-products', if_modified_since=second['Last-Modified']).status_code, 304)
+        with at(2600):
+            caching.bump_versions(scope)
+            self.assertEqual(self.get('my-products', if_modified_since=second['Last-Modified']).status_code, 200)
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_generate_leaves_existing_rooms_alone(self):
+        user, other = User.objects.create(username='me'), User.objects.create(username='other')
+        [product] = make_products(other, 1)
+        room = ChatRoom.objects.create(product=product)
+        room.participants.add(user, other)
+        Message.objects.create(chat_room=room, sender=user, content='hello')
+        Message.objects.create(chat_room=room, sender=other, content='hi')
+        room.mark_read(user)
+        state = ChatReadState.objects.get(chat_room=room, user=user)
+        before = ChatRoom.objects.values('message_count', 'last_message_id', 'last_activity_at').get(pk=room.pk)
+
+        call_command('generate_fake_data', users=3, products=5, likes=5, rooms=2, messages=10, stdout=io.StringIO())
+        self.assertEqual(
+            ChatRoom.objects.values('message_count', 'last_message_id', 'last_activity_at').get(pk=room.pk), before
+        )
+        self.assertEqual(
+            ChatReadState.objects.values_list('last_read_message_id', 'read_count').get(pk=state.pk),
+            (state.last_read_message_id, state.read_count),
+        )
+
+    def test_generate_and_benchmark(self):
+        call_command(
+            'generate_fake_data', users=5, products=20, likes=30, rooms=4, messages=40,
+            seed=1, stdout=io.StringIO(),
+        )
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(ProductChange.objects.count(), 20)
+        self.assertEqual(Message.objects.count(), 40)
+        before = self.snapshot()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            call_command('benchmark_api', iterations=2, warmup=0, output=output, stdout=io.StringIO())
+            with open(output) as f:
+                routes = json.load(f)['routes']
+            call_command(
+                'benchmark_api', iterations=2, warmup=0, baseline=output, stdout=io.StringIO()
+            )
+        self.assertIn('all-products', routes)
+        self.assertEqual(routes['all-products']['status'], [200])
+        for name in ('batch-my-products', 'product-batch', 'batch-toggle-likes', 'batch-mark-read'):
+            self.assertEqual(routes[name]['status'], [200])
+        self.assertTrue({'p50_ms', 'p95_ms', 'p99_ms', 'queries', 'bytes'} <= routes['my-chats'].keys())
+        # Writes were rolled back
+        self.assertEqual(self.snapshot(), before)
+
+    @staticmethod
+    def snapshot():
+        return (
+            list(Product.objects.order_by('id').values_list('id', 'title', 'likes_count')),
+            list(ProductLike.objects.order_by('id').values_list('id', flat=True)),
+            list(ChatRoom.objects.order_by('id').values_list('id', flat=True)),
+            list(ChatReadState.objects.order_by('id').values_list('id', 'last_read_message_id')),
+        )
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.reset()
+        self.user = User.objects.create(username='viewer')
+        make_products(User.objects.create(username='owner'), 3)
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+    def test_records_per_route_histograms(self):
+        self.client.get(reverse('all-products'))
+        text = self.client.get('/metrics').content.decode()
+        samples = dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+        self.assertEqual(samples['http_request_duration_seconds_count{route="all-products"}'], '1')
+        self.assertGreater(float(samples['http_request_sql_queries_sum{route="all-products"}']), 0)
+        self.assertGreater(float(samples['http_request_serializer_duration_seconds_sum{route="all-products"}']), 0)
+        self.assertGreater(float(samples['http_request_auth_duration_seconds_sum{route="all-products"}']), 0)
+        self.assertIn('http_response_size_bytes_bucket{route="all-products",le="+Inf"} 1', text)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0)
+    def test_logs_slow_requests_with_queries(self):
+        with self.assertLogs('backend.metrics', 'WARNING') as logs:
+            self.client.get(reverse('my-products'))
+        self.assertIn('(my-products)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_scrape_token(self):
+        client = APIClient()
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        response = client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
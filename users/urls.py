@@ -1,9 +1,11 @@
 from django.urls import path
+from . import async_views
 from .views import (
     item_list, UserProfileView, MyProductsView, ProductDetailView,
     AllProductsView, MyChatRoomsView, ChatRoomDetailView, 
     ChatMessagesView, toggle_product_like, create_chat_room,
-    mark_messages_read
+    mark_messages_read, ProductSearchView, NearbyProductsView, FeedView, product_matches,
+    batch_my_products, ProductBatchView, batch_toggle_likes, batch_mark_read, ProductChangesView
 )
 
 urlpatterns = [
@@ -15,14 +17,35 @@ urlpatterns = [
     
     # Product endpoints
     path('api/my-products/', MyProductsView.as_view(), name='my-products'),
+    path('api/my-products/batch/', batch_my_products, name='batch-my-products'),
     path('api/my-products/<int:pk>/', ProductDetailView.as_view(), name='product-detail'),
     path('api/products/', AllProductsView.as_view(), name='all-products'),
+    path('api/products/search/', ProductSearchView.as_view(), name='product-search'),
+    path('api/products/nearby/', NearbyProductsView.as_view(), name='nearby-products'),
+    path('api/products/changes/', ProductChangesView.as_view(), name='product-changes'),
+    path('api/products/batch/', ProductBatchView.as_view(), name='product-batch'),
+    path('api/products/likes/batch/', batch_toggle_likes, name='batch-toggle-likes'),
+    path('api/feed/', FeedView.as_view(), name='feed'),
     path('api/products/<int:product_id>/like/', toggle_product_like, name='toggle-product-like'),
+    path('api/products/<int:product_id>/matches/', product_matches, name='product-matches'),
     
     # Chat endpoints
     path('api/my-chats/', MyChatRoomsView.as_view(), name='my-chats'),
     path('api/chats/<int:pk>/', ChatRoomDetailView.as_view(), name='chat-room-detail'),
     path('api/chats/<int:chat_room_id>/messages/', ChatMessagesView.as_view(), name='chat-messages'),
     path('api/chats/<int:chat_room_id>/mark-read/', mark_messages_read, name='mark-messages-read'),
+    path('api/chats/mark-read/batch/', batch_mark_read, name='batch-mark-read'),
     path('api/chats/create/', create_chat_room, name='create-chat-room'),
+
+    # Async variants of the hot paths, for ASGI deployments
+    path('api/async/products/', async_views.all_products, name='async-all-products'),
+    path(
+        'api/async/products/<int:product_id>/like/', async_views.toggle_product_like,
+        name='async-toggle-product-like',
+    ),
+    path('api/async/my-chats/', async_views.my_chats, name='async-my-chats'),
+    path(
+        'api/async/chats/<int:chat_room_id>/messages/', async_views.chat_messages,
+        name='async-chat-messages',
+    ),
 ]
\ No newline at end of file
@@ -1,34 +1,55 @@
+import heapq
+
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
-from .models import Product, ChatRoom, Message, ProductLike, Item
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils.dateparse import parse_datetime
+from .models import Product, ChatRoom, FeedRecommendation, Message, ProductLike, Item
 from .serializers import (
     UserSerializer, ProductSerializer, ChatRoomSerializer, 
     MessageSerializer
 )
+from . import archive, batch, caching, changes, geo, likes, matching, search
+from .caching import ConditionalListMixin
+from .fieldsets import RepresentationMixin, apply_fieldset, sideload_user
+from .pagination import (
+    KeysetPagination, ChatRoomPagination, FeedPagination, MessagePagination, cursor_float, cursor_int,
+    encode_cursor,
+)
+from .longpoll import wait_for_messages
+from .realtime import broadcast_read_receipt
+from .streaming import StreamingListMixin, iter_json_array, streaming_json_response
 
 User = get_user_model()
 
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def item_list(request):
-    """Legacy endpoint for backward compatibility"""
-    items = Item.objects.all().order_by('-created_at')
-    data = [
-        {
-            'id': item.id,
-            'title': item.title,
-            'location': item.location,
-            'image': item.image,
-            'wanted_items': item.wanted_items.split(',') if item.wanted_items else [],
-            'created_at': item.created_at.isoformat(),
-        }
-        for item in items
-    ]
-    return Response(data)
+    """Legacy endpoint for backward compatibility; ?stream=1 streams the whole list"""
+    rows = Item.objects.order_by('-created_at').values_list(
+        'id', 'title', 'location', 'image', 'wanted_items', 'created_at'
+    )
+    if request.query_params.get('stream') in ('1', 'true'):
+        return streaming_json_response(iter_json_array(
+            serialize_item(*row) for row in rows.iterator(chunk_size=StreamingListMixin.stream_chunk_size)
+        ))
+    return Response([serialize_item(*row) for row in rows])
+
+def serialize_item(id, title, location, image, wanted_items, created_at):
+    return {
+        'id': id,
+        'title': title,
+        'location': location,
+        'image': image,
+        'wanted_items': wanted_items.split(',') if wanted_items else [],
+        'created_at': created_at.isoformat(),
+    }
 
 class UserProfileView(generics.RetrieveUpdateAPIView):
     """Get and update user profile"""
@@ -38,86 +59,471 @@ class UserProfileView(generics.RetrieveUpdateAPIView):
     def get_object(self):
         return self.request.user
 
-class MyProductsView(generics.ListCreateAPIView):
+class MyProductsView(StreamingListMixin, ConditionalListMixin, RepresentationMixin, generics.ListCreateAPIView):
     """List user's products and create new products"""
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Product.objects.filter(owner=self.request.user)
+        return Product.objects.filter(owner=self.request.user).with_like_state(self.request.user)
+
+    def get_version_scopes(self):
+        return [caching.owner_products_scope(self.request.user.id), caching.likes_scope(self.request.user.id)]
 
-class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def batch_my_products(request):
+    """
+    Create and update many of my products in one transaction:
+    {"create": [{...}, ...], "update": [{"id": 1, ...}, ...]}
+    """
+    try:
+        creates, updates = batch.get_items(request.data, 'create', 'update')
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    created, updated = batch.save_products(request, creates, updates)
+    return Response({'created': created, 'updated': updated})
+
+class ProductDetailView(RepresentationMixin, generics.RetrieveUpdateDestroyAPIView):
     """Get, update, or delete a specific product"""
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Product.objects.filter(owner=self.request.user)
+        return Product.objects.filter(owner=self.request.user).with_like_state(self.request.user)
 
-class AllProductsView(generics.ListAPIView):
+class AllProductsView(StreamingListMixin, ConditionalListMixin, RepresentationMixin, generics.ListAPIView):
     """List all available products"""
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
-        return Product.objects.filter(status='available').exclude(owner=self.request.user)
+        return (
+            Product.objects.filter(status='available')
+            .exclude(owner=self.request.user)
+            .with_like_state(self.request.user)
+        )
+
+    def get_version_scopes(self):
+        return [caching.PRODUCTS_SCOPE, caching.likes_scope(self.request.user.id)]
+
+    def get_list_response(self, request, *args, **kwargs):
+        """
+        Page through ids only, then fill in product representations from the
+        shared cache (serializing just the misses) and merge this user's
+        is_liked flags with one extra query. The cache holds full
+        representations; ?fields= and ?normalize= are applied to the copies.
+        """
+        queryset = (
+            Product.objects.filter(status='available')
+            .exclude(owner=request.user)
+            .only('id', 'created_at')
+        )
+        product_ids = [product.id for product in self.paginate_queryset(queryset)]
+
+        representations = caching.get_product_representations(product_ids)
+        missing = [product_id for product_id in product_ids if product_id not in representations]
+        if missing:
+            products = Product.objects.with_like_state(None).order_by().in_bulk(missing)
+            serializer = ProductSerializer(
+                [products[product_id] for product_id in missing if product_id in products],
+                many=True, context={'request': request},
+            )
+            fresh = {item['id']: dict(item) for item in serializer.data}
+            caching.set_product_representations(fresh)
+            representations.update(fresh)
+
+        liked = set(
+            ProductLike.objects.filter(user=request.user, product_id__in=product_ids)
+            .values_list('product_id', flat=True)
+        )
+        fieldset, users = self.get_fieldset(), self.get_sideloaded_users()
+        data = []
+        for product_id in product_ids:
+            if product_id not in representations:
+                continue
+            item = {**representations[product_id], 'is_liked': product_id in liked}
+            # Side-load before projecting, which may drop the owner's id
+            if users is not None and (fieldset is None or 'owner' in fieldset):
+                owner_fields = fieldset['owner'] if fieldset is not None else None
+                item['owner'] = sideload_user(users, item['owner'], owner_fields)
+            if fieldset is not None:
+                item = apply_fieldset(item, fieldset)
+            data.append(item)
+        return self.get_paginated_response(data)
+
+class ProductBatchView(RepresentationMixin, generics.GenericAPIView):
+    """Products by id, ?ids=1,2,3, in the order asked for; unknown ids are listed under "missing" """
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        values = [value for value in request.query_params.get('ids', '').split(',') if value.strip()]
+        if len(values) > settings.BATCH_MAX_ITEMS:
+            return Response(
+                {'error': f'At most {settings.BATCH_MAX_ITEMS} items per batch'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            ids = [batch.parse_id(int(value)) for value in values]
+            if None in ids:
+                raise ValueError
+        except ValueError:
+            return Response(
+                {'error': 'ids must be a comma separated list of product ids'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        products = Product.objects.with_like_state(request.user).order_by().in_bulk(ids)
+        found = list(dict.fromkeys(product_id for product_id in ids if product_id in products))
+        serializer = self.get_serializer([products[product_id] for product_id in found], many=True)
+        return Response({
+            'results': serializer.data,
+            'missing': list(dict.fromkeys(product_id for product_id in ids if product_id not in products)),
+        })
+
+class ProductChangesView(RepresentationMixin, generics.GenericAPIView):
+    """
+    Delta sync of the catalogue AllProductsView lists.
+
+    Without ?since= start from scratch: every listed product. With
+    ?since=<token> return the products changed since that token, plus under
+    "tombstones" the ids of changed products that were deleted or are no
+    longer listed. Store "next" and keep asking while "has_more" is true.
+    410 Gone means the token expired: drop the local copy and start over.
+    """
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    page_size = 500
+    max_page_size = 1000
+
+    def get(self, request, *args, **kwargs):
+        token = request.query_params.get('since') or None
+        try:
+            page_size = min(int(request.query_params.get('page_size', self.page_size)), self.max_page_size)
+            if page_size < 1:
+                raise ValueError
+            product_ids, next_token, has_more = changes.read(token, page_size)
+        except changes.TokenExpired:
+            return Response(
+                {'error': 'Sync token expired, sync again without since', 'reset': True},
+                status=status.HTTP_410_GONE
+            )
+        except ValueError:
+            return Response(
+                {'error': 'since must be a token from an earlier response and page_size a positive integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        products = (
+            Product.objects.filter(status='available')
+            .exclude(owner=request.user)
+            .with_like_state(request.user)
+            .order_by()
+            .in_bulk(product_ids)
+        )
+        serializer = self.get_serializer(
+            [products[product_id] for product_id in product_ids if product_id in products], many=True
+        )
+        # A fresh replica holds nothing to delete
+        tombstones = [product_id for product_id in product_ids if product_id not in products] if token else []
+        return Response({
+            'upserts': serializer.data,
+            'tombstones': tombstones,
+            'next': next_token,
+            'has_more': has_more,
+        })
+
+class ProductSearchView(RepresentationMixin, generics.ListAPIView):
+    """Full-text search over products by title, description and wanted items"""
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'q is required'}, status=status.HTTP_400_BAD_REQUEST)
+        category = request.query_params.get('category')
+        product_status = request.query_params.get('status', 'available')
+
+        if not search.is_available():
+            queryset = Product.objects.filter(
+                Q(title__icontains=query) | Q(description__icontains=query) |
+                Q(wanted_items__icontains=query)
+            ).exclude(owner=request.user).with_like_state(request.user)
+            if category:
+                queryset = queryset.filter(category=category)
+            if product_status:
+                queryset = queryset.filter(status=product_status)
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        # Ranked by bm25, so the cursor is the (rank, id) of the last result
+        page_size = self.paginator.get_page_size(request)
+        after, _ = self.paginator.get_position(request, (cursor_float, cursor_int))
+        rows = search.search_product_ids(
+            query, page_size + 1, after=after, exclude_owner=request.user.id,
+            category=category, status=product_status,
+        )
+        next_link = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_link = replace_query_param(
+                request.build_absolute_uri(), self.paginator.cursor_query_param,
+                encode_cursor({'p': [rows[-1][1], rows[-1][0]]}),
+            )
+
+        products = Product.objects.with_like_state(request.user).in_bulk([row[0] for row in rows])
+        results = [products[product_id] for product_id, _ in rows if product_id in products]
+        serializer = self.get_serializer(results, many=True)
+        return Response({'next': next_link, 'previous': None, 'results': serializer.data})
+
+class NearbyProductsView(RepresentationMixin, generics.ListAPIView):
+    """
+    Available products within ?radius= km (default 10, at most 100) of
+    ?lat=&lng=, or of the user's saved coordinates, nearest first. Each
+    result carries its distance_km. ?category= narrows the results.
+    """
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetPagination
+    default_radius_km = 10.0
+    max_radius_km = 100.0
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        try:
+            if 'lat' in params or 'lng' in params:
+                latitude, longitude = float(params['lat']), float(params['lng'])
+            else:
+                latitude, longitude = request.user.latitude, request.user.longitude
+            radius = min(float(params.get('radius', self.default_radius_km)), self.max_radius_km)
+            if latitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and radius > 0):
+                raise ValueError
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'lat and lng (or a saved location) and a positive radius are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        queryset = Product.objects.filter(status='available').exclude(owner=request.user)
+        if params.get('category'):
+            queryset = queryset.filter(category=params['category'])
+        queryset = queryset.near(latitude, longitude, radius)
 
-class MyChatRoomsView(generics.ListAPIView):
+        # Ranked by exact distance, so the cursor is the (distance, id) of the last result
+        page_size = self.paginator.get_page_size(request)
+        after, _ = self.paginator.get_position(request, (cursor_float, cursor_int))
+        candidates = (
+            (geo.haversine_km(latitude, longitude, lat, lng), product_id)
+            for product_id, lat, lng in queryset.values_list('id', 'latitude', 'longitude')
+        )
+        rows = heapq.nsmallest(page_size + 1, (
+            row for row in candidates
+            if row[0] <= radius and (after is None or row > tuple(after))
+        ))
+        next_link = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_link = replace_query_param(
+                request.build_absolute_uri(), self.paginator.cursor_query_param,
+                encode_cursor({'p': list(rows[-1])}),
+            )
+
+        products = (
+            Product.objects.with_like_state(request.user).order_by()
+            .in_bulk([product_id for _, product_id in rows])
+        )
+        # Pair before serializing so a product deleted meanwhile doesn't shift the distances
+        found = [(products[product_id], distance) for distance, product_id in rows if product_id in products]
+        data = self.get_serializer([product for product, _ in found], many=True).data
+        for item, (_, distance) in zip(data, found):
+            item['distance_km'] = round(distance, 3)
+        return Response({'next': next_link, 'previous': None, 'results': data})
+
+class FeedView(RepresentationMixin, generics.ListAPIView):
+    """
+    The user's personalized feed as ranked offline by users.recommendations,
+    best first. Users without one, and anyone paging past its end, continue
+    with the newest available products (?source=recent).
+    """
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FeedPagination
+    source_query_param = 'source'
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.source_query_param) != 'recent':
+            entries = self.paginate_queryset(
+                FeedRecommendation.objects.filter(user=request.user, product__status='available')
+                .select_related('product__owner')
+                .annotate(is_liked=Exists(
+                    ProductLike.objects.filter(user=request.user, product=OuterRef('product'))
+                ))
+            )
+            if entries or request.query_params.get(self.paginator.cursor_query_param):
+                for entry in entries:
+                    entry.product.is_liked = entry.is_liked
+                data = self.paginator.get_paginated_data(
+                    self.get_serializer([entry.product for entry in entries], many=True).data
+                )
+                if not self.paginator.has_next:
+                    data['next'] = self.get_recent_link(request)
+                return Response({**data, 'source': 'personalized'})
+
+        paginator = KeysetPagination()
+        queryset = (
+            Product.objects.filter(status='available')
+            .exclude(owner=request.user)
+            .with_like_state(request.user)
+        )
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        paginator.base_url = replace_query_param(paginator.base_url, self.source_query_param, 'recent')
+        data = paginator.get_paginated_data(self.get_serializer(page, many=True).data)
+        return Response({**data, 'source': 'recent'})
+
+    def get_recent_link(self, request):
+        url = remove_query_param(request.build_absolute_uri(), self.paginator.cursor_query_param)
+        return replace_query_param(url, self.source_query_param, 'recent')
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def product_matches(request, product_id):
+    """Direct two-way swaps and three-way trade cycles for one of my products"""
+    product = get_object_or_404(Product, id=product_id, owner=request.user)
+    direct = matching.find_direct_matches(product)
+    cycles = matching.find_trade_cycles(product)
+
+    product_ids = {product_id for product_id, _ in direct}
+    product_ids.update(product_id for pair, _ in cycles for product_id in pair)
+    products = Product.objects.with_like_state(request.user).in_bulk(product_ids)
+    context = {'request': request}
+
+    def serialize(product_id):
+        return ProductSerializer(products[product_id], context=context).data
+
+    # Skip matches deleted since the index was read
+    return Response({
+        'direct': [
+            {'product': serialize(product_id), 'score': score}
+            for product_id, score in direct if product_id in products
+        ],
+        'cycles': [
+            {'products': [serialize(b_id), serialize(c_id)], 'score': score}
+            for (b_id, c_id), score in cycles if b_id in products and c_id in products
+        ],
+    })
+
+class MyChatRoomsView(StreamingListMixin, ConditionalListMixin, RepresentationMixin, generics.ListAPIView):
     """List user's chat rooms"""
     serializer_class = ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ChatRoomPagination
+
+    def get_version_scopes(self):
+        # Chat rooms embed products, so product and like changes matter too
+        return [
+            caching.chats_scope(self.request.user.id),
+            caching.PRODUCTS_SCOPE,
+            caching.likes_scope(self.request.user.id),
+        ]
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user).order_by('-updated_at')
+        return ChatRoom.objects.for_inbox(self.request.user)
 
-class ChatRoomDetailView(generics.RetrieveAPIView):
+class ChatRoomDetailView(RepresentationMixin, generics.RetrieveAPIView):
     """Get specific chat room details"""
     serializer_class = ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user)
+        return ChatRoom.objects.for_inbox(self.request.user)
 
-class ChatMessagesView(generics.ListCreateAPIView):
-    """List messages in a chat room and send new messages"""
+class ChatMessagesView(StreamingListMixin, RepresentationMixin, generics.ListCreateAPIView):
+    """List messages in a chat room (newest first) and send new messages"""
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessagePagination
 
     def get_queryset(self):
         chat_room_id = self.kwargs['chat_room_id']
         chat_room = get_object_or_404(ChatRoom, id=chat_room_id, participants=self.request.user)
-        return Message.objects.filter(chat_room=chat_room).order_by('created_at')
+        return Message.objects.filter(chat_room=chat_room).with_read_state().select_related('sender')
+
+    def list(self, request, *args, **kwargs):
+        """
+        Without parameters, page back through history newest first,
+        archived history included.
+
+        With ?after_id=<message id> (or ?since=<ISO timestamp>) return only newer
+        messages, oldest first, capped at one batch. Adding ?wait=<seconds> holds
+        the request until a new message arrives or the wait expires.
+        """
+        params = request.query_params
+        if 'after_id' not in params and 'since' not in params:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.get_queryset()
+        try:
+            if 'after_id' in params:
+                queryset = queryset.filter(id__gt=int(params['after_id']))
+            if 'since' in params:
+                since = parse_datetime(params['since'])
+                if since is None:
+                    raise ValueError
+                queryset = queryset.filter(created_at__gt=since)
+            wait = min(float(params.get('wait', 0)), settings.CHAT_LONG_POLL_MAX_WAIT)
+        except ValueError:
+            return Response(
+                {'error': 'after_id must be an integer, since an ISO timestamp and wait a number'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if wait > 0:
+            wait_for_messages(
+                self.kwargs['chat_room_id'], queryset.exists, wait,
+                poll_interval=settings.CHAT_LONG_POLL_INTERVAL,
+            )
+        # Ids grow with created_at, and the (chat_room, id) index yields them in order
+        batch = queryset.order_by('id')[:self.pagination_class.max_page_size]
+        serializer = self.get_serializer(batch, many=True)
+        return Response(serializer.data)
+
+    def paginate_queryset(self, queryset):
+        """Page through the hot rows, then on into the room's archive"""
+        rows = list(self.paginator.get_page_queryset(queryset, self.request))
+        return self.paginator.set_page(archive.fill_page(self.paginator, rows, self.kwargs['chat_room_id']))
 
     def perform_create(self, serializer):
         chat_room_id = self.kwargs['chat_room_id']
         chat_room = get_object_or_404(ChatRoom, id=chat_room_id, participants=self.request.user)
-        serializer.save(sender=self.request.user, chat_room=chat_room)
+        # The message row and the room's counters (see ChatRoom.record_message) commit together
+        with transaction.atomic():
+            serializer.save(sender=self.request.user, chat_room=chat_room)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def toggle_product_like(request, product_id):
     """Toggle like/unlike for a product"""
-    product = get_object_or_404(Product, id=product_id)
-    like, created = ProductLike.objects.get_or_create(
-        user=request.user, 
-        product=product
-    )
-    
-    if not created:
-        like.delete()
-        product.likes_count = max(0, product.likes_count - 1)
-        liked = False
-    else:
-        product.likes_count += 1
-        liked = True
-    
-    product.save()
+    get_object_or_404(Product.objects.only('id'), id=product_id)
+    liked = likes.toggle(request.user, product_id)
     
     return Response({
         'liked': liked,
-        'likes_count': product.likes_count
+        'likes_count': likes.current_count(product_id)
     })
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def batch_toggle_likes(request):
+    """Apply several like toggles in order, in one transaction: {"product_ids": [1, 2, ...]}"""
+    try:
+        product_ids, = batch.get_items(request.data, 'product_ids')
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': batch.toggle_likes(request.user, product_ids)})
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def create_chat_room(request):
@@ -126,31 +532,18 @@ def create_chat_room(request):
     product = get_object_or_404(Product, id=product_id)
     
     # Don't allow chat with own product
-    if product.owner == request.user:
+    if product.owner_id == request.user.id:
         return Response(
             {'error': 'Cannot create chat room with your own product'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Check if chat room already exists
-    existing_room = ChatRoom.objects.filter(
-        participants=request.user
-    ).filter(
-        participants=product.owner
-    ).filter(
-        product=product
-    ).first()
-    
-    if existing_room:
-        serializer = ChatRoomSerializer(existing_room, context={'request': request})
-        return Response(serializer.data)
-    
-    # Create new chat room
-    chat_room = ChatRoom.objects.create(product=product)
-    chat_room.participants.add(request.user, product.owner)
+    chat_room, created = ChatRoom.objects.get_or_create_conversation(
+        product, request.user, product.owner
+    )
     
     serializer = ChatRoomSerializer(chat_room, context={'request': request})
-    return Response(serializer.data, status=status.HTTP_201_CREATED)
+    return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -158,10 +551,17 @@ def mark_messages_read(request, chat_room_id):
     """Mark all messages in a chat room as read"""
     chat_room = get_object_or_404(ChatRoom, id=chat_room_id, participants=request.user)
     
-    # Mark all messages from other users as read
-    Message.objects.filter(
-        chat_room=chat_room,
-        is_read=False
-    ).exclude(sender=request.user).update(is_read=True)
+    chat_room.mark_read(request.user)
+    broadcast_read_receipt(chat_room.id, request.user.id)
     
-    return Response({'success': True})
\ No newline at end of file
+    return Response({'success': True})
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def batch_mark_read(request):
+    """Mark several chat rooms read in one transaction: {"chat_room_ids": [1, 2, ...]}"""
+    try:
+        chat_room_ids, = batch.get_items(request.data, 'chat_room_ids')
+    except ValueError as exc:
+        return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': batch.mark_rooms_read(request.user, chat_room_ids)})